@@ -36,6 +36,9 @@ from blueoil.quantizations import (
     linear_mid_tread_half_quantizer,
 )
 
+from dataset_cache import cached_dataset_class
+from distributed import sharded_dataset_class
+
 IS_DEBUG = False
 
 NETWORK_CLASS = LmnetV1Quantize
@@ -43,6 +46,8 @@ NETWORK_CLASS = LmnetV1Quantize
 DATASET_CLASS = type('DATASET_CLASS', (ImageFolderBase,), {'extend_dir': '/opt/ml/input/data/dataset/cifar/train', 'validation_extend_dir': '/opt/ml/input/data/dataset/cifar/test'})
 
 IMAGE_SIZE = [32, 32]
+# Split among the hosts of the job, then decoded and resized once, before the first epoch
+DATASET_CLASS = cached_dataset_class(sharded_dataset_class(DATASET_CLASS), IMAGE_SIZE)
 BATCH_SIZE = 64
 DATA_FORMAT = "NHWC"
 TASK = Tasks.CLASSIFICATION
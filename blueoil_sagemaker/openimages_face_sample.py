@@ -42,6 +42,8 @@ from blueoil.quantizations import (
     linear_mid_tread_half_quantizer,
 )
 
+from distributed import sharded_dataset_class
+
 IS_DEBUG = False
 
 NETWORK_CLASS = LMFYoloQuantize
@@ -49,6 +51,9 @@ NETWORK_CLASS = LMFYoloQuantize
 DATASET_CLASS = type('DATASET_CLASS', (OpenImagesV4BoundingBoxBase,), {'extend_dir': '/opt/ml/input/data/dataset/openimages_face/', 'validation_extend_dir': '/opt/ml/input/data/dataset/openimages_face/'})
 
 IMAGE_SIZE = [224, 224]
+# Split among the hosts of the job. Not cached by dataset_cache: SSDRandomCrop below crops the source images, not ones
+# already resized to IMAGE_SIZE
+DATASET_CLASS = sharded_dataset_class(DATASET_CLASS)
 BATCH_SIZE = 16
 DATA_FORMAT = "NHWC"
 TASK = Tasks.OBJECT_DETECTION
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Decoded and resized copy of a Blueoil dataset, memory-mapped from local disk.
+
+A config opts in by wrapping its dataset class:
+
+    from dataset_cache import cached_dataset_class
+
+    DATASET_CLASS = cached_dataset_class(
+        type('DATASET_CLASS', (ImageFolderBase,), {...}), IMAGE_SIZE,
+    )
+
+Every item of each subset is then decoded and resized to `IMAGE_SIZE` once, by the `Resize` or `ResizeWithGtBoxes` of
+`DATASET.PRE_PROCESSOR` itself, and stored as one uint8 array of images plus one array of labels (one-hot classes, or
+the padded boxes of object detection). Epochs read items from those arrays; augmentation still runs on every item, and
+the pre-processor's resize has nothing left to do. Caches are keyed by the contents of the annotation files and the
+sizes of the images in the dataset's `data_dir`, and by the arguments of the resize, so a changed dataset or config gets
+a new one.
+
+Augmentation then runs on resized images rather than on the source ones. That's the same for flips and color changes,
+but a config whose `DATASET.AUGMENTOR` crops, e.g. `SSDRandomCrop`, would upscale crops of the resized images and train
+on blurrier ones: don't cache its dataset.
+
+`main.py` builds the caches before training with a process pool, by running this module on the config:
+
+    python dataset_cache.py [config file] [--workers N]
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '/opt/ml/input/data/dataset/.cache'
+IMAGES = 'images.npy'
+LABELS = 'labels.npy'
+# Files of a dataset directory keyed by their size, all others by their contents.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+# Written last, so a cache having it is complete.
+META = 'meta.json'
+
+# Dataset and arrays of the cache being built, inherited by the worker processes.
+_building = {}
+
+
+class CachedDatasetMixin(object):
+    """Serve the items of a Blueoil dataset class from its cache, building the cache if missing."""
+
+    # Dataset class given to `cached_dataset_class`.
+    source_class = None
+    cache_image_size = None
+    cache_dir = None
+
+    def __init__(self, *args, **kwargs):
+        super(CachedDatasetMixin, self).__init__(*args, **kwargs)
+        self._arrays = None
+        self._cache_path = None
+
+    def __getstate__(self):
+        # Memory maps are opened again by each process using the dataset.
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __getitem__(self, i):
+        images, labels = self._open()
+        # Copies, augmentors may change them in place.
+        return np.array(images[i]), np.array(labels[i])
+
+    def source_item(self, i):
+        """Decode item i from the dataset itself, without the cache."""
+        return super(CachedDatasetMixin, self).__getitem__(i)
+
+    def source_length(self):
+        return super(CachedDatasetMixin, self).__len__()
+
+    def resize_processor(self):
+        """The `Resize` or `ResizeWithGtBoxes` of the dataset's pre-processor, which the cache resizes items with.
+
+        Raises:
+            ValueError: If the pre-processor has none, or it resizes to another size than `cache_image_size`.
+
+        """
+        from blueoil.pre_processor import Resize, ResizeWithGtBoxes
+
+        pre_processor = getattr(self, 'pre_processor', None)
+        for processor in getattr(pre_processor, 'processors', [pre_processor]):
+            if isinstance(processor, (Resize, ResizeWithGtBoxes)):
+                break
+        else:
+            raise ValueError('The pre-processor of {} has no Resize or ResizeWithGtBoxes to cache items with'.format(
+                type(self).__name__))
+        if list(processor.size) != self.cache_image_size:
+            raise ValueError('The pre-processor of {} resizes to {}, not to {}'.format(
+                type(self).__name__, list(processor.size), self.cache_image_size))
+        return processor
+
+    def cache_path(self):
+        """Directory of the cache of this subset, named after a checksum of its items and of the resize.
+
+        Raises:
+            ValueError: If the dataset has no `data_dir`, whose annotation files the checksum covers, or no resize.
+
+        """
+        if self._cache_path is not None:
+            return self._cache_path
+        data_dir = getattr(self, 'data_dir', None)
+        if data_dir is None or not os.path.isdir(data_dir):
+            raise ValueError('{} has no data_dir to checksum its annotations in, a cache of it could be stale'.format(
+                type(self).__name__))
+        digest = hashlib.sha256()
+        # The whole hierarchy, as the given class may wrap the dataset class too, see `distributed.py`.
+        classes = ['{}.{}'.format(cls.__module__, cls.__qualname__) for cls in self.source_class.__mro__]
+        resize = self.resize_processor()
+        digest.update('{} {} {}{}'.format(
+            classes, self.subset, type(resize).__name__, sorted(vars(resize).items()),
+        ).encode())
+        for file in getattr(self, 'files', None) or []:
+            size = os.path.getsize(file) if os.path.exists(file) else -1
+            digest.update('{} {}\n'.format(file, size).encode())
+        # Share of the items of a host, see `distributed.sharded_dataset_class`.
+        digest.update(repr(getattr(self, 'shard', None)).encode())
+        cache_dir = self.cache_dir or os.environ.get('DATASET_CACHE_DIR', DEFAULT_CACHE_DIR)
+        _update_with_directory(digest, data_dir, exclude=cache_dir)
+        digest.update(str(self.source_length()).encode())
+        # Kept, also by the processes the dataset is handed to: the checksum reads every annotation file.
+        self._cache_path = os.path.join(cache_dir, '{}_{}'.format(self.subset, digest.hexdigest()[:16]))
+        return self._cache_path
+
+    def _open(self):
+        if self._arrays is None:
+            path = self.cache_path()
+            if not os.path.exists(os.path.join(path, META)):
+                build(self, workers=1)
+            self._arrays = (
+                np.load(os.path.join(path, IMAGES), mmap_mode='r'),
+                np.load(os.path.join(path, LABELS), mmap_mode='r'),
+            )
+        return self._arrays
+
+
+def cached_dataset_class(dataset_class, image_size, cache_dir=None):
+    """Return a subclass of a Blueoil dataset class serving its items from a cache.
+
+    Args:
+        dataset_class (type): Dataset class of the config, e.g. a subclass of `OpenImagesV4BoundingBoxBase`.
+        image_size (list): [height, width] the images are resized to, `IMAGE_SIZE` of the config.
+        cache_dir (str): Directory of the caches, `DATASET_CACHE_DIR` of the environment or the `.cache` directory of
+            the dataset channel by default.
+
+    """
+    return type(dataset_class.__name__, (CachedDatasetMixin, dataset_class), {
+        'source_class': dataset_class,
+        'cache_image_size': list(image_size),
+        'cache_dir': cache_dir,
+    })
+
+
+def _update_with_directory(digest, directory, exclude):
+    """Add the images' sizes and other files' contents of a directory tree to a checksum.
+
+    Hidden directories and the `exclude` one, the cache directory, are left out.
+    """
+    exclude = os.path.realpath(exclude)
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(
+            name for name in dirs
+            if not name.startswith('.') and os.path.realpath(os.path.join(root, name)) != exclude
+        )
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            digest.update('{}\n'.format(os.path.relpath(path, directory)).encode())
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                digest.update('{}\n'.format(os.path.getsize(path)).encode())
+                continue
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+
+
+def _resized_item(i):
+    dataset, resize = _building['dataset'], _building['resize']
+    image, label = dataset.source_item(i)
+    if _building['boxes']:
+        sample = resize(image=image, gt_boxes=label)
+        return sample['image'], sample['gt_boxes']
+    return resize(image=image)['image'], label
+
+
+def _store_items(indices):
+    if 'arrays' not in _building:
+        path = _building['path']
+        _building['arrays'] = (
+            np.load(os.path.join(path, IMAGES), mmap_mode='r+'),
+            np.load(os.path.join(path, LABELS), mmap_mode='r+'),
+        )
+    images, labels = _building['arrays']
+    for i in indices:
+        images[i], labels[i] = _resized_item(i)
+    images.flush()
+    labels.flush()
+    return len(indices)
+
+
+def build(dataset, workers=None, chunk_size=64):
+    """Decode and resize every item of a dataset into its cache, unless the cache exists.
+
+    Args:
+        dataset (CachedDatasetMixin): Subset of a dataset class from `cached_dataset_class`.
+        workers (int): Number of processes decoding items, all CPUs by default.
+        chunk_size (int): Items handed to a process at once.
+
+    Returns:
+        str: Directory of the cache.
+
+    """
+    from blueoil.datasets.base import ObjectDetectionBase
+
+    path = dataset.cache_path()
+    if os.path.exists(os.path.join(path, META)):
+        logger.info('Dataset cache {} exists'.format(path))
+        return path
+    start = time.time()
+    boxes = isinstance(dataset, ObjectDetectionBase)
+    _building.clear()
+    _building.update(dataset=dataset, resize=dataset.resize_processor(), boxes=boxes)
+
+    # Built aside and renamed once complete, so an interrupted build is never used.
+    partial_path = '{}.{}.tmp'.format(path, os.getpid())
+    os.makedirs(partial_path)
+    _building['path'] = partial_path
+    count = dataset.source_length()
+    image, label = _resized_item(0)
+    np.lib.format.open_memmap(
+        os.path.join(partial_path, IMAGES), mode='w+', dtype=np.uint8, shape=(count,) + image.shape,
+    )
+    np.lib.format.open_memmap(
+        os.path.join(partial_path, LABELS), mode='w+', dtype=np.asarray(label).dtype,
+        shape=(count,) + np.shape(label),
+    )
+    chunks = [range(i, min(i + chunk_size, count)) for i in range(0, count, chunk_size)]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    try:
+        if workers > 1:
+            # Forked, the workers share the dataset already loaded here.
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for _ in pool.imap_unordered(_store_items, chunks):
+                    pass
+        else:
+            for chunk in chunks:
+                _store_items(chunk)
+        _building.pop('arrays', None)
+        with open(os.path.join(partial_path, META), 'w') as f:
+            json.dump({'count': count, 'image_shape': list(image.shape), 'label_shape': list(np.shape(label))}, f)
+        try:
+            os.rename(partial_path, path)
+        except OSError:
+            # Another process sharing the cache directory built it meanwhile.
+            if not os.path.exists(os.path.join(path, META)):
+                raise
+            shutil.rmtree(partial_path)
+    except BaseException:
+        shutil.rmtree(partial_path, ignore_errors=True)
+        raise
+    finally:
+        _building.clear()
+    logger.info('Cached {} item(s) of {} into {} in {:.1f}s'.format(count, dataset.subset, path, time.time() - start))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the dataset caches of a Blueoil config.')
+    parser.add_argument('config', help='config file whose DATASET_CLASS comes from cached_dataset_class')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all CPUs by default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from blueoil.utils import config as config_util
+    config = config_util.load(args.config)
+    dataset_class = config.DATASET_CLASS
+    # Not issubclass: the config imports this module again as `dataset_cache`.
+    if getattr(dataset_class, 'cache_image_size', None) is None:
+        logger.info('DATASET_CLASS of {} is not cached'.format(args.config))
+        return
+    # Created like Blueoil creates it, with the pre-processor whose resize the cache does.
+    dataset_kwargs = {key.lower(): value for key, value in config.DATASET.items()}
+    dataset_kwargs.pop('enable_prefetch', None)
+    for subset in ('train', 'validation'):
+        if subset in dataset_class.available_subsets:
+            build(dataset_class(subset=subset, **dataset_kwargs), workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Data-parallel training of a Blueoil config on the hosts of a SageMaker training job.
+
+`main.py` runs one training process per host, through `main` of this module:
+
+    python distributed.py /home/blueoil/blueoil/cmd/main.py train --config ...
+
+Hosts are ranked by their name in `resourceconfig.json`, the first one being the leader. Each process is given the
+environment `horovodrun --gloo` gives the processes it launches, and `main` initializes Horovod with it before running
+Blueoil's training, whose Horovod support then broadcasts the initial variables of the leader and averages the
+gradients across the hosts. Gloo needs no MPI or SSH between hosts, only the key-value store `RendezvousServer` the
+leader serves over HTTP, like horovodrun does.
+
+Configs give each host 1 in `WORLD_SIZE` of the items of the train subset with `sharded_dataset_class`, wrapped before
+`cached_dataset_class` if the config caches it, so each host only decodes its share:
+
+    from distributed import sharded_dataset_class
+
+    DATASET_CLASS = cached_dataset_class(sharded_dataset_class(DATASET_CLASS), IMAGE_SIZE)
+
+A single host, without `RANK` and `WORLD_SIZE`, gets all of them.
+"""
+from __future__ import print_function
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import runpy
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+RESOURCE_CONFIG = '/opt/ml/input/config/resourceconfig.json'
+DEFAULT_PORT = 29500
+
+
+def read_cluster(path=RESOURCE_CONFIG):
+    """Hosts of the job and rank of this one, a single host if `path` doesn't exist.
+
+    Returns:
+        dict: "hosts" sorted by name, "current_host", its "rank", "world_size" and "leader", the host of rank 0.
+
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            resource_config = json.load(f)
+        hosts = sorted(resource_config['hosts'])
+        current_host = resource_config['current_host']
+    else:
+        hosts = ['localhost']
+        current_host = hosts[0]
+    return {
+        'hosts': hosts,
+        'current_host': current_host,
+        'rank': hosts.index(current_host),
+        'world_size': len(hosts),
+        'leader': hosts[0],
+    }
+
+
+def worker_env(cluster, address, port):
+    """Environment of the training process of a host.
+
+    Args:
+        cluster (dict): Result of `read_cluster`.
+        address (str): Address of the leader, where `RendezvousServer` listens.
+        port (int): Port of `RendezvousServer`.
+
+    """
+    rank, world_size = str(cluster['rank']), str(cluster['world_size'])
+    return {
+        'RANK': rank,
+        'WORLD_SIZE': world_size,
+        'LOCAL_RANK': '0',
+        'MASTER_ADDR': address,
+        'MASTER_PORT': str(port),
+        # One process per host: the ranks across hosts are the global ones.
+        'HOROVOD_RANK': rank,
+        'HOROVOD_SIZE': world_size,
+        'HOROVOD_LOCAL_RANK': '0',
+        'HOROVOD_LOCAL_SIZE': '1',
+        'HOROVOD_CROSS_RANK': rank,
+        'HOROVOD_CROSS_SIZE': world_size,
+        'HOROVOD_HOSTNAME': cluster['current_host'],
+        'HOROVOD_CONTROLLER': 'gloo',
+        'HOROVOD_CPU_OPERATIONS': 'gloo',
+        'HOROVOD_GLOO_RENDEZVOUS_ADDR': address,
+        'HOROVOD_GLOO_RENDEZVOUS_PORT': str(port),
+    }
+
+
+class _RendezvousHandler(BaseHTTPRequestHandler):
+    # Keys are the paths, e.g. /global/0 for the address of rank 0; a missing one is a 404 the client retries.
+
+    def do_GET(self):
+        with self.server.lock:
+            value = self.server.values.get(self.path)
+        if value is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(value)))
+        self.end_headers()
+        self.wfile.write(value)
+
+    def do_PUT(self):
+        value = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.values[self.path] = value
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_DELETE(self):
+        # A rank done with a scope, e.g. /cross_0/1. Its keys are kept: /cross_0/1 is also the address of rank 1, which
+        # the other ranks of the scope may not have read yet.
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class RendezvousServer(object):
+    """Key-value store over HTTP through which the training processes of the hosts find each other.
+
+    Args:
+        port (int): Port listened to on all interfaces.
+
+    """
+
+    def __init__(self, port=DEFAULT_PORT):
+        self._server = ThreadingHTTPServer(('', port), _RendezvousHandler)
+        self._server.values = {}
+        self._server.lock = threading.Lock()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info('Rendezvous server listening on port {}'.format(self._server.server_address[1]))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class ShardedDatasetMixin(object):
+    """Serve the items of the train subset of a host, 1 in `WORLD_SIZE` of them from the `RANK`-th.
+
+    Every host gets the same number of items, so that all of them take the same number of steps: the gradients are
+    averaged at each step, and a host stepping once more would wait for the others forever. Up to `WORLD_SIZE - 1` items
+    are left out for that.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ShardedDatasetMixin, self).__init__(*args, **kwargs)
+        self._item_count = super(ShardedDatasetMixin, self).num_per_epoch
+        if self.subset == 'train':
+            self.shard = (int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1)))
+        else:
+            # Validation, done by the leader, sees all of it.
+            self.shard = (0, 1)
+
+    @property
+    def num_per_epoch(self):
+        _, world_size = self.shard
+        return self._item_count // world_size
+
+    def __len__(self):
+        return self.num_per_epoch
+
+    def __getitem__(self, i):
+        rank, world_size = self.shard
+        return super(ShardedDatasetMixin, self).__getitem__(rank + i * world_size)
+
+
+def sharded_dataset_class(dataset_class):
+    """Return a subclass of a Blueoil dataset class serving only the share of its train subset of this host."""
+    return type(dataset_class.__name__, (ShardedDatasetMixin, dataset_class), {})
+
+
+def main():
+    """Run a Blueoil command with Horovod initialized from the Gloo settings of `worker_env`.
+
+    Blueoil enables its Horovod support only when launched by MPI, see `blueoil.utils.horovod.is_enabled`; it's
+    enabled here instead.
+    """
+    logging.basicConfig(level=logging.INFO)
+    import horovod.tensorflow as hvd
+    from blueoil.utils import horovod as horovod_util
+
+    hvd.init()
+    size = int(os.environ.get('HOROVOD_SIZE', 1))
+    if hvd.size() != size:
+        raise RuntimeError('Horovod started {} process(es) instead of {}, is it built with Gloo?'.format(
+            hvd.size(), size))
+    if not hasattr(horovod_util, 'is_enabled'):
+        raise RuntimeError('blueoil.utils.horovod has no is_enabled, the Horovod support of Blueoil changed')
+    horovod_util.is_enabled = lambda: True
+    logger.info('Horovod rank {} of {} over Gloo'.format(hvd.rank(), hvd.size()))
+
+    # As if run by python itself.
+    sys.argv = sys.argv[1:]
+    sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+    runpy.run_path(sys.argv[0], run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
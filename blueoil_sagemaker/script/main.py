@@ -17,30 +17,136 @@
 
 from __future__ import print_function
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import errno
 import glob
+import hashlib
 import json
 import logging
 import os
+import re
 import shutil
 import subprocess
 import sys
 import tarfile
+import time
 import traceback
 
+from distributed import DEFAULT_PORT, RendezvousServer, read_cluster, worker_env
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Programs tar streams each kind of archive through, None for plain tar and zip.
+DECOMPRESSORS = {
+    '.gz': 'pigz',
+    '.tgz': 'pigz',
+    '.zst': 'zstd',
+    '.tzst': 'zstd',
+    '.tar': None,
+    '.zip': None,
+}
+# Records the archives already extracted into a directory.
+EXTRACTED_MARKER = '.extracted.json'
+# Files of the converted output the inference server on the device loads.
+RUNTIME_FILES = ['models/lib/libdlk_fpga.so', 'models/meta.yaml', 'python']
+# Per file sizes and sha256, in the packaged directory and next to the package.
+MANIFEST = 'manifest.json'
+
+# Training progress in the output of Blueoil: progress bars ("1200/60000 [====>....] - ETA: 1:02:03"), "step 1200",
+# "step = 1200", "loss: 0.123", and rates such as "global_step/sec: 3.5" or "123.4 examples/sec".
+PROGRESS_PATTERN = re.compile(r'^\s*(\d+)/(\d+) \[')
+STEP_PATTERN = re.compile(r'\bstep[\s:=]+(\d+)', re.IGNORECASE)
+LOSS_PATTERN = re.compile(r'\bloss[\s:=]+([-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)', re.IGNORECASE)
+RATE_PATTERN = re.compile(r'(?:(\w+)/sec[\s:=]+(\d+(?:\.\d*)?)|(\d+(?:\.\d*)?) (\w+)/sec)')
+
+
+class _OutputMonitor(object):
+    """Turn the output of a training or convert command into metrics, keeping its last lines.
+
+    Every `interval` seconds at most, once a new step shows up, the latest step, loss, rates and the steps per second
+    since the previous report are logged as one "METRICS name=value ..." line, for metric definitions of SageMaker
+    such as `{'Name': 'train:steps_per_sec', 'Regex': 'steps_per_sec=([0-9.]+)'}`, and appended to a JSON lines
+    timeline if `timeline_path` is given.
+    """
+
+    def __init__(self, timeline_path=None, interval=30.0, tail_lines=100):
+        self.timeline_path = timeline_path
+        self.interval = interval
+        self.tail = deque(maxlen=tail_lines)
+        self.start = time.time()
+        self.values = {}
+        self._reported_step = None
+        self._reported_at = self.start
+        if timeline_path:
+            os.makedirs(os.path.dirname(timeline_path), exist_ok=True)
+
+    def feed(self, line):
+        """Parse a line of output, reporting metrics when it's time."""
+        self.tail.append(line)
+        match = PROGRESS_PATTERN.match(line) or STEP_PATTERN.search(line)
+        if match:
+            self.values['step'] = int(match.group(1))
+        match = LOSS_PATTERN.search(line)
+        if match:
+            self.values['loss'] = float(match.group(1))
+        for name, value, prefix_value, prefix_name in RATE_PATTERN.findall(line):
+            self.values['{}_per_sec'.format(name or prefix_name)] = float(value or prefix_value)
+        if time.time() - self._reported_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Report the metrics if a new step showed up since the last report."""
+        if self.values.get('step', self._reported_step) != self._reported_step:
+            self.report()
+
+    def report(self):
+        now = time.time()
+        step = self.values.get('step')
+        metrics = dict(self.values, elapsed=round(now - self.start, 1))
+        if step is not None and self._reported_step is not None and now > self._reported_at:
+            metrics['steps_per_sec'] = round((step - self._reported_step) / (now - self._reported_at), 4)
+        self._reported_step = step
+        self._reported_at = now
+        logger.info('METRICS ' + ' '.join('{}={}'.format(name, value) for name, value in sorted(metrics.items())))
+        if self.timeline_path:
+            with open(self.timeline_path, 'a') as f:
+                f.write(json.dumps(dict(metrics, time=now)) + '\n')
+
 
 # Execute your algorithm.
-def _run(cmd):
-    """Invokes your algorithm."""
-    process = subprocess.Popen(cmd, stderr=subprocess.PIPE, env=os.environ)
-    _, stderr = process.communicate()
+def _run(cmd, timeline_path=None):
+    """Invokes your algorithm.
 
-    return_code = process.poll()
+    Its output is logged line by line as it comes, and watched for training metrics by `_OutputMonitor`. Only the last
+    lines are kept, for the error message.
+    """
+    monitor = _OutputMonitor(
+        timeline_path,
+        interval=float(os.environ.get('METRICS_INTERVAL', 30)),
+        tail_lines=int(os.environ.get('OUTPUT_TAIL_LINES', 100)),
+    )
+    # Unbuffered, so that the child's output arrives as it's printed rather than when its buffer fills up.
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+        universal_newlines=True, errors='replace',
+    )
+    # Universal newlines end a line at "\r" too, the way progress bars redraw themselves. Redraws aren't logged, the
+    # metrics report their progress.
+    for line in process.stdout:
+        line = line.rstrip()
+        if not line:
+            continue
+        if not PROGRESS_PATTERN.match(line):
+            print(line, flush=True)
+        monitor.feed(line)
+
+    return_code = process.wait()
+    monitor.flush()
     if return_code:
-        error_msg = 'Return Code: {}, CMD: {}, Err: {}'.format(return_code, cmd, stderr)
+        error_msg = 'Return Code: {}, CMD: {}, Err: {}'.format(return_code, cmd, '\n'.join(monitor.tail))
         raise Exception(error_msg)
 
 
@@ -58,22 +164,157 @@ def _hyperparameters_to_cmd_args(hyperparameters):
     return cmd_args_list
 
 
-def _extract(path):
-    """Extract compressed files of input path."""
-    extensions = {'.gz', '.tgz', '.zip', '.tar'}
-    files = [file.path for file in os.scandir(path) if os.path.splitext(file.name)[1] in extensions]
-    for file in files:
-        logger.info('Extract ' + file)
+def _extract_archive(file, path, delete=False):
+    """Extract one archive into path, streaming it through pigz or zstd when they are installed."""
+    start = time.time()
+    extension = os.path.splitext(file)[1]
+    decompressor = DECOMPRESSORS[extension]
+    if extension == '.zip':
         shutil.unpack_archive(file, path)
+    elif shutil.which('tar') and (decompressor is None or shutil.which(decompressor)):
+        # tar reads the output of the decompressor as it comes, in another process.
+        cmd = ['tar', '-x', '-f', file, '-C', path]
+        if decompressor:
+            cmd += ['--use-compress-program', decompressor]
+        _run(cmd)
+    elif decompressor == 'zstd':
+        raise FileNotFoundError(errno.ENOENT, 'tar and zstd are needed to extract', file)
+    else:
+        with tarfile.open(file, 'r|*') as tar:
+            tar.extractall(path)
+    if delete:
+        os.remove(file)
+    logger.info('Extracted {} in {:.1f}s'.format(file, time.time() - start))
+
+
+def _extract(path, workers=None, delete=False):
+    """Extract compressed files of input path.
+
+    Archives are checksummed and extracted in parallel by up to `workers` processes, all CPUs by default. Those
+    already extracted into path, according to the SHA-256 checksums of the marker file, are skipped. If `delete`, each
+    archive is removed once extracted, which frees disk space but makes the next run on the same directory skip nothing.
+    """
+    files = sorted(file.path for file in os.scandir(path) if os.path.splitext(file.name)[1] in DECOMPRESSORS)
+    marker_path = os.path.join(path, EXTRACTED_MARKER)
+    extracted = {}
+    if os.path.exists(marker_path):
+        with open(marker_path) as f:
+            extracted = json.load(f)
+
+    workers = workers or os.cpu_count() or 1
+    checksums = {}
+    if files:
+        # The whole of each archive: one changed in the middle only is extracted again too.
+        with ProcessPoolExecutor(min(workers, len(files))) as executor:
+            checksums = dict(zip(files, executor.map(_sha256, files)))
+    pending = [file for file in files if extracted.get(os.path.basename(file)) != checksums[file]]
+    for file in sorted(set(files) - set(pending)):
+        logger.info('Skip {}, already extracted'.format(file))
+        if delete:
+            os.remove(file)
+    if not pending:
+        return files
+
+    workers = min(workers, len(pending))
+    logger.info('Extract {} archive(s) with {} process(es)'.format(len(pending), workers))
+    errors = []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {file: executor.submit(_extract_archive, file, path, delete) for file in pending}
+        for file, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error('Failed to extract {}: {}'.format(file, e))
+                errors.append(e)
+                continue
+            # Written after each archive, so a failed job doesn't extract the others again.
+            extracted[os.path.basename(file)] = checksums[file]
+            with open(marker_path + '.tmp', 'w') as f:
+                json.dump(extracted, f)
+            os.replace(marker_path + '.tmp', marker_path)
+    if errors:
+        raise errors[0]
 
     return files
 
 
-def _compress(src, dest_dir):
+def _sha256(file):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _select_files(src, patterns):
+    """Paths relative to src of the files matching glob patterns, or below directories matching them."""
+    if not patterns:
+        patterns = ['**']
+    files = set()
+    for pattern in patterns:
+        matches = glob.glob(os.path.join(src, pattern), recursive=True)
+        if not matches:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), os.path.join(src, pattern))
+        for match in matches:
+            if os.path.isdir(match):
+                for root, _, names in os.walk(match):
+                    files.update(os.path.join(root, name) for name in names)
+            else:
+                files.add(match)
+    return sorted(os.path.relpath(file, src) for file in files)
+
+
+def _compress_command(compression, level):
+    """Command compressing stdin to stdout on all CPUs, None to compress with tarfile instead."""
+    level_args = ['-{}'.format(level)] if level else []
+    if compression == 'gzip':
+        return ['pigz', '-c'] + level_args if shutil.which('pigz') else None
+    if compression == 'zstd':
+        if not shutil.which('zstd'):
+            raise FileNotFoundError(errno.ENOENT, 'zstd is needed to compress', 'zstd')
+        return ['zstd', '-c', '-q', '-T0'] + level_args
+    raise ValueError('Unknown compression: ' + compression)
+
+
+def _compress(src, dest_dir, patterns=None, compression='gzip', level=None):
+    """Package the files of src matching patterns, all of them by default, with a manifest.
+
+    The manifest lists the size and sha256 of each file, and is added to the package as well as written next to it.
+    """
     base_name = os.path.basename(src)
-    compressed_file = os.path.join(dest_dir, f"{base_name}.tar.gz")
-    with tarfile.open(compressed_file, "w:gz") as tar:
-        tar.add(src, arcname=base_name)
+    extension = {'gzip': 'gz', 'zstd': 'zst'}.get(compression, compression)
+    compressed_file = os.path.join(dest_dir, f"{base_name}.tar.{extension}")
+    files = [file for file in _select_files(src, patterns) if file != MANIFEST]
+    manifest = {
+        'files': {
+            file: {'size': os.path.getsize(os.path.join(src, file)), 'sha256': _sha256(os.path.join(src, file))}
+            for file in files
+        },
+    }
+    with open(os.path.join(src, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    shutil.copyfile(os.path.join(src, MANIFEST), os.path.join(dest_dir, f"{base_name}.{MANIFEST}"))
+
+    start = time.time()
+    command = _compress_command(compression, level)
+    with open(compressed_file, 'wb') as f:
+        process = None
+        if command:
+            # tarfile only writes the tar stream, the compressor runs alongside in its own process.
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=f)
+            tar = tarfile.open(fileobj=process.stdin, mode='w|')
+        else:
+            tar = tarfile.open(fileobj=f, mode='w:gz', compresslevel=level or 9)
+        with tar:
+            for file in [MANIFEST] + files:
+                tar.add(os.path.join(src, file), arcname=os.path.join(base_name, file), recursive=False)
+        if process:
+            process.stdin.close()
+            if process.wait():
+                raise Exception('Return Code: {}, CMD: {}'.format(process.returncode, command))
+    logger.info('Packaged {} file(s) into {} ({} bytes) in {:.1f}s'.format(
+        len(files), compressed_file, os.path.getsize(compressed_file), time.time() - start
+    ))
     return compressed_file
 
 
@@ -86,6 +327,59 @@ def _search_converted_output(model_path):
     return find_output[0]
 
 
+def _extract_options():
+    """Keyword arguments of `_extract` from the environment of the job."""
+    return {
+        'workers': int(os.environ.get('EXTRACT_WORKERS', 0)) or None,
+        'delete': bool(int(os.environ.get('EXTRACT_DELETE_ARCHIVES', 0))),
+    }
+
+
+def _package_options():
+    """Keyword arguments of `_compress` from the environment of the job."""
+    patterns = os.environ.get('PACKAGE_FILES', ','.join(RUNTIME_FILES))
+    return {
+        'patterns': [pattern.strip() for pattern in patterns.split(',') if pattern.strip()],
+        'compression': os.environ.get('PACKAGE_COMPRESSION', 'gzip'),
+        'level': int(os.environ.get('PACKAGE_COMPRESSION_LEVEL', 0)) or None,
+    }
+
+
+def _cache_dataset(python_executable, config_path):
+    """Build the dataset caches of a config whose DATASET_CLASS comes from `dataset_cache.cached_dataset_class`."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset_cache.py')
+    cache_cmd = [python_executable, script, config_path]
+    workers = int(os.environ.get('DATASET_CACHE_WORKERS', 0))
+    if workers:
+        cache_cmd += ['--workers', str(workers)]
+    logger.info(cache_cmd)
+    _run(cache_cmd)
+
+
+def _setup_distributed(resource_config_path):
+    """Set the environment of data-parallel training if the job has several hosts.
+
+    Returns:
+        dict: The hosts of the job, see `distributed.read_cluster`.
+        RendezvousServer: Started on the leader host, None on the others and for a single host.
+
+    """
+    cluster = read_cluster(resource_config_path)
+    if cluster['world_size'] == 1:
+        return cluster, None
+    address = os.environ.get('MASTER_ADDR', cluster['leader'])
+    port = int(os.environ.get('MASTER_PORT', DEFAULT_PORT))
+    os.environ.update(worker_env(cluster, address, port))
+    logger.info('Host {current_host} is rank {rank} of {world_size}, leader {leader}'.format(**cluster))
+    if cluster['rank']:
+        # Only the leader writes the checkpoints and model, uploaded from /opt/ml/model.
+        os.environ['OUTPUT_DIR'] = os.environ.get('WORKER_OUTPUT_DIR', '/tmp/blueoil_output')
+        return cluster, None
+    server = RendezvousServer(port)
+    server.start()
+    return cluster, server
+
+
 def _train(python_executable, blueoil_cmd):
     # These are the paths to where SageMaker mounts interesting things in your container.
     prefix = '/opt/ml/'
@@ -93,23 +387,64 @@ def _train(python_executable, blueoil_cmd):
     dataset_path = os.path.join(input_path, 'dataset')
     output_path = os.path.join(prefix, 'output')
     param_path = os.path.join(prefix, 'input/config/hyperparameters.json')
+    resource_config_path = os.environ.get('RESOURCE_CONFIG', os.path.join(prefix, 'input/config/resourceconfig.json'))
 
+    rendezvous_server = None
     try:
+        cluster, rendezvous_server = _setup_distributed(resource_config_path)
         logger.info('#### Extract dataset ####')
-        _extract(dataset_path)
-        logger.info('#### Run training ####')
+        _extract(dataset_path, **_extract_options())
         # Amazon SageMaker makes our specified hyperparameters available within the
         # /opt/ml/input/config/hyperparameters.json.
         # https://docs.aws.amazon.com/sagemaker/latest/dg/your-algorithms-training-algo.html#your-algorithms-training-algo-running-container
         with open(param_path, 'r') as tc:
             training_params = json.load(tc)
+        if 'config' in training_params:
+            logger.info('#### Cache dataset ####')
+            _cache_dataset(python_executable, training_params['config'])
         cmd_args = _hyperparameters_to_cmd_args(training_params)
+        logger.info('#### Run training ####')
         train_cmd = [python_executable, blueoil_cmd, 'train'] + cmd_args
+        if cluster['world_size'] > 1:
+            # Blueoil's training with Horovod initialized over Gloo, see `distributed.main`.
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'distributed.py')
+            train_cmd = [python_executable, script] + train_cmd[1:]
         logger.info(train_cmd)
-        _run(train_cmd)
+        _run(train_cmd, timeline_path=os.path.join(output_path, 'data', 'timeline.jsonl'))
         logger.info('Training is completed.')
     except Exception as e:
         _error_exit(e, output_path)
+    finally:
+        if rendezvous_server is not None:
+            rendezvous_server.stop()
+
+
+def _profile(python_executable, cmd_args):
+    # The layout of a training job, the paths of the configs.
+    prefix = '/opt/ml/'
+    dataset_path = os.path.join(prefix, 'input/data/dataset')
+    output_path = os.path.join(prefix, 'output')
+    param_path = os.path.join(prefix, 'input/config/hyperparameters.json')
+
+    try:
+        logger.info('#### Extract dataset ####')
+        _extract(dataset_path, **_extract_options())
+        if not cmd_args or cmd_args[0].startswith('-'):
+            with open(param_path, 'r') as tc:
+                cmd_args = [json.load(tc)['config']] + cmd_args
+        logger.info('#### Cache dataset ####')
+        _cache_dataset(python_executable, cmd_args[0])
+        logger.info('#### Profile input pipeline ####')
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline_profile.py')
+        profile_cmd = [python_executable, script] + cmd_args
+        if '--output' not in cmd_args:
+            os.makedirs(os.path.join(output_path, 'data'), exist_ok=True)
+            profile_cmd += ['--output', os.path.join(output_path, 'data', 'profile.json')]
+        logger.info(profile_cmd)
+        _run(profile_cmd)
+        logger.info('Profiling is completed.')
+    except Exception as e:
+        _error_exit(e, output_path)
 
 
 def _convert(python_executable, blueoil_cmd, cmd_args):
@@ -124,16 +459,16 @@ def _convert(python_executable, blueoil_cmd, cmd_args):
 
     try:
         logger.info('#### Extract dataset ####')
-        _extract(dataset_path)
+        _extract(dataset_path, **_extract_options())
         logger.info('#### Extract model ####')
-        _extract(model_path)
+        _extract(model_path, **_extract_options())
         logger.info('#### Run convert ####')
         convert_cmd = [python_executable, blueoil_cmd, 'convert'] + cmd_args
         logger.info(convert_cmd)
-        _run(convert_cmd)
+        _run(convert_cmd, timeline_path=os.path.join(output_path, 'timeline.jsonl'))
         logger.info('#### Compress converted model ####')
         counverted_output_path = _search_converted_output(model_path)
-        _compress(counverted_output_path, os.path.join(output_path, "converted"))
+        _compress(counverted_output_path, os.path.join(output_path, "converted"), **_package_options())
         logger.info('Converting is completed.')
     except Exception as e:
         _error_exit(e, output_path)
@@ -160,6 +495,12 @@ def main():
         # Run convert
         cmd_args = sys.argv[2:]
         _convert(python_executable, blueoil_cmd, cmd_args)
+    elif sys.argv[1:] and sys.argv[1] == 'profile':
+        # Profile the input pipeline, e.g. `main.py profile [config] --batch-sizes 16 32`
+        _profile(python_executable, sys.argv[2:])
+    elif os.environ.get('JOB_MODE') == 'profile':
+        # Training job of an estimator given this environment variable
+        _profile(python_executable, [])
     else:
         # Run train
         _train(python_executable, blueoil_cmd)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Input pipeline of a Blueoil config, profiled without the network.
+
+Items of the train subset of `DATASET_CLASS` go through `DATASET.AUGMENTOR` and `DATASET.PRE_PROCESSOR` as in
+training, then are stacked into batches. Reported are:
+
+- the cost of reading an item and of each processor, in one process,
+- images/sec and memory for each number of worker processes and batch size of the sweep, 0 workers being the
+  pipeline without prefetch.
+
+Compare images/sec with `examples_per_sec` of a training job: if the pipeline isn't much faster, it is the bottleneck.
+
+    python pipeline_profile.py [config file] [--workers 0 2 4] [--batch-sizes 16 32] [--output profile.json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Dataset and processors of the config, inherited by the worker processes.
+_pipeline = {}
+
+
+def _processors(sequence):
+    if sequence is None:
+        return []
+    return list(getattr(sequence, 'processors', [sequence]))
+
+
+def _names(processors):
+    names = [type(processor).__name__ for processor in processors]
+    return [name if names.count(name) == 1 else '{}_{}'.format(name, i) for i, name in enumerate(names)]
+
+
+def _load(i):
+    image, label = _pipeline['dataset'][i]
+    return {'image': image, _pipeline['label_key']: label}
+
+
+def _process(i):
+    sample = _load(i)
+    for processor in _pipeline['processors']:
+        sample = processor(**sample)
+    return sample
+
+
+def _batch(samples):
+    return {key: np.stack([sample[key] for sample in samples]) for key in samples[0]}
+
+
+def _peak_rss_mb(pid=None):
+    """Peak resident memory of a process, this one by default."""
+    if pid is None:
+        # KiB on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def profile_processors(indices):
+    """Seconds per item spent reading it and in each processor, in this process."""
+    processors = _pipeline['processors']
+    names = ['read'] + _names(processors)
+    seconds = dict.fromkeys(names, 0.0)
+    for i in indices:
+        start = time.perf_counter()
+        sample = _load(i)
+        seconds['read'] += time.perf_counter() - start
+        for name, processor in zip(names[1:], processors):
+            start = time.perf_counter()
+            sample = processor(**sample)
+            seconds[name] += time.perf_counter() - start
+    return {name: value / len(indices) for name, value in seconds.items()}
+
+
+def profile_throughput(indices, workers, batch_size):
+    """Images/sec and memory of batches made from `indices` by a number of processes.
+
+    One batch is made before timing, so the workers are started and warm.
+    """
+    batches = [indices[i:i + batch_size] for i in range(0, len(indices) - batch_size + 1, batch_size)]
+    warmup, batches = batches[0], batches[1:]
+    result = {'workers': workers, 'batch_size': batch_size}
+    if workers:
+        # Forked, the workers share the dataset already loaded here.
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            _batch(pool.map(_process, warmup))
+            start = time.perf_counter()
+            samples = pool.imap(_process, [i for batch in batches for i in batch], chunksize=max(1, batch_size // 4))
+            for _ in batches:
+                batch = _batch([next(samples) for _ in range(batch_size)])
+            elapsed = time.perf_counter() - start
+            result['workers_peak_rss_mb'] = sum(_peak_rss_mb(child.pid) for child in multiprocessing.active_children())
+    else:
+        _batch([_process(i) for i in warmup])
+        start = time.perf_counter()
+        for indices_of_batch in batches:
+            batch = _batch([_process(i) for i in indices_of_batch])
+        elapsed = time.perf_counter() - start
+        result['workers_peak_rss_mb'] = 0.0
+    result['images_per_sec'] = len(batches) * batch_size / elapsed
+    result['batch_mb'] = sum(value.nbytes for value in batch.values()) / 1024 / 1024
+    result['main_peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+def _int_list(env, default):
+    value = os.environ.get(env)
+    return [int(item) for item in value.split(',')] if value else default
+
+
+def main():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Profile the input pipeline of a Blueoil config.')
+    parser.add_argument('config', help='config file')
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=_int_list('PROFILE_WORKERS', None),
+        help='numbers of worker processes, 0 for none; 0, 1, 2, 4, ... up to the number of CPUs by default',
+    )
+    parser.add_argument(
+        '--batch-sizes', type=int, nargs='+', default=_int_list('PROFILE_BATCH_SIZES', None),
+        help='batch sizes; half, once and twice BATCH_SIZE of the config by default',
+    )
+    parser.add_argument(
+        '--batches', type=int, default=int(os.environ.get('PROFILE_BATCHES', 20)),
+        help='batches timed for each number of workers and batch size',
+    )
+    parser.add_argument('--samples', type=int, default=200, help='items timed through each processor')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the report there as JSON')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from blueoil.common import Tasks
+    from blueoil.utils import config as config_util
+    config = config_util.load(args.config)
+    # Created like Blueoil creates it; a cached dataset resizes with its pre-processor. Processors are run below.
+    dataset_kwargs = {key.lower(): value for key, value in config.DATASET.items()}
+    dataset_kwargs.pop('enable_prefetch', None)
+    dataset = config.DATASET_CLASS(subset='train', **dataset_kwargs)
+    label_keys = {Tasks.OBJECT_DETECTION: 'gt_boxes', Tasks.SEMANTIC_SEGMENTATION: 'mask'}
+    _pipeline.update(
+        dataset=dataset,
+        label_key=label_keys.get(config.TASK, 'label'),
+        processors=_processors(config.DATASET.AUGMENTOR) + _processors(config.DATASET.PRE_PROCESSOR),
+    )
+    workers = args.workers or [0] + [2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus]
+    batch_sizes = args.batch_sizes or sorted({max(1, config.BATCH_SIZE // 2), config.BATCH_SIZE,
+                                              config.BATCH_SIZE * 2})
+    rng = np.random.RandomState(args.seed)
+    logger.info('Profiling {} train item(s) of {} on {} CPU(s)'.format(len(dataset), args.config, cpus))
+
+    processors = profile_processors(rng.randint(0, len(dataset), args.samples))
+    total = sum(processors.values())
+    print('{:<32} {:>10} {:>7}'.format('stage', 'ms/image', 'share'))
+    for name, seconds in processors.items():
+        print('{:<32} {:>10.3f} {:>6.1f}%'.format(name, seconds * 1000, seconds / total * 100))
+    print('{:<32} {:>10.3f} {:>7}'.format('total', total * 1000, ''))
+    print()
+
+    sweep = []
+    print('{:>7} {:>10} {:>10} {:>9} {:>12} {:>14}'.format(
+        'workers', 'batch_size', 'images/sec', 'batch_mb', 'main_rss_mb', 'workers_rss_mb'))
+    for batch_size in batch_sizes:
+        indices = rng.randint(0, len(dataset), (args.batches + 1) * batch_size)
+        for count in workers:
+            result = profile_throughput(indices, count, batch_size)
+            sweep.append(result)
+            print('{workers:>7} {batch_size:>10} {images_per_sec:>10.1f} {batch_mb:>9.2f} {main_peak_rss_mb:>12.1f} '
+                  '{workers_peak_rss_mb:>14.1f}'.format(**result))
+    best = max(sweep, key=lambda result: result['images_per_sec'])
+    print()
+    print('Fastest: {workers} worker(s), batch size {batch_size}, {images_per_sec:.1f} images/sec'.format(**best))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'config': args.config,
+                'cpus': cpus,
+                'items': len(dataset),
+                'processors_sec_per_image': processors,
+                'sweep': sweep,
+                'fastest': best,
+            }, f, indent=2)
+        logger.info('Wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
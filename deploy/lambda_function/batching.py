@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Batching of frames from several cameras into one inference."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import time
+
+import numpy as np
+
+
+class Batch(object):
+    """Frames of several cameras going through inference together.
+
+    Stages add their results as attributes (`data`, `outputs`), like they
+    do on a single `pipeline.Frame`.
+
+    Args:
+        streams (list): Index of the camera of each frame.
+        frames (list): `pipeline.Frame`s, one per camera at most.
+
+    """
+
+    def __init__(self, streams, frames):
+        self.streams = streams
+        self.frames = frames
+
+    def release(self):
+        for frame in self.frames:
+            frame.release()
+
+
+class BatchCollector(object):
+    """Collect the newest frame chosen by each camera's scheduler.
+
+    Args:
+        schedulers (list): `scheduler.InferenceScheduler` of each camera,
+            all created with `ready` set to the same event.
+        ready (threading.Event): Event set by the schedulers.
+        linger (float): Seconds to wait for the other cameras once a frame
+            has arrived, as cameras aren't synchronized.
+
+    """
+
+    def __init__(self, schedulers, ready, linger=0.01):
+        self.schedulers = schedulers
+        self.linger = linger
+        self._ready = ready
+
+    def next_batch(self, timeout=0.5):
+        """Source of the inference pipeline.
+
+        Returns:
+            Batch: Frames of the cameras that had one ready in time, or
+                None if no frame arrived within `timeout`.
+
+        """
+        if not self._ready.wait(timeout):
+            return None
+        deadline = time.time() + self.linger
+        frames = {}
+        while True:
+            # Clear first, so a frame chosen meanwhile sets it again.
+            self._ready.clear()
+            for i, scheduler in enumerate(self.schedulers):
+                if i not in frames:
+                    frame = scheduler.next_frame(timeout=0)
+                    if frame is not None:
+                        frames[i] = frame
+            remaining = deadline - time.time()
+            if len(frames) == len(self.schedulers) or remaining <= 0:
+                break
+            self._ready.wait(remaining)
+        if not frames:
+            return None
+        streams = sorted(frames)
+        return Batch(streams, [frames[i] for i in streams])
+
+
+def model_batch_size(nn):
+    """Return the batch size the model takes, None if it takes any.
+
+    Models exposing no input shape are assumed to take one image at a time.
+    """
+    get_input_shape = getattr(nn, "get_input_shape", None)
+    if get_input_shape is None:
+        return 1
+    batch_size = get_input_shape()[0]
+    return batch_size if batch_size > 0 else None
+
+
+def run_batched(nn, data, batch_size):
+    """Run `nn` on stacked inputs, splitting or padding them as needed.
+
+    If the model takes fewer images than `data` holds, it's run once per
+    chunk, i.e. the cameras are time-multiplexed. A partial chunk is padded
+    with zeros to the model's batch size.
+
+    Args:
+        nn: Loaded `NNLib` or compatible runner.
+        data (np.ndarray): Inputs of shape [num_images, ...].
+        batch_size (int): Batch size of the model, None if it takes any.
+
+    Returns:
+        np.ndarray: Outputs of shape [num_images, ...].
+
+    """
+    if batch_size is None:
+        return nn.run(data)
+    outputs = []
+    for start in range(0, len(data), batch_size):
+        chunk = data[start:start + batch_size]
+        count = len(chunk)
+        if count < batch_size:
+            padding = np.zeros(
+                (batch_size - count, ) + chunk.shape[1:], dtype=chunk.dtype,
+            )
+            chunk = np.concatenate([chunk, padding])
+        outputs.append(nn.run(chunk)[:count])
+    if len(outputs) == 1:
+        return outputs[0]
+    return np.concatenate(outputs)
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Offline benchmark of the inference server pipeline.
+
+Replays a directory of images or a video file through the same
+pre-process / nn.run / post-process / render / encode stages as the
+motion JPEG server, without camera, FPGA or browser, and prints latency
+percentiles of every stage and the sustained FPS as JSON. The processors
+are built like the server builds them, fused unless `--no-fused`, and the
+frames of `--cameras` cameras are inferred as one batch.
+
+Usage:
+    python benchmark_server.py \\
+        --config /path/to/output/models/meta.yaml \\
+        --images /path/to/images --stub-latency 40 --frames 300
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from batching import Batch, model_batch_size, run_batched
+from encoder import JpegEncoder
+from pipeline import Frame, Pipeline
+from processors import build_processors, pre_process_images
+from visualize import FrameRenderer
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp"}
+PERCENTILES = (50, 95, 99)
+
+
+class StubNNLib(object):
+    """Stand-in for `lmnet.nnlib.NNLib` returning random outputs.
+
+    Args:
+        output_shape (tuple): Shape of the array returned by `run`.
+        latency (float): Seconds `run` takes, spent sleeping like an
+            accelerator would, so other threads keep running.
+        input_shape (tuple): Shape of the input the model takes, whose
+            first dimension is its batch size.
+
+    """
+
+    def __init__(self, output_shape, latency=0.0, input_shape=None):
+        self.output_shape = tuple(output_shape)
+        self.latency = latency
+        self.input_shape = input_shape
+        self._rng = np.random.RandomState(0)
+
+    def get_input_shape(self):
+        return self.input_shape
+
+    def load(self, model):
+        pass
+
+    def init(self):
+        pass
+
+    def run(self, data):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        shape = (len(data), ) + self.output_shape[1:]
+        return self._rng.standard_normal(shape).astype(np.float32)
+
+
+def _default_output_shape(config):
+    """Guess the network output shape from meta.yaml."""
+    height, width = config.IMAGE_SIZE
+    num_classes = len(config.CLASSES)
+    if config.TASK == "IMAGE.CLASSIFICATION":
+        return 1, num_classes
+    if config.TASK == "IMAGE.SEMANTIC_SEGMENTATION":
+        return 1, height, width, num_classes
+    for processor in config.POST_PROCESSOR or []:
+        if "FormatYoloV2" in processor:
+            anchors = processor["FormatYoloV2"]["anchors"]
+            return (
+                1, height // 32, width // 32,
+                len(anchors) * (num_classes + 5),
+            )
+    raise ValueError(
+        "Can't guess the output shape, please set --stub-output-shape"
+    )
+
+
+def _read_images(path):
+    files = sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+    )
+    if not files:
+        raise ValueError("No images found in " + path)
+    for file in files:
+        yield cv2.cvtColor(cv2.imread(file), cv2.COLOR_BGR2RGB)
+
+
+def _read_video(path):
+    vc = cv2.VideoCapture(path)
+    while True:
+        ok, frame = vc.read()
+        if not ok:
+            break
+        yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    vc.release()
+
+
+def _load_frames(args, camera_size):
+    frames = []
+    source = _read_images(args.images) if args.images \
+        else _read_video(args.video)
+    height, width = camera_size
+    for image in source:
+        image = cv2.resize(image, (width, height))
+        frames.append(image)
+        if len(frames) >= args.frames:
+            break
+    if not frames:
+        raise ValueError("No frames could be read")
+    return frames
+
+
+class _Stages(object):
+    """The stages of the server's pipeline, built from meta.yaml.
+
+    They pass a `batching.Batch` of one frame per camera along.
+    """
+
+    def __init__(self, config, nn, pre_process, post_process, encoder):
+        self.config = config
+        self.nn = nn
+        self.batch_size = model_batch_size(nn)
+        self.pre_process = pre_process
+        self.post_process = post_process
+        self.encoder = encoder
+        self.renderer = FrameRenderer(config)
+        self.state = 0
+        self.start_time = None
+
+    def pre(self, batch):
+        batch.data = pre_process_images(
+            self.pre_process, [frame.image for frame in batch.frames],
+        )
+        return batch
+
+    def nn_run(self, batch):
+        batch.outputs = run_batched(self.nn, batch.data, self.batch_size)
+        return batch
+
+    def post(self, batch):
+        outputs = self.post_process(outputs=batch.outputs)['outputs']
+        for frame, result in zip(batch.frames, outputs):
+            frame.result = result
+        return batch
+
+    def draw(self, batch):
+        for frame in batch.frames:
+            frame.drawn = self._draw(frame)
+        return batch
+
+    def _draw(self, frame):
+        config = self.config
+        if config.TASK == "IMAGE.OBJECT_DETECTION":
+            image, self.state, self.start_time, _ = \
+                self.renderer.render_object_detection(
+                    frame.image.copy(), frame.result,
+                    self.state, self.start_time, 1.0,
+                )
+        elif config.TASK == "IMAGE.CLASSIFICATION":
+            from blueoil.visualize import visualize_classification
+            image = np.array(
+                visualize_classification(frame.image, frame.result, config)
+            )
+        else:
+            from blueoil.visualize import visualize_semantic_segmentation
+            image = np.array(visualize_semantic_segmentation(
+                frame.image, frame.result, config
+            ))
+        self.renderer.draw_stats(image, 0.0, [], self.encoder.frame_bytes)
+        return image
+
+    def encode(self, batch):
+        for frame in batch.frames:
+            frame.jpeg = self.encoder.encode(frame.drawn)
+        return batch
+
+    def as_list(self):
+        return [
+            ("pre", self.pre),
+            ("nn", self.nn_run),
+            ("post", self.post),
+            ("draw", self.draw),
+            ("encode", self.encode),
+        ]
+
+
+def _summarize(seconds):
+    milliseconds = np.array(seconds) * 1000
+    summary = OrderedDict([("mean_ms", float(np.mean(milliseconds)))])
+    for q in PERCENTILES:
+        summary["p{}_ms".format(q)] = float(np.percentile(milliseconds, q))
+    return summary
+
+
+def _batch(frames, index, cameras):
+    """Next frame of each camera, replaying `frames` from its own offset."""
+    return Batch(list(range(cameras)), [
+        Frame(index, frames[(index + camera) % len(frames)].copy())
+        for camera in range(cameras)
+    ])
+
+
+def run_sequential(stages, frames, count, warmup, cameras=1):
+    """Run `count` batches through all stages in turn, timing every stage.
+
+    `frames` are replayed in a loop when there are fewer than `count`.
+
+    Returns:
+        tuple: Seconds each stage took for each batch, and the frames per
+            second of all cameras together.
+
+    """
+    timings = OrderedDict((name, []) for name, _ in stages.as_list())
+    start = None
+    for i in range(count):
+        if i == warmup:
+            start = time.time()
+        batch = _batch(frames, i, cameras)
+        for name, func in stages.as_list():
+            stage_start = time.time()
+            batch = func(batch)
+            if i >= warmup:
+                timings[name].append(time.time() - stage_start)
+    elapsed = time.time() - start
+    return timings, (count - warmup) * cameras / elapsed
+
+
+def run_pipelined(stages, frames, duration, camera_fps, cameras=1):
+    """Run the threaded pipeline fed like cameras for `duration` seconds.
+
+    Returns:
+        tuple: Frames per second of all cameras leaving the last stage, and
+            the number of batches dropped by the queues between the stages.
+
+    """
+    state = {"index": 0, "next": time.time()}
+    finished = []
+
+    def capture():
+        # Deliver frames at the camera frame rate, like `vc.read()`.
+        delay = state["next"] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        state["next"] = max(state["next"], time.time()) + 1.0 / camera_fps
+        index = state["index"]
+        state["index"] += 1
+        return _batch(frames, index, cameras)
+
+    def encode(batch):
+        batch = stages.encode(batch)
+        finished.append(time.time())
+        return batch
+
+    stage_list = stages.as_list()[:-1] + [("encode", encode)]
+    pipeline = Pipeline([("capture", capture)] + stage_list)
+    pipeline.start()
+    time.sleep(duration)
+    pipeline.stop()
+
+    dropped = sum(queue.dropped for queue in pipeline.queues)
+    # Skip the first second, while the stages warm up.
+    measured = [t for t in finished if t - finished[0] >= 1.0] \
+        if finished else []
+    if len(measured) < 2:
+        return 0.0, dropped
+    fps = (len(measured) - 1) * cameras / (measured[-1] - measured[0])
+    return fps, dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--config", required=True, help="path to meta.yaml")
+    parser.add_argument(
+        "--python-dir",
+        help="blueoil output python directory, "
+             "default: <meta.yaml dir>/../python",
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images", help="directory of images to replay")
+    source.add_argument("--video", help="video file to replay")
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument(
+        "--camera-size", nargs="+", default=["320", "240"],
+        metavar="WIDTH HEIGHT",
+        help="resize frames like the camera delivers, or \"model\" for the "
+             "image size of the model, whose resize pre-processing is then "
+             "skipped like the server does",
+    )
+    parser.add_argument(
+        "--cameras", type=int, default=1,
+        help="cameras whose frames are inferred as one batch",
+    )
+    parser.add_argument(
+        "--no-fused", action="store_true",
+        help="run the pre- and post-processors through Blueoil one by one "
+             "instead of the fused routines",
+    )
+    parser.add_argument(
+        "--model", help="model .so file, the NNLib stub is used if omitted"
+    )
+    parser.add_argument(
+        "--stub-latency", type=float, default=0.0,
+        help="milliseconds the NNLib stub takes for one run",
+    )
+    parser.add_argument(
+        "--stub-output-shape", type=int, nargs="+",
+        help="output shape of the NNLib stub, guessed from meta.yaml",
+    )
+    parser.add_argument(
+        "--stub-batch-size", type=int, default=1,
+        help="batch size the NNLib stub takes, 0 for any",
+    )
+    parser.add_argument("--jpeg-quality", type=int, default=85)
+    parser.add_argument("--jpeg-subsampling", type=int, default=2)
+    parser.add_argument("--jpeg-backend", default="pillow")
+    parser.add_argument(
+        "--duration", type=float, default=10.0,
+        help="seconds to run the threaded pipeline, 0 to skip it",
+    )
+    parser.add_argument(
+        "--camera-fps", type=float, default=60.0,
+        help="frame rate the threaded pipeline is fed with",
+    )
+    parser.add_argument("--output", help="also write the JSON report here")
+    args = parser.parse_args()
+
+    python_dir = args.python_dir or os.path.join(
+        os.path.dirname(os.path.abspath(args.config)), "..", "python"
+    )
+    sys.path.append(python_dir)
+    from config import load_yaml
+
+    config = load_yaml(args.config)
+    if args.camera_size == ["model"]:
+        camera_size = list(config.IMAGE_SIZE)
+    else:
+        try:
+            width, height = (int(size) for size in args.camera_size)
+        except ValueError:
+            parser.error("--camera-size takes WIDTH HEIGHT or model")
+        camera_size = [height, width]
+    pre_process, post_process = build_processors(
+        config, camera_size, fused_pre_process=not args.no_fused,
+        fused_post_process=not args.no_fused,
+    )
+
+    if args.model:
+        from lmnet.nnlib import NNLib
+        nn = NNLib()
+        nn.load(args.model)
+        nn.init()
+    else:
+        output_shape = args.stub_output_shape or _default_output_shape(config)
+        height, width = config.IMAGE_SIZE
+        nn = StubNNLib(
+            output_shape, args.stub_latency / 1000.0,
+            input_shape=(args.stub_batch_size, height, width, 3),
+        )
+
+    encoder = JpegEncoder(
+        quality=args.jpeg_quality, subsampling=args.jpeg_subsampling,
+        backend=args.jpeg_backend,
+    )
+    stages = _Stages(config, nn, pre_process, post_process, encoder)
+
+    frames = _load_frames(args, camera_size)
+    warmup = min(args.warmup, args.frames // 2)
+    logger.info("Replay {} frames of {} camera(s) from {} images".format(
+        args.frames, args.cameras, len(frames)
+    ))
+
+    timings, fps = run_sequential(
+        stages, frames, args.frames, warmup, cameras=args.cameras,
+    )
+    report = OrderedDict([
+        ("task", config.TASK),
+        ("frames", args.frames),
+        ("warmup", warmup),
+        ("nn", "NNLib" if args.model else "stub"),
+        ("fused", not args.no_fused),
+        ("cameras", args.cameras),
+        ("camera_size", camera_size),
+        ("model_batch_size", stages.batch_size),
+        ("sequential_fps", fps),
+        ("stages", OrderedDict(
+            (name, _summarize(seconds)) for name, seconds in timings.items()
+        )),
+        ("jpeg_bytes", encoder.frame_bytes),
+    ])
+    if args.duration > 0:
+        pipelined_fps, dropped = run_pipelined(
+            stages, frames, args.duration, args.camera_fps,
+            cameras=args.cameras,
+        )
+        report["pipelined_fps"] = pipelined_fps
+        report["pipelined_dropped"] = dropped
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Box grouping and state evaluation: per-box Python loop vs NumPy.
+
+The loop implementation below is the one visualize.py used before the
+NumPy version; results of both are compared for equality before timing.
+They agree on the float32 boxes models output. On python2, str() rounds
+floats to 12 digits, so the loop also merged float64 boxes agreeing to
+12 digits, which the NumPy version keeps apart; that change is checked too.
+
+Usage:
+    python benchmarks/benchmark_box_grouping.py [--boxes 300] [--runs 200]
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import visualize  # noqa: E402
+
+
+def _decide_class(preds, tuning_threshold=0.0):
+    class_id = 0
+    score = 0.0
+    for pred in preds:
+        current_score = pred[1]
+        if current_score - tuning_threshold >= score:
+            class_id = int(pred[0])
+            score = current_score
+    return class_id, score
+
+
+def _gather_prediction(predict_boxes):
+    box_preds_list = []
+    indices = {}
+    for predict_box in predict_boxes:
+        box = predict_box[:4].tolist()
+        pred = predict_box[4:]
+        key = "{}-{}-{}-{}".format(*box)
+        if key in indices:
+            box_preds_list[indices[key]]["preds"].append(pred)
+        else:
+            indices[key] = len(box_preds_list)
+            box_preds_list.append({
+                "box": box,
+                "preds": [pred],
+            })
+
+    uniq_boxes = []
+    for box_preds in box_preds_list:
+        class_id, score = _decide_class(box_preds["preds"])
+        uniq_boxes.append({
+            "box": box_preds["box"],
+            "class_id": class_id,
+            "score": score,
+        })
+    return uniq_boxes
+
+
+def _get_state(box, center_width):
+    mid = box["box"][0] + (box["box"][2] / 2)
+    return (mid < center_width), box["class_id"]
+
+
+def _get_total_state(states, ng_class_id):
+    box_in_restricted_area = False
+    for state, class_id in states:
+        if not state:
+            if class_id == ng_class_id:
+                return visualize.STATE_WARNING
+            box_in_restricted_area = True
+    if box_in_restricted_area:
+        return visualize.STATE_CLEAR
+    return visualize.STATE_NORMAL
+
+
+def loop_evaluate(predict_boxes, center_width, ng_class_id):
+    uniq_boxes = _gather_prediction(predict_boxes)
+    states = [_get_state(box, center_width) for box in uniq_boxes]
+    return uniq_boxes, states, _get_total_state(states, ng_class_id)
+
+
+def numpy_evaluate(predict_boxes, center_width, ng_class_id):
+    boxes, class_ids, scores = visualize._gather_prediction_arrays(
+        predict_boxes
+    )
+    states = visualize._get_states(boxes, center_width)
+    total_state = visualize._get_total_state(states, class_ids, ng_class_id)
+    uniq_boxes = visualize._to_uniq_boxes(boxes, class_ids, scores)
+    return uniq_boxes, list(zip(states.tolist(), class_ids.tolist())), \
+        total_state
+
+
+def make_boxes(num_boxes, num_classes, rng):
+    """NMS-like output: the same box reported for several classes."""
+    num_uniq = max(1, num_boxes // num_classes)
+    uniq = np.zeros((num_uniq, 4), dtype=np.float32)
+    uniq[:, :2] = rng.uniform(0, 280, (num_uniq, 2))
+    uniq[:, 2:] = rng.uniform(5, 60, (num_uniq, 2))
+    rows = rng.randint(0, num_uniq, num_boxes)
+    predict_boxes = np.zeros((num_boxes, 6), dtype=np.float32)
+    predict_boxes[:, :4] = uniq[rows]
+    predict_boxes[:, 4] = rng.randint(0, num_classes, num_boxes)
+    # Coarse scores so that ties happen, a few negative ones as edge cases.
+    predict_boxes[:, 5] = rng.randint(-1, 20, num_boxes) / 20.0
+    return predict_boxes
+
+
+def _same(expected, actual):
+    if expected[2] != actual[2] or expected[1] != actual[1]:
+        return False
+    for a, b in zip(expected[0], actual[0]):
+        if a["box"] != b["box"] or a["class_id"] != b["class_id"] \
+                or float(a["score"]) != float(b["score"]):
+            return False
+    return len(expected[0]) == len(actual[0])
+
+
+def check_precision_change():
+    """Boxes differing beyond 12 digits are merged only by the loop, on py2."""
+    predict_boxes = np.array([
+        [10.0, 20.0, 30.0, 40.0, 1, 0.5],
+        [10.0 + 1e-11, 20.0, 30.0, 40.0, 2, 0.9],
+    ])
+    merged = len(loop_evaluate(predict_boxes, 160, 0)[0])
+    kept = len(numpy_evaluate(predict_boxes, 160, 0)[0])
+    if merged != (1 if sys.version_info[0] == 2 else 2) or kept != 2:
+        raise AssertionError("Unexpected grouping of close boxes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--boxes", type=int, default=300)
+    parser.add_argument("--classes", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    center_width, ng_class_id = 160, 0
+    for _ in range(100):
+        predict_boxes = make_boxes(
+            rng.randint(0, args.boxes + 1), args.classes, rng
+        )
+        expected = loop_evaluate(predict_boxes, center_width, ng_class_id)
+        actual = numpy_evaluate(predict_boxes, center_width, ng_class_id)
+        if not _same(expected, actual):
+            raise AssertionError("Results differ")
+    print("results identical on 100 random inputs")
+    check_precision_change()
+
+    predict_boxes = make_boxes(args.boxes, args.classes, rng)
+    for name, func in [("loop", loop_evaluate), ("numpy", numpy_evaluate)]:
+        seconds = timeit.timeit(
+            lambda: func(predict_boxes, center_width, ng_class_id),
+            number=args.runs,
+        ) / args.runs
+        print("{:<6s} {:4d} boxes {:8.3f} ms".format(
+            name, args.boxes, seconds * 1000
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Post-processing: Blueoil's generic YOLOv2 chain vs the fused fast path.
+
+The generic functions below follow `blueoil.post_processor`, which
+`build_post_process` chains for `FormatYoloV2`, `ExcludeLowScoreBox` and
+`NMS` in `openimages_face_sample.py`. Outputs of both paths are compared
+before timing.
+
+Usage:
+    python benchmarks/benchmark_post_process.py [--size 224 224] [--runs 200]
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from fused_post_process import compile_post_process  # noqa: E402
+
+TOLERANCE = 1e-3
+
+ANCHORS = [
+    [1.3221, 1.73145], [3.19275, 4.00944], [5.05587, 8.09892],
+    [9.47112, 4.84053], [11.2364, 10.0071],
+]
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _softmax(x):
+    exp = np.exp(x - np.max(x))
+    return exp / np.expand_dims(exp.sum(axis=-1), -1)
+
+
+def format_yolo_v2(outputs, image_size, num_classes, anchors):
+    batch_size = len(outputs)
+    num_cell_y, num_cell_x = image_size[0] // 32, image_size[1] // 32
+    boxes_per_cell = len(anchors)
+    outputs = np.reshape(outputs, [
+        batch_size, num_cell_y, num_cell_x, boxes_per_cell, num_classes + 5
+    ])
+    predict_classes, predict_confidence, predict_boxes = np.split(
+        outputs, [num_classes, num_classes + 1], axis=4
+    )
+    predict_classes = _softmax(predict_classes)
+    predict_confidence = _sigmoid(predict_confidence)
+
+    offset_y = np.broadcast_to(
+        np.reshape(np.arange(num_cell_y), (1, num_cell_y, 1, 1)),
+        [1, num_cell_y, num_cell_x, boxes_per_cell],
+    )
+    offset_x = np.broadcast_to(
+        np.reshape(np.arange(num_cell_x), (1, 1, num_cell_x, 1)),
+        [1, num_cell_y, num_cell_x, boxes_per_cell],
+    )
+    offset_w = np.broadcast_to([w for w, _ in anchors], offset_x.shape)
+    offset_h = np.broadcast_to([h for _, h in anchors], offset_x.shape)
+    center_x = (_sigmoid(predict_boxes[..., 0]) + offset_x) / num_cell_x
+    center_y = (_sigmoid(predict_boxes[..., 1]) + offset_y) / num_cell_y
+    w = np.exp(predict_boxes[..., 2]) * offset_w / num_cell_x
+    h = np.exp(predict_boxes[..., 3]) * offset_h / num_cell_y
+    center_x, w = center_x * image_size[1], w * image_size[1]
+    center_y, h = center_y * image_size[0], h * image_size[0]
+    predict_boxes = np.stack(
+        [center_x - w / 2, center_y - h / 2, w, h], axis=4
+    )
+
+    num_boxes = num_cell_y * num_cell_x * boxes_per_cell
+    results = []
+    for i in range(batch_size):
+        result = []
+        for class_id in range(num_classes):
+            predict_prob = predict_classes[i, ..., class_id] \
+                * predict_confidence[i, ..., 0]
+            predict_prob = np.reshape(predict_prob, [num_boxes, 1])
+            predict_box = np.reshape(predict_boxes[i], [num_boxes, 4])
+            predict_class_id = np.full(predict_prob.shape, class_id)
+            result.append(np.concatenate(
+                [predict_box, predict_class_id, predict_prob], 1
+            ))
+        results.append(np.concatenate(result, 0))
+    return results
+
+
+def exclude_low_score_box(outputs, threshold):
+    return [boxes[boxes[:, 5] > threshold] for boxes in outputs]
+
+
+def _iou(box, boxes):
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[0] + box[2], boxes[:, 0] + boxes[:, 2])
+    y2 = np.minimum(box[1] + box[3], boxes[:, 1] + boxes[:, 3])
+    intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    union = box[2] * box[3] + boxes[:, 2] * boxes[:, 3] - intersection
+    return intersection / union
+
+
+def _nms(boxes, iou_threshold, max_output_size):
+    boxes = boxes[np.argsort(-boxes[:, 5], kind="mergesort")]
+    keep = []
+    while len(boxes) and len(keep) < max_output_size:
+        keep.append(boxes[0])
+        boxes = boxes[1:][_iou(boxes[0], boxes[1:]) <= iou_threshold]
+    return np.array(keep).reshape(-1, 6)
+
+
+def nms(outputs, num_classes, iou_threshold, max_output_size):
+    return [
+        np.concatenate([
+            _nms(boxes[boxes[:, 4] == class_id], iou_threshold,
+                 max_output_size)
+            for class_id in range(num_classes)
+        ])
+        for boxes in outputs
+    ]
+
+
+def generic_post_process(image_size, num_classes, threshold):
+    def post_process(outputs):
+        outputs = format_yolo_v2(outputs, image_size, num_classes, ANCHORS)
+        outputs = exclude_low_score_box(outputs, threshold)
+        return nms(outputs, num_classes, 0.5, 100)
+    return post_process
+
+
+def random_outputs(rng, shape, num_classes, objects):
+    """Raw outputs with mostly empty cells and a few confident ones."""
+    outputs = rng.standard_normal(shape).astype(np.float32)
+    outputs = outputs.reshape(shape[:3] + (len(ANCHORS), num_classes + 5))
+    outputs[..., num_classes] -= 4.0
+    cells = rng.randint(0, outputs[0, ..., 0].size, objects)
+    confidence = outputs[0, ..., num_classes].reshape(-1)
+    confidence[cells] = rng.uniform(0.0, 6.0, objects)
+    return outputs.reshape(shape)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--size", type=int, nargs=2, default=[224, 224],
+        metavar=("HEIGHT", "WIDTH"), help="IMAGE_SIZE of the model",
+    )
+    parser.add_argument("--classes", type=int, default=1)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--objects", type=int, default=5)
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    classes = ["class_{}".format(i) for i in range(args.classes)]
+    generic = generic_post_process(args.size, args.classes, args.threshold)
+    fused = compile_post_process([
+        {"FormatYoloV2": {
+            "image_size": args.size, "classes": classes,
+            "anchors": ANCHORS, "data_format": "NHWC",
+        }},
+        {"ExcludeLowScoreBox": {"threshold": args.threshold}},
+        {"NMS": {
+            "classes": classes, "iou_threshold": 0.5,
+            "max_output_size": 100, "per_class": True,
+        }},
+    ])
+    shape = (
+        1, args.size[0] // 32, args.size[1] // 32,
+        len(ANCHORS) * (args.classes + 5),
+    )
+
+    rng = np.random.RandomState(0)
+    num_boxes = 0
+    for _ in range(20):
+        outputs = random_outputs(rng, shape, args.classes, args.objects)
+        expected = generic(outputs)[0]
+        actual = fused(outputs=outputs)["outputs"][0]
+        if expected.shape != actual.shape or len(actual) and \
+                np.abs(expected - actual).max() > TOLERANCE:
+            raise AssertionError(
+                "Boxes differ:\n{}\n{}".format(expected, actual)
+            )
+        num_boxes += len(actual)
+    print("Same {} boxes on 20 random outputs".format(num_boxes))
+
+    outputs = random_outputs(rng, shape, args.classes, args.objects)
+    for name, func in [
+        ("generic", lambda: generic(outputs)),
+        ("fused", lambda: fused(outputs=outputs)),
+    ]:
+        seconds = timeit.timeit(func, number=args.runs) / args.runs
+        print("  {:<8s} {}x{} {} classes {:8.3f} ms".format(
+            name, args.size[1], args.size[0], args.classes, seconds * 1000,
+        ))
+
+
+if __name__ == "__main__":
+    main()
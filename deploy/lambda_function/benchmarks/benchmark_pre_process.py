@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Pre-processing: Blueoil's generic chain vs the fused fast path.
+
+The generic functions below are those of `blueoil.pre_processor`, which
+`build_pre_process` chains for `Resize` and `PerImageStandardization` or
+`DivideBy255`. Outputs of both paths are compared before timing.
+
+Usage:
+    python benchmarks/benchmark_pre_process.py [--size 224 224] [--runs 200]
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import argparse
+import math
+import os
+import sys
+import timeit
+
+import numpy as np
+import PIL.Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from fused_pre_process import compile_pre_process  # noqa: E402
+
+TOLERANCE = 1e-4
+
+
+def resize(image, size, resample="NEAREST"):
+    width = size[1]
+    height = size[0]
+    image = PIL.Image.fromarray(np.uint8(image))
+    methods = {
+        "NEAREST": PIL.Image.NEAREST,
+        "LINEAR": PIL.Image.BILINEAR,
+        "BICUBIC": PIL.Image.BICUBIC,
+    }
+    return np.array(image.resize([width, height], methods[resample]))
+
+
+def per_image_standardization(image):
+    image = image.astype(np.float32)
+    mean = image.mean()
+    stddev = np.std(image)
+    adjusted_stddev = max(stddev, 1.0 / math.sqrt(image.size))
+    image -= mean
+    image = image / adjusted_stddev
+    return image
+
+
+def divide_by_255(image):
+    return image / 255.0
+
+
+def generic_pre_process(size, normalize):
+    normalizers = {
+        "PerImageStandardization": per_image_standardization,
+        "DivideBy255": divide_by_255,
+    }
+
+    def pre_process(image):
+        return normalizers[normalize](resize(image, size))
+    return pre_process
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--camera-size", type=int, nargs=2, default=[240, 320],
+        metavar=("HEIGHT", "WIDTH"),
+    )
+    parser.add_argument(
+        "--size", type=int, nargs=2, default=[224, 224],
+        metavar=("HEIGHT", "WIDTH"), help="IMAGE_SIZE of the model",
+    )
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    shape = tuple(args.camera_size) + (3, )
+    for normalize in ["PerImageStandardization", "DivideBy255"]:
+        generic = generic_pre_process(args.size, normalize)
+        fused = compile_pre_process([
+            {"Resize": {"size": args.size, "resample": "NEAREST"}},
+            {normalize: None},
+        ])
+        out = np.empty(fused.output_shape(shape), dtype=fused.dtype)
+
+        error = 0.0
+        for _ in range(20):
+            image = rng.randint(0, 256, shape).astype(np.uint8)
+            expected = generic(image)
+            actual = fused(image=image, out=out)["image"]
+            error = max(error, float(np.abs(expected - actual).max()))
+        if error > TOLERANCE:
+            raise AssertionError(
+                "{} differs by {}".format(normalize, error)
+            )
+        print("{}: max abs difference {:.2e} on 20 random images".format(
+            normalize, error
+        ))
+
+        image = rng.randint(0, 256, shape).astype(np.uint8)
+        for name, func in [
+            ("generic", lambda: generic(image)),
+            ("fused", lambda: fused(image=image, out=out)),
+        ]:
+            seconds = timeit.timeit(func, number=args.runs) / args.runs
+            print("  {:<8s} {}x{} -> {}x{} {:8.3f} ms".format(
+                name, shape[1], shape[0], args.size[1], args.size[0],
+                seconds * 1000,
+            ))
+
+
+if __name__ == "__main__":
+    main()
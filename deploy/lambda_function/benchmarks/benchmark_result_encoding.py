@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Published results: `JsonOutput` JSON vs the compact encodings.
+
+`json_output` below follows the object detection document of
+`blueoil.utils.predict_output.output.JsonOutput`. Each compact record is
+decoded and compared with the boxes before timing. Sizes are those of the
+Kinesis Firehose message the publisher sends for one result.
+
+Usage:
+    python benchmarks/benchmark_result_encoding.py [--boxes 5] [--runs 500]
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import argparse
+from datetime import datetime
+from functools import partial
+import json
+import os
+import sys
+import time
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from encoder import Thumbnailer  # noqa: E402
+import result_format  # noqa: E402
+from result_format import CompactResultEncoder, decode_result  # noqa: E402
+
+# float16 keeps 11 significant bits: half a pixel up to 1024 pixels.
+BOX_TOLERANCE = 0.5
+SCORE_TOLERANCE = 1e-3
+
+
+class Config(object):
+    TASK = "IMAGE.OBJECT_DETECTION"
+
+    def __init__(self, classes, image_size):
+        self.CLASSES = classes
+        self.IMAGE_SIZE = image_size
+
+
+def json_output(config, result, image):
+    height_scale = image.shape[0] / config.IMAGE_SIZE[0]
+    width_scale = image.shape[1] / config.IMAGE_SIZE[1]
+    predictions = []
+    for x, y, w, h, class_id, score in result:
+        predictions.append({
+            "class": {
+                "id": int(class_id),
+                "name": config.CLASSES[int(class_id)],
+            },
+            "box": [
+                float(x * width_scale), float(y * height_scale),
+                float(w * width_scale), float(h * height_scale),
+            ],
+            "score": str(score),
+        })
+    output = {
+        "benchmark": {},
+        "classes": [
+            {"id": i, "name": name} for i, name in enumerate(config.CLASSES)
+        ],
+        "date": datetime.now().isoformat(),
+        "results": [{"file_path": None, "prediction": predictions}],
+        "task": config.TASK,
+        "version": "0.20.0",
+    }
+    return json.dumps(output, indent=4, sort_keys=True)
+
+
+def kinesis_message(result):
+    # What `ResultPublisher` sends for a single result.
+    return json.dumps({
+        "request": {"data": result},
+        "id": datetime.now().strftime("%Y%m%d%H%M%S"),
+    })
+
+
+def check(record, result, image, config):
+    predictions = decode_result(record)["results"][0]["prediction"]
+    scale = np.array([
+        image.shape[1] / config.IMAGE_SIZE[1],
+        image.shape[0] / config.IMAGE_SIZE[0],
+    ] * 2)
+    if len(predictions) != len(result):
+        raise AssertionError("Decoded {} boxes instead of {}".format(
+            len(predictions), len(result)
+        ))
+    for prediction, expected in zip(predictions, result):
+        box_error = np.abs(
+            np.array(prediction["box"]) - expected[:4] * scale
+        ).max()
+        if prediction["class"]["id"] != int(expected[4]) \
+                or box_error > BOX_TOLERANCE \
+                or abs(prediction["score"] - expected[5]) > SCORE_TOLERANCE:
+            raise AssertionError("Decoded {} instead of {}".format(
+                prediction, expected
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--boxes", type=int, default=5)
+    parser.add_argument("--classes", type=int, default=1)
+    parser.add_argument(
+        "--image-size", type=int, nargs=2, default=[240, 320],
+        metavar=("HEIGHT", "WIDTH"), help="size of the camera image",
+    )
+    parser.add_argument("--thumbnail-width", type=int, default=80)
+    parser.add_argument("--runs", type=int, default=500)
+    args = parser.parse_args()
+
+    config = Config(
+        ["class_{}".format(i) for i in range(args.classes)], [224, 224]
+    )
+    rng = np.random.RandomState(0)
+    image = rng.randint(
+        0, 256, tuple(args.image_size) + (3, )
+    ).astype(np.uint8)
+    result = np.zeros((args.boxes, 6), dtype=np.float32)
+    result[:, :4] = rng.uniform(0, 200, (args.boxes, 4))
+    result[:, 4] = rng.randint(0, args.classes, args.boxes)
+    result[:, 5] = rng.uniform(0.5, 1.0, args.boxes)
+
+    encodings = [("json", lambda: json_output(config, result, image))]
+    framings = [result_format.FRAMING_BINARY]
+    if result_format.msgpack is not None:
+        framings.append(result_format.FRAMING_MSGPACK)
+    if result_format.cbor2 is not None:
+        framings.append(result_format.FRAMING_CBOR)
+    for framing in framings:
+        for thumbnail in (None, Thumbnailer(args.thumbnail_width)):
+            encoder = CompactResultEncoder(framing, thumbnail=thumbnail)
+            record = encoder.encode(config, result, image, time.time())
+            check(record, result, image, config)
+            name = framing + (" + thumbnail" if thumbnail else "")
+            encodings.append((name, partial(
+                encoder.encode, config, result, image, time.time()
+            )))
+
+    print("{:<20} {:>8} {:>10}".format("encoding", "bytes", "ms/result"))
+    for name, encode in encodings:
+        size = len(kinesis_message(encode()))
+        seconds = timeit.timeit(
+            lambda: kinesis_message(encode()), number=args.runs
+        ) / args.runs
+        print("{:<20} {:>8} {:>10.3f}".format(name, size, seconds * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Store and forward of results through a broker failing intermittently.
+
+Results are submitted to a `ResultPublisher` backed by a `ResultStore`,
+while the fake client below fails a share of its publish calls and goes
+through a full outage. Halfway, the publisher is stopped and a new one is
+started on the same database, like after a restart of the Lambda
+function. Every result must be delivered at least once.
+
+Usage:
+    python benchmarks/benchmark_store_and_forward.py [--results 500]
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from publisher import KINESIS_BATCH_TOPIC, KINESIS_TOPIC  # noqa: E402
+from publisher import ResultPublisher  # noqa: E402
+from result_store import ResultStore  # noqa: E402
+
+
+class FlakyClient(object):
+    """Greengrass client failing randomly and during an outage.
+
+    Args:
+        failure_rate (float): Probability of a publish call to fail.
+        outage (tuple): (start, end) seconds from creation during which
+            every publish call fails.
+        seed (int): Seed of the failures.
+
+    """
+
+    def __init__(self, failure_rate, outage, seed=0):
+        self.failure_rate = failure_rate
+        self.outage = outage
+        self.calls = 0
+        self.failures = 0
+        self.delivered = []
+        self._random = random.Random(seed)
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload):
+        with self._lock:
+            self.calls += 1
+            elapsed = time.time() - self._start
+            in_outage = self.outage[0] <= elapsed < self.outage[1]
+            if in_outage or self._random.random() < self.failure_rate:
+                self.failures += 1
+                raise RuntimeError("broker unreachable")
+            if topic == KINESIS_TOPIC:
+                self.delivered.append(json.loads(payload)["request"]["data"])
+            elif topic == KINESIS_BATCH_TOPIC:
+                self.delivered.extend(
+                    json.loads(payload)["request"]["data_list"]
+                )
+
+
+def _publisher(client, store, args):
+    publisher = ResultPublisher(
+        client, max_batch=args.batch_size, linger=0.05, retries=1,
+        backoff=0.01, max_backoff=0.1, store=store, max_rate=args.max_rate,
+    )
+    publisher.start()
+    return publisher
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--results", type=int, default=500)
+    parser.add_argument(
+        "--interval", type=float, default=0.005,
+        help="seconds between two submitted results",
+    )
+    parser.add_argument("--result-bytes", type=int, default=1024)
+    parser.add_argument("--failure-rate", type=float, default=0.2)
+    parser.add_argument(
+        "--outage", type=float, nargs=2, default=[0.5, 1.5],
+        metavar=("START", "END"), help="seconds of full outage",
+    )
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument(
+        "--max-rate", type=float, default=None,
+        help="results forwarded per second at most",
+    )
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "results.db")
+    client = FlakyClient(args.failure_rate, args.outage)
+    try:
+        store = ResultStore(path)
+        publisher = _publisher(client, store, args)
+        start = time.time()
+        for i in range(args.results):
+            if i == args.results // 2:
+                # Restart: what isn't delivered yet stays in the database.
+                publisher.stop()
+                store.close()
+                store = ResultStore(path)
+                print("Restarted with {} result(s) stored".format(
+                    len(store)
+                ))
+                publisher = _publisher(client, store, args)
+            publisher.submit(json.dumps({
+                "id": i, "data": "x" * args.result_bytes,
+            }))
+            time.sleep(args.interval)
+
+        deadline = time.time() + args.timeout
+        while len(store) and time.time() < deadline:
+            time.sleep(0.05)
+        elapsed = time.time() - start
+        publisher.stop()
+        stats = publisher.stats()
+        store.close()
+        size = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory)
+        )
+    finally:
+        shutil.rmtree(directory)
+
+    ids = [json.loads(result)["id"] for result in client.delivered]
+    missing = set(range(args.results)) - set(ids)
+    print("Delivered {} of {} results in {:.2f}s, {} duplicate(s)".format(
+        len(set(ids)), args.results, elapsed, len(ids) - len(set(ids)),
+    ))
+    print("Publish calls: {}, failed: {}".format(
+        client.calls, client.failures
+    ))
+    print("Last publisher: {}".format(stats))
+    print("Database size after draining: {} bytes".format(size))
+    if missing:
+        raise AssertionError("Lost results: {}".format(sorted(missing)))
+
+
+if __name__ == "__main__":
+    main()
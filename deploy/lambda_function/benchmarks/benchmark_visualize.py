@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Per-frame render time of the PIL based and the numpy based visualizers.
+
+Usage:
+    python benchmarks/benchmark_visualize.py [--frames 200] [--boxes 10]
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import visualize  # noqa: E402
+
+
+class _Config(dict):
+    __getattr__ = dict.__getitem__
+
+
+def _make_inputs(num_boxes, width=320, height=240, seed=0):
+    rng = np.random.RandomState(seed)
+    image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    boxes = np.zeros((num_boxes, 6), dtype=np.float32)
+    boxes[:, 0] = rng.uniform(0, 180, num_boxes)
+    boxes[:, 1] = rng.uniform(0, 180, num_boxes)
+    boxes[:, 2:4] = rng.uniform(10, 40, (num_boxes, 2))
+    boxes[:, 4] = rng.randint(0, 2, num_boxes)
+    boxes[:, 5] = rng.uniform(0.5, 1.0, num_boxes)
+    return image, boxes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--boxes", type=int, default=10)
+    args = parser.parse_args()
+
+    config = _Config(CLASSES=["face", "person"], IMAGE_SIZE=[224, 224])
+    image, boxes = _make_inputs(args.boxes)
+    renderer = visualize.FrameRenderer(config)
+    latencies = [("capture", 0.01), ("nn", 0.05), ("encode", 0.02)]
+
+    masked = visualize._mask_image(image.copy())
+    print("mask identical: {}".format(
+        np.array_equal(masked, renderer.mask_image(image.copy()))
+    ))
+
+    def pil(reload_fonts):
+        if reload_fonts:
+            visualize._FONTS.clear()
+        drawn, _, _, _ = visualize.visualize_object_detection_custom(
+            image.copy(), boxes, config, visualize.STATE_NORMAL, None, 0.0
+        )
+        visualize.draw_fps(drawn, 10.0)
+
+    def numpy_renderer():
+        drawn, _, _, _ = renderer.render_object_detection(
+            image.copy(), boxes, visualize.STATE_NORMAL, None, 0.0
+        )
+        renderer.draw_stats(drawn, 10.0, latencies)
+
+    cases = [
+        ("PIL, fonts loaded per frame", lambda: pil(True)),
+        ("PIL, cached fonts", lambda: pil(False)),
+        ("FrameRenderer (numpy)", numpy_renderer),
+    ]
+    for name, func in cases:
+        func()
+        seconds = timeit.timeit(func, number=args.frames) / args.frames
+        print("{:<30s} {:8.3f} ms/frame".format(name, seconds * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Fan-out of encoded frames from one producer to many stream clients."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import threading
+import time
+
+
+class FrameBroadcaster(object):
+    """Hold the latest encoded frame and hand it to every waiting client.
+
+    The producer calls :meth:`publish` once per frame and never blocks on
+    clients. Each client remembers the sequence number of the last frame it
+    sent and calls :meth:`wait` for a newer one, so a slow client simply
+    skips the frames published while it was still writing.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame = None
+        self._sequence = 0
+        self._closed = False
+
+    def publish(self, frame):
+        """Replace the latest frame and wake up all waiting clients.
+
+        Args:
+            frame (bytes): An encoded frame (e.g. JPEG data).
+
+        """
+        with self._condition:
+            self._frame = frame
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def wait(self, last_sequence, timeout=None):
+        """Wait for a frame newer than `last_sequence`.
+
+        Args:
+            last_sequence (int): Sequence number of the frame the client
+                sent last, 0 for a new client.
+            timeout (float): Seconds to wait at most, None to wait forever.
+
+        Returns:
+            int: Sequence number of the returned frame.
+            bytes: The latest frame, None on timeout or after close.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._sequence <= last_sequence and not self._closed:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return last_sequence, None
+                self._condition.wait(remaining)
+            if self._closed:
+                return last_sequence, None
+            return self._sequence, self._frame
+
+    @property
+    def closed(self):
+        """Whether :meth:`close` was called."""
+        return self._closed
+
+    def close(self):
+        """Release all waiting clients, e.g. on server shutdown."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
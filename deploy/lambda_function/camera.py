@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Camera capture in a child process through shared-memory frame buffers."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import ctypes
+import logging
+import multiprocessing
+from Queue import Empty
+import signal
+import time
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Pixel formats requested from the camera driver.
+FORMAT_DEFAULT = "default"
+FORMAT_MJPEG = "MJPG"
+FORMAT_YUYV = "YUYV"
+
+
+def _cap_prop(name):
+    # OpenCV 2.x only has the properties in the legacy `cv` namespace.
+    if hasattr(cv2, 'cv'):
+        return getattr(cv2.cv, "CV_CAP_PROP_" + name)
+    return getattr(cv2, "CAP_PROP_" + name)
+
+
+def _fourcc(pixel_format):
+    if hasattr(cv2, 'cv'):
+        return cv2.cv.CV_FOURCC(*pixel_format)
+    return cv2.VideoWriter_fourcc(*pixel_format)
+
+
+def open_camera(source, width, height, fps, pixel_format=FORMAT_DEFAULT):
+    """Open a camera, asking the driver for a resolution and pixel format.
+
+    With "MJPG" the camera sends compressed frames, so higher resolutions
+    and frame rates fit through USB 2.0. With "YUYV" the raw frames are
+    returned as they are, to be converted to RGB by `FrameConverter`
+    without the BGR frame OpenCV would make first.
+
+    Args:
+        source (int or str): Device number or path, e.g. 0 or "/dev/video0".
+        width (int): Requested frame width.
+        height (int): Requested frame height.
+        fps (int): Requested frame rate.
+        pixel_format (str): "default", "MJPG" or "YUYV".
+
+    Returns:
+        cv2.VideoCapture: Opened camera.
+
+    """
+    vc = cv2.VideoCapture(source)
+    if pixel_format != FORMAT_DEFAULT:
+        vc.set(_cap_prop("FOURCC"), _fourcc(pixel_format))
+    vc.set(_cap_prop("FRAME_WIDTH"), width)
+    vc.set(_cap_prop("FRAME_HEIGHT"), height)
+    vc.set(_cap_prop("FPS"), fps)
+    if pixel_format == FORMAT_YUYV:
+        vc.set(_cap_prop("CONVERT_RGB"), 0)
+    return vc
+
+
+class FrameConverter(object):
+    """Convert camera frames to RGB of a given size in as few passes as we can.
+
+    A frame of the right size is converted straight into the destination.
+    Otherwise it's resized and converted through one scratch buffer, in the
+    order touching fewer pixels. Raw YUYV frames, returned by cameras opened
+    with "YUYV", can only be resized after conversion.
+
+    Args:
+        frame_size (tuple): (width, height) the camera delivers.
+
+    """
+
+    def __init__(self, frame_size):
+        self.frame_size = tuple(int(v) for v in frame_size)
+        self._scratch = None
+
+    def _scratch_buffer(self, shape):
+        if self._scratch is None or self._scratch.shape != shape:
+            self._scratch = np.empty(shape, dtype=np.uint8)
+        return self._scratch
+
+    def convert(self, raw, dst):
+        """Write the RGB image of a captured frame into `dst`.
+
+        Args:
+            raw (np.ndarray): Frame returned by the camera's `read`, BGR or
+                raw YUYV bytes.
+            dst (np.ndarray): RGB image of shape [height, width, 3].
+
+        """
+        height, width = dst.shape[:2]
+        if raw.ndim == 3 and raw.shape[2] == 3:
+            src, code = raw, cv2.COLOR_BGR2RGB
+        else:
+            # Older drivers ignore CONVERT_RGB and return BGR, handled above.
+            camera_width, camera_height = self.frame_size
+            src = raw.reshape(camera_height, camera_width, 2)
+            code = cv2.COLOR_YUV2RGB_YUYV
+
+        if src.shape[:2] == (height, width):
+            cv2.cvtColor(src, code, dst=dst)
+        elif code == cv2.COLOR_BGR2RGB and src.shape[0] > height:
+            # Shrink first, then convert fewer pixels into the destination.
+            scratch = self._scratch_buffer(dst.shape)
+            cv2.resize(src, (width, height), dst=scratch)
+            cv2.cvtColor(scratch, code, dst=dst)
+        else:
+            scratch = self._scratch_buffer(src.shape[:2] + (3, ))
+            cv2.cvtColor(src, code, dst=scratch)
+            cv2.resize(scratch, (width, height), dst=dst)
+        return dst
+
+
+def frame_size(vc):
+    """Return the (width, height) of the frames a camera delivers."""
+    return vc.get(_cap_prop("FRAME_WIDTH")), vc.get(_cap_prop("FRAME_HEIGHT"))
+
+
+def _capture_loop(open_camera, views, free_slots, ready_slots, stop_event):
+    # ignore SIGINT in capture process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    vc = open_camera()
+    converter = FrameConverter(frame_size(vc))
+    logger.info("Camera frame size: {}x{}".format(*converter.frame_size))
+    raw = None
+    while not stop_event.is_set():
+        try:
+            slot = free_slots.get(timeout=0.5)
+        except Empty:
+            continue
+
+        ok, raw = vc.read(raw)
+        if not ok:
+            free_slots.put(slot)
+            time.sleep(0.01)
+            continue
+
+        # Convert straight into the shared buffer where possible.
+        converter.convert(raw, views[slot])
+        ready_slots.put(slot)
+    vc.release()
+
+
+def read_rgb(vc, converter, shape):
+    """Read a frame and return it as a new RGB image of `shape`."""
+    _, raw = vc.read()
+    return converter.convert(raw, np.empty(shape, dtype=np.uint8))
+
+
+class SharedMemoryCamera(object):
+    """Capture RGB frames in a child process into a ring of shared buffers.
+
+    Frames are written straight into preallocated shared memory, and only
+    slot indices travel between the processes, so no frame is pickled or
+    copied on its way to the consumer. A slot handed out by :meth:`read`
+    belongs to the consumer until it is given back with :meth:`release`.
+
+    Args:
+        open_camera (callable): Returns an opened `cv2.VideoCapture`-like
+            object; called in the child process.
+        shape (tuple): (height, width, 3) of the frames to be delivered.
+        slots (int): Number of frame buffers in the ring. It must exceed
+            the number of frames the consumer holds at the same time.
+
+    """
+
+    def __init__(self, open_camera, shape, slots=4):
+        size = int(np.prod(shape))
+        self._buffers = [
+            multiprocessing.RawArray(ctypes.c_uint8, size)
+            for _ in range(slots)
+        ]
+        self._views = [
+            np.frombuffer(buf, dtype=np.uint8).reshape(shape)
+            for buf in self._buffers
+        ]
+        self._free_slots = multiprocessing.Queue()
+        self._ready_slots = multiprocessing.Queue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+        self._stop_event = multiprocessing.Event()
+        self._process = multiprocessing.Process(
+            target=_capture_loop,
+            args=(
+                open_camera, self._views,
+                self._free_slots, self._ready_slots, self._stop_event,
+            ),
+        )
+        self._process.daemon = True
+
+    def start(self):
+        self._process.start()
+
+    def read(self, timeout=None):
+        """Wait for the newest captured frame.
+
+        Older frames waiting in the ring are released unread, so the
+        consumer never falls behind the camera.
+
+        Args:
+            timeout (float): Seconds to wait at most, None to wait forever.
+
+        Returns:
+            int: Slot index to be passed to :meth:`release`.
+            np.ndarray: RGB frame, a view of the shared buffer.
+
+        Raises:
+            Queue.Empty: If no frame arrived within `timeout`.
+
+        """
+        slot = self._ready_slots.get(timeout=timeout)
+        while True:
+            try:
+                newer = self._ready_slots.get_nowait()
+            except Empty:
+                break
+            self._free_slots.put(slot)
+            slot = newer
+        return slot, self._views[slot]
+
+    def release(self, slot):
+        """Give a slot back to the capture process."""
+        self._free_slots.put(slot)
+
+    def close(self):
+        self._stop_event.set()
+        self._process.join(1.0)
+        if self._process.is_alive():
+            self._process.terminate()
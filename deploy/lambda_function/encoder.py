@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""JPEG encoding of stream frames."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+from io import BytesIO
+import time
+
+import cv2
+import numpy as np
+import PIL.Image
+
+BACKEND_PILLOW = "pillow"
+BACKEND_OPENCV = "opencv"
+
+# Pillow's `subsampling` values.
+SUBSAMPLING_444 = 0
+SUBSAMPLING_422 = 1
+SUBSAMPLING_420 = 2
+
+
+def _imwrite_flag(name):
+    # OpenCV 2.x only has the flags in the legacy `cv` namespace.
+    if hasattr(cv2, name):
+        return getattr(cv2, name)
+    if hasattr(cv2, "cv") and hasattr(cv2.cv, "CV_" + name):
+        return getattr(cv2.cv, "CV_" + name)
+    return None
+
+
+class JpegEncoder(object):
+    """Encode RGB frames to JPEG, reusing buffers between frames.
+
+    Args:
+        quality (int): JPEG quality, 1 to 100.
+        subsampling (int): Chroma subsampling, 0 (4:4:4), 1 (4:2:2) or
+            2 (4:2:0).
+        backend (str): "pillow", or "opencv" to encode with `cv2.imencode`
+            (libjpeg-turbo in most OpenCV builds). Older OpenCV versions
+            can't set the subsampling and always use 4:2:0.
+        alpha (float): Smoothing factor of the reported moving averages.
+
+    """
+
+    def __init__(self, quality=85, subsampling=SUBSAMPLING_420,
+                 backend=BACKEND_PILLOW, alpha=0.1):
+        if backend not in (BACKEND_PILLOW, BACKEND_OPENCV):
+            raise ValueError("Unknown JPEG backend: " + backend)
+        if subsampling not in (
+                SUBSAMPLING_444, SUBSAMPLING_422, SUBSAMPLING_420):
+            raise ValueError("Unknown subsampling: {}".format(subsampling))
+        self.quality = quality
+        self.subsampling = subsampling
+        self.backend = backend
+        self.encode_time = 0.0
+        self.frame_bytes = 0.0
+        self._alpha = alpha
+        self._buffer = BytesIO()
+        self._bgr = None
+        self._imencode_params = self._opencv_params()
+
+    def _opencv_params(self):
+        params = [_imwrite_flag("IMWRITE_JPEG_QUALITY"), self.quality]
+        sampling_flag = _imwrite_flag("IMWRITE_JPEG_SAMPLING_FACTOR")
+        if sampling_flag is not None:
+            factors = {
+                SUBSAMPLING_444: "IMWRITE_JPEG_SAMPLING_FACTOR_444",
+                SUBSAMPLING_422: "IMWRITE_JPEG_SAMPLING_FACTOR_422",
+                SUBSAMPLING_420: "IMWRITE_JPEG_SAMPLING_FACTOR_420",
+            }
+            params += [sampling_flag, getattr(cv2, factors[self.subsampling])]
+        return params
+
+    def encode(self, image):
+        """Encode an image.
+
+        Args:
+            image (np.ndarray): RGB image of shape [height, width, 3].
+
+        Returns:
+            bytes: JPEG data.
+
+        """
+        start = time.time()
+        if self.backend == BACKEND_OPENCV:
+            data = self._encode_opencv(image)
+        else:
+            data = self._encode_pillow(image)
+        elapsed = time.time() - start
+        self.encode_time += self._alpha * (elapsed - self.encode_time)
+        self.frame_bytes += self._alpha * (len(data) - self.frame_bytes)
+        return data
+
+    def _encode_pillow(self, image):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        PIL.Image.fromarray(image).save(
+            self._buffer, "JPEG",
+            quality=self.quality, subsampling=self.subsampling,
+        )
+        return self._buffer.getvalue()
+
+    def _encode_opencv(self, image):
+        if self._bgr is None or self._bgr.shape != image.shape:
+            self._bgr = np.empty_like(image)
+        cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=self._bgr)
+        ok, data = cv2.imencode(".jpg", self._bgr, self._imencode_params)
+        if not ok:
+            raise RuntimeError("cv2.imencode failed")
+        return data.tobytes()
+
+
+class Thumbnailer(object):
+    """Shrink RGB images to a given width and encode them to JPEG.
+
+    Args:
+        width (int): Width of the thumbnails, the height keeps the aspect
+            ratio.
+        quality (int): JPEG quality, 1 to 100.
+
+    """
+
+    def __init__(self, width, quality=70):
+        self.width = width
+        self._encoder = JpegEncoder(quality=quality)
+
+    def __call__(self, image):
+        height = max(1, image.shape[0] * self.width // image.shape[1])
+        # INTER_AREA averages the pixels shrunk together, so it doesn't alias.
+        small = cv2.resize(
+            image, (self.width, height), interpolation=cv2.INTER_AREA
+        )
+        return self._encoder.encode(small)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Fused fast path of the YOLOv2 object detection post-processor chain."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import math
+
+import numpy as np
+
+FORMAT_YOLO_V2 = "FormatYoloV2"
+EXCLUDE_LOW_SCORE_BOX = "ExcludeLowScoreBox"
+NMS = "NMS"
+
+# YOLOv2 predicts boxes on a grid of cells of 32x32 pixels.
+CELL_SIZE = 32
+
+# Margin on raw confidences, so float32 rounding of the sigmoid can't make
+# the pre-filter drop a box the exact score test would keep.
+_LOGIT_MARGIN = 1e-3
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _logit(probability):
+    """Inverse of the sigmoid, to compare probabilities with raw outputs."""
+    if probability <= 0.0:
+        return -np.inf
+    if probability >= 1.0:
+        return np.inf
+    return math.log(probability / (1.0 - probability))
+
+
+def _overlaps(boxes, iou_threshold):
+    """Whether each pair of [x, y, w, h] boxes overlaps beyond the threshold.
+
+    The IoU of all pairs is computed at once, which for the few boxes left
+    after score filtering is much cheaper than a row per kept box.
+    """
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = x1 + boxes[:, 2], y1 + boxes[:, 3]
+    width = np.minimum(x2[:, np.newaxis], x2) \
+        - np.maximum(x1[:, np.newaxis], x1)
+    height = np.minimum(y2[:, np.newaxis], y2) \
+        - np.maximum(y1[:, np.newaxis], y1)
+    intersection = np.maximum(width, 0.0) * np.maximum(height, 0.0)
+    areas = boxes[:, 2] * boxes[:, 3]
+    union = areas[:, np.newaxis] + areas - intersection
+    # Pairs of empty boxes have no intersection either, so an IoU of 0.
+    iou = intersection / np.maximum(union, np.finfo(union.dtype).tiny)
+    return iou > iou_threshold
+
+
+def _greedy_nms(boxes, iou_threshold, max_output_size):
+    """Return indices of the boxes kept, by descending score."""
+    order = np.argsort(-boxes[:, 5], kind="mergesort")
+    overlaps = _overlaps(boxes[order], iou_threshold)
+    suppressed = np.zeros(len(order), dtype=np.bool_)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        if len(keep) == max_output_size:
+            break
+        suppressed |= overlaps[i]
+    return order[keep]
+
+
+def nms(boxes, iou_threshold, max_output_size, per_class=True):
+    """Greedy non maximum suppression, one IoU matrix per class.
+
+    Args:
+        boxes (np.ndarray): [num_boxes, 6 (x, y, w, h, class_id, score)].
+        iou_threshold (float): Boxes overlapping a kept box of higher score
+            by more than this are suppressed.
+        max_output_size (int): Maximum number of boxes kept, per class if
+            `per_class`.
+        per_class (bool): Suppress boxes of the same class only.
+
+    Returns:
+        np.ndarray: Kept rows of `boxes`, ordered by class if `per_class`,
+            then by descending score.
+
+    """
+    if len(boxes) == 0 or not per_class:
+        return boxes[_greedy_nms(boxes, iou_threshold, max_output_size)]
+    results = []
+    for class_id in np.unique(boxes[:, 4]):
+        class_boxes = boxes[boxes[:, 4] == class_id]
+        keep = _greedy_nms(class_boxes, iou_threshold, max_output_size)
+        results.append(class_boxes[keep])
+    return np.concatenate(results)
+
+
+class FusedYoloV2PostProcess(object):
+    """Decode YOLOv2 outputs into boxes, filter and suppress them at once.
+
+    Equivalent to `FormatYoloV2` followed by `ExcludeLowScoreBox` and `NMS`
+    of Blueoil, the last two being optional. The generic chain decodes
+    every anchor of every cell for every class before dropping most of
+    them; here cells whose confidence alone can't reach the threshold are
+    dropped first from the raw outputs, and only the remaining boxes are
+    decoded, against grid offsets and anchor sizes computed once.
+
+    Args:
+        image_size (list): [height, width] of the model input.
+        num_classes (int): Number of classes.
+        anchors (list): [width, height] of each anchor, in cells.
+        data_format (str): "NHWC" or "NCHW" layout of the outputs.
+        threshold (float): Boxes of score not above it are excluded, None
+            to keep all of them.
+        iou_threshold (float): IoU threshold of NMS, None to skip NMS.
+        max_output_size (int): Maximum number of boxes kept by NMS.
+        per_class (bool): Whether NMS is applied per class.
+
+    """
+
+    def __init__(self, image_size, num_classes, anchors, data_format="NHWC",
+                 threshold=None, iou_threshold=None, max_output_size=100,
+                 per_class=True):
+        self.image_size = image_size
+        self.num_classes = num_classes
+        self.anchors = anchors
+        self.data_format = data_format
+        self.threshold = threshold
+        self.iou_threshold = iou_threshold
+        self.max_output_size = max_output_size
+        self.per_class = per_class
+
+        height, width = image_size
+        num_cell_y, num_cell_x = height // CELL_SIZE, width // CELL_SIZE
+        num_anchors = len(anchors)
+        # Flattened in the order of the outputs: cell row, column, anchor.
+        offset_y, offset_x, anchor = np.meshgrid(
+            np.arange(num_cell_y), np.arange(num_cell_x),
+            np.arange(num_anchors), indexing="ij",
+        )
+        anchors = np.asarray(anchors, dtype=np.float32)[anchor.ravel()]
+        self._scale = np.array(
+            [width / num_cell_x, height / num_cell_y], dtype=np.float32
+        )
+        self._offsets = np.stack(
+            [offset_x.ravel(), offset_y.ravel()], axis=1
+        ).astype(np.float32)
+        self._anchor_sizes = anchors * self._scale
+        self._num_predictions = len(anchors)
+        self._min_confidence = _logit(threshold or 0.0) - _LOGIT_MARGIN
+
+    def _format(self, output):
+        """Return [num_boxes, 6] boxes of one image scoring above threshold.
+
+        Args:
+            output (np.ndarray): Predictions of shape
+                [num_cells * num_anchors, num_classes + 5 (class scores,
+                confidence, x, y, w, h)].
+
+        """
+        num_classes = self.num_classes
+        candidates = np.flatnonzero(
+            output[:, num_classes] > self._min_confidence
+        )
+        predictions = output[candidates]
+
+        logits = predictions[:, :num_classes]
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        scores = probabilities * _sigmoid(
+            predictions[:, num_classes:num_classes + 1]
+        )
+        if self.threshold is None:
+            rows, class_ids = np.indices(scores.shape).reshape(2, -1)
+        else:
+            rows, class_ids = np.nonzero(scores > self.threshold)
+
+        indices = candidates[rows]
+        deltas = predictions[rows, num_classes + 1:]
+        sizes = np.exp(deltas[:, 2:]) * self._anchor_sizes[indices]
+        centers = (_sigmoid(deltas[:, :2]) + self._offsets[indices]) \
+            * self._scale
+
+        boxes = np.empty((len(rows), 6), dtype=np.float32)
+        boxes[:, :2] = centers - sizes / 2
+        boxes[:, 2:4] = sizes
+        boxes[:, 4] = class_ids
+        boxes[:, 5] = scores[rows, class_ids]
+        return boxes
+
+    def __call__(self, outputs, **kwargs):
+        """Post-process a batch of outputs like the Blueoil chain.
+
+        Args:
+            outputs (np.ndarray): Network outputs of shape [batch_size,
+                num_cell_y, num_cell_x, num_anchors * (num_classes + 5)],
+                or channels first for "NCHW".
+
+        Returns:
+            dict: 'outputs' holding a [num_boxes, 6 (x, y, w, h, class_id,
+                score)] array per image, along with `kwargs`.
+
+        """
+        outputs = np.asarray(outputs, dtype=np.float32)
+        if self.data_format == "NCHW":
+            outputs = np.transpose(outputs, [0, 2, 3, 1])
+        outputs = outputs.reshape(
+            len(outputs), self._num_predictions, self.num_classes + 5
+        )
+
+        results = []
+        for output in outputs:
+            boxes = self._format(output)
+            if self.iou_threshold is not None:
+                boxes = nms(
+                    boxes, self.iou_threshold, self.max_output_size,
+                    self.per_class,
+                )
+            results.append(boxes)
+        return dict({'outputs': results}, **kwargs)
+
+
+def compile_post_process(post_processor_config):
+    """Build a fused post-process for a chain of `POST_PROCESSOR` of meta.yaml.
+
+    Args:
+        post_processor_config (list): {class name: arguments} dicts.
+
+    Returns:
+        FusedYoloV2PostProcess: Fused equivalent of the chain, or None if
+            the chain isn't `FormatYoloV2` optionally followed by
+            `ExcludeLowScoreBox` and `NMS`, to be built by
+            `build_post_process`.
+
+    """
+    steps = []
+    for processor in post_processor_config or []:
+        for class_name, class_args in processor.items():
+            steps.append((class_name, class_args or {}))
+
+    if not steps or steps[0][0] != FORMAT_YOLO_V2:
+        return None
+    _, format_args = steps.pop(0)
+    kwargs = {
+        "image_size": format_args["image_size"],
+        "num_classes": len(format_args["classes"]),
+        "anchors": format_args["anchors"],
+        "data_format": format_args.get("data_format", "NHWC"),
+    }
+    if steps and steps[0][0] == EXCLUDE_LOW_SCORE_BOX:
+        kwargs["threshold"] = steps.pop(0)[1]["threshold"]
+    if steps and steps[0][0] == NMS:
+        nms_args = steps.pop(0)[1]
+        kwargs["iou_threshold"] = nms_args["iou_threshold"]
+        kwargs["max_output_size"] = nms_args.get("max_output_size", 100)
+        kwargs["per_class"] = nms_args.get("per_class", True)
+    if steps:
+        return None
+    return FusedYoloV2PostProcess(**kwargs)
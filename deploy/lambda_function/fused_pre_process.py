@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Fused fast path of common Blueoil pre-processor chains."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import math
+
+import cv2
+import numpy as np
+import PIL.Image
+
+RESIZE_PRE_PROCESSORS = ("Resize", "ResizeWithGtBoxes")
+PER_IMAGE_STANDARDIZATION = "PerImageStandardization"
+DIVIDE_BY_255 = "DivideBy255"
+
+RESAMPLE_NEAREST = "NEAREST"
+RESAMPLE_METHODS = {
+    RESAMPLE_NEAREST: PIL.Image.NEAREST,
+    "LINEAR": PIL.Image.BILINEAR,
+    "BICUBIC": PIL.Image.BICUBIC,
+}
+
+
+def _nearest_indices(src, dst):
+    """Source index of each destination pixel, as Pillow's NEAREST picks it.
+
+    Pillow accumulates the sampling position pixel by pixel; `np.cumsum`
+    adds the same doubles in the same order, so positions falling exactly
+    on a pixel boundary round the same way.
+    """
+    step = src / dst
+    positions = np.cumsum(
+        np.concatenate([[step * 0.5], np.full(dst - 1, step)])
+    )
+    return np.minimum(positions.astype(np.intp), src - 1)
+
+
+def _mean_std(image):
+    # One pass in OpenCV accumulating in float64, over all channels at once.
+    mean, stddev = cv2.meanStdDev(np.ascontiguousarray(image).reshape(-1, 1))
+    return float(mean[0, 0]), float(stddev[0, 0])
+
+
+class FusedPreProcess(object):
+    """Resize and normalize an image in one routine with reused buffers.
+
+    Equivalent to `Resize` or `ResizeWithGtBoxes` followed by
+    `PerImageStandardization` or `DivideBy255` of Blueoil, either being
+    optional. NEAREST resizing remaps the pixels Pillow would pick through
+    cached coordinate maps into a preallocated buffer; other methods still
+    go through Pillow. Normalization computes the statistics in one pass
+    and writes float32 straight into the output.
+
+    Args:
+        size (list): [height, width] to resize to, 0 keeping the input's,
+            or None not to resize.
+        resample (str): "NEAREST", "LINEAR" or "BICUBIC".
+        normalize (str): "PerImageStandardization", "DivideBy255" or None.
+
+    """
+
+    def __init__(self, size=None, resample=RESAMPLE_NEAREST, normalize=None):
+        if resample not in RESAMPLE_METHODS:
+            raise ValueError("Unknown resample method: " + resample)
+        self.size = size
+        self.resample = resample
+        self.normalize = normalize
+        self._maps = None
+        self._maps_shape = None
+        self._resized = None
+
+    @property
+    def dtype(self):
+        return np.uint8 if self.normalize is None else np.float32
+
+    def output_shape(self, input_shape):
+        """Return the shape of the output for an input of `input_shape`."""
+        return self._target_size(input_shape) + tuple(input_shape[2:])
+
+    def _target_size(self, input_shape):
+        if self.size is None:
+            return tuple(input_shape[:2])
+        height, width = self.size
+        return (height or input_shape[0], width or input_shape[1])
+
+    def _resize(self, image):
+        height, width = self._target_size(image.shape)
+        if image.shape[:2] == (height, width):
+            return image
+        if self.resample != RESAMPLE_NEAREST:
+            return np.array(PIL.Image.fromarray(image).resize(
+                [width, height], RESAMPLE_METHODS[self.resample]
+            ))
+
+        if self._maps_shape != image.shape[:2]:
+            rows = _nearest_indices(image.shape[0], height)
+            cols = _nearest_indices(image.shape[1], width)
+            # Integral coordinates, so INTER_NEAREST takes them exactly.
+            self._maps = (
+                np.tile(cols.astype(np.float32), (height, 1)),
+                np.tile(rows.astype(np.float32)[:, np.newaxis], (1, width)),
+            )
+            self._maps_shape = image.shape[:2]
+        shape = (height, width) + image.shape[2:]
+        if self._resized is None or self._resized.shape != shape:
+            self._resized = np.empty(shape, dtype=np.uint8)
+        cv2.remap(
+            image, self._maps[0], self._maps[1], cv2.INTER_NEAREST,
+            dst=self._resized,
+        )
+        return self._resized
+
+    def __call__(self, image, out=None, **kwargs):
+        """Process an image like the Blueoil pre-processor chain.
+
+        Args:
+            image (np.ndarray): uint8 image of shape [height, width, ...].
+            out (np.ndarray): Array of `output_shape` and `dtype` to write
+                the result into, a new one is allocated if None.
+
+        Returns:
+            dict: 'image' holding the result, along with `kwargs`.
+
+        """
+        image = np.asarray(image, dtype=np.uint8)
+        resized = self._resize(image)
+        if out is None:
+            out = np.empty(resized.shape, dtype=self.dtype)
+
+        if self.normalize == PER_IMAGE_STANDARDIZATION:
+            mean, stddev = _mean_std(resized)
+            adjusted_stddev = max(stddev, 1.0 / math.sqrt(resized.size))
+            scale = 1.0 / adjusted_stddev
+            np.multiply(resized, scale, out=out, dtype=np.float32)
+            out -= mean * scale
+        elif self.normalize == DIVIDE_BY_255:
+            np.multiply(resized, 1.0 / 255, out=out, dtype=np.float32)
+        else:
+            out[...] = resized
+        return dict({'image': out}, **kwargs)
+
+
+def compile_pre_process(pre_processor_config):
+    """Build a `FusedPreProcess` for a chain of `PRE_PROCESSOR` of meta.yaml.
+
+    Args:
+        pre_processor_config (list): {class name: arguments} dicts.
+
+    Returns:
+        FusedPreProcess: Fused equivalent of the chain, or None if the chain
+            has other pre-processors, to be built by `build_pre_process`.
+
+    """
+    steps = []
+    for processor in pre_processor_config or []:
+        for class_name, class_args in processor.items():
+            steps.append((class_name, class_args or {}))
+
+    size = None
+    resample = RESAMPLE_NEAREST
+    normalize = None
+    if steps and steps[0][0] in RESIZE_PRE_PROCESSORS:
+        _, class_args = steps.pop(0)
+        size = class_args.get("size", [256, 256])
+        resample = class_args.get("resample", RESAMPLE_NEAREST)
+        if resample not in RESAMPLE_METHODS:
+            return None
+    if steps and steps[0][0] in (PER_IMAGE_STANDARDIZATION, DIVIDE_BY_255):
+        normalize = steps.pop(0)[0]
+    if steps or (size is None and normalize is None):
+        return None
+    return FusedPreProcess(size, resample, normalize)
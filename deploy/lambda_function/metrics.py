@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Latency histograms of the inference server stages."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+
+# Upper bounds in seconds, from a fast numpy call to a stalled client.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+PERCENTILES = (50, 95, 99)
+METRIC_NAME = "bluegrass_stage_seconds"
+
+
+def _format_float(value):
+    return repr(float(value))
+
+
+class Histogram(object):
+    """Histogram of durations with a rolling window for percentiles.
+
+    The bucket counts, sum and count are cumulative like a Prometheus
+    histogram, so rates can be computed by the scraper. Percentiles are
+    computed from the last `window` observations only, so they follow
+    changes such as a newly deployed model.
+
+    Args:
+        buckets (tuple): Sorted upper bounds of the buckets in seconds.
+        window (int): Number of recent observations kept for percentiles.
+
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=1024):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+            self._recent.append(value)
+
+    def cumulative_counts(self):
+        """Return (upper bound, count) tuples, ending with +Inf."""
+        with self._lock:
+            counts = list(self._counts)
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"), ), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def totals(self):
+        """Return the sum and the count of all observations."""
+        with self._lock:
+            return self._sum, self._count
+
+    def snapshot(self):
+        """Return count, sum and recent mean and percentiles as a dict."""
+        with self._lock:
+            recent = sorted(self._recent)
+            result = OrderedDict([("count", self._count), ("sum", self._sum)])
+        result["mean"] = sum(recent) / len(recent) if recent else 0.0
+        for q in PERCENTILES:
+            value = 0.0
+            if recent:
+                # Nearest-rank percentile.
+                rank = int(round(q / 100.0 * (len(recent) - 1)))
+                value = recent[rank]
+            result["p{}".format(q)] = value
+        return result
+
+
+class StageMetrics(object):
+    """Histograms of named stages, exported as Prometheus text or a dict.
+
+    Args:
+        names (list): Stages to create upfront, so they are exported in
+            this order even before their first observation.
+        buckets (tuple): Upper bounds of the buckets in seconds.
+        window (int): Number of recent observations kept for percentiles.
+
+    """
+
+    def __init__(self, names=(), buckets=DEFAULT_BUCKETS, window=1024):
+        self._buckets = buckets
+        self._window = window
+        self._histograms = OrderedDict()
+        self._lock = threading.Lock()
+        for name in names:
+            self._histogram(name)
+
+    def _histogram(self, name):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(self._buckets, self._window)
+                self._histograms[name] = histogram
+            return histogram
+
+    def observe(self, name, seconds):
+        self._histogram(name).observe(seconds)
+
+    @contextmanager
+    def time(self, name):
+        """Observe the duration of the `with` block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def _items(self):
+        with self._lock:
+            return list(self._histograms.items())
+
+    def as_dict(self):
+        return OrderedDict(
+            (name, histogram.snapshot()) for name, histogram in self._items()
+        )
+
+    def to_prometheus(self, gauges=None):
+        """Render the Prometheus text exposition format.
+
+        Args:
+            gauges (dict): Additional {metric name: value} exported as
+                gauges, e.g. the frame rate. Names may carry labels, like
+                'bluegrass_fps{stream="0"}'.
+
+        Returns:
+            str: Text served on `/metrics`.
+
+        """
+        lines = [
+            "# HELP {} Latency of the inference server stages.".format(
+                METRIC_NAME
+            ),
+            "# TYPE {} histogram".format(METRIC_NAME),
+        ]
+        for name, histogram in self._items():
+            for bound, count in histogram.cumulative_counts():
+                le = "+Inf" if bound == float("inf") else _format_float(bound)
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                    METRIC_NAME, name, le, count
+                ))
+            total, count = histogram.totals()
+            lines.append('{}_sum{{stage="{}"}} {}'.format(
+                METRIC_NAME, name, _format_float(total)
+            ))
+            lines.append('{}_count{{stage="{}"}} {}'.format(
+                METRIC_NAME, name, count
+            ))
+        family = None
+        for metric, value in sorted((gauges or {}).items()):
+            # Labeled gauges of one metric share a single TYPE line.
+            name = metric.split("{")[0]
+            if name != family:
+                lines.append("# TYPE {} gauge".format(name))
+                family = name
+            lines.append("{} {}".format(metric, _format_float(value)))
+        return "\n".join(lines) + "\n"
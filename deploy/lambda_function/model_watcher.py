@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Detection of model updates pushed to the device."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ModelWatcher(object):
+    """Poll model files and call back once a change has settled.
+
+    Greengrass replaces the files of a machine learning resource one by one
+    when it's updated, so a change is only reported once all files exist
+    and their sizes and modification times stayed the same between two
+    polls. A change is reported once, whether the callback succeeds or not.
+
+    Args:
+        paths (list): Files to watch, e.g. the model and meta.yaml.
+        on_change (callable): Called without arguments from the watcher
+            thread after a change.
+        interval (float): Seconds between two polls.
+
+    """
+
+    def __init__(self, paths, on_change, interval=10.0):
+        self.paths = paths
+        self.on_change = on_change
+        self.interval = interval
+        self._current = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="watcher")
+        self._thread.daemon = True
+
+    def start(self):
+        self._current = self._signature()
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self._thread.join(timeout)
+
+    def _signature(self):
+        signature = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                signature.append(None)
+                continue
+            signature.append((stat.st_mtime, stat.st_size))
+        return tuple(signature)
+
+    def _loop(self):
+        pending = None
+        while not self._stop_event.wait(self.interval):
+            signature = self._signature()
+            if signature == self._current:
+                pending = None
+                continue
+            if None in signature or signature != pending:
+                # Missing or still being written, look again next time.
+                pending = signature
+                continue
+            logger.info("Model files changed: " + ", ".join(self.paths))
+            self._current = signature
+            pending = None
+            try:
+                self.on_change()
+            except Exception as e:
+                logger.error("Failed to handle the change: {!r}".format(e))
@@ -18,54 +18,220 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import _ctypes
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from datetime import datetime
-from io import BytesIO
+from functools import partial
+from SocketServer import ThreadingMixIn
 import json
 import logging
 from multiprocessing import Pool
 import os
-import signal
+import shutil
+import socket
+import tempfile
+import threading
 import time
 
 from blueoil.common import Tasks
 from blueoil.utils.predict_output.output import JsonOutput
-from config import (
-    build_post_process,
-    build_pre_process,
-    load_yaml,
-)
+from config import load_yaml
 from blueoil.visualize import (
     visualize_classification,
     visualize_semantic_segmentation,
 )
-import cv2
 import greengrasssdk
 from lmnet.nnlib import NNLib
 import numpy as np
-from visualize import (
-    draw_fps,
-    visualize_object_detection_custom as visualize_od,
+from batching import BatchCollector, model_batch_size, run_batched
+from broadcaster import FrameBroadcaster
+from camera import (
+    FORMAT_DEFAULT,
+    FrameConverter,
+    frame_size,
+    open_camera,
+    read_rgb,
+    SharedMemoryCamera,
 )
-
+from encoder import JpegEncoder, Thumbnailer
+from metrics import StageMetrics
+from model_watcher import ModelWatcher
+from pipeline import Frame, Pipeline
+from processors import build_processors, pre_process_images
+from publisher import ResultPublisher
+from recorder import ClipRecorder, ClipWriter
+from result_format import CompactResultEncoder
+from result_store import ResultStore
+from scheduler import InferenceScheduler
+from visualize import draw_message, FrameRenderer
+
+
+# camera settings.
+CAMERA_WIDTH = 320
+CAMERA_HEIGHT = 240
+CAMERA_FPS = 60
+CAMERA_SOURCE = 0
 
 # global variable for multi process or multi thread.
-nn = None
-pre_process = None
-post_process = None
+current_model = None
+model_lock = threading.Lock()
+# Held by the nn stage while it runs, and by a reload while the new
+# network initializes: both would use the FPGA otherwise.
+runner_lock = threading.Lock()
 vc = None
-config = None
-pool = None
+converter = None
+publisher = None
+streams = []
+inference_pipeline = None
+metrics = None
+clip_writer = None
+
+STREAM_PATH = "/camera/"
+# Frames of a camera held by inference at once: queued by its scheduler,
+# being batched, queued for pre-processing and being pre-processed.
+INFERENCE_FRAMES_HELD = 4
+# Seconds a stream client waits for a new frame before the last one is sent
+# again, so a stalled pipeline or a model reload doesn't hold its thread
+# forever and a disconnected client is noticed.
+STREAM_KEEPALIVE = 5.0
+
+# Stages of `pipeline` and `inference_pipeline`, then the ones timed
+# outside of them.
+METRIC_STAGES = [
+    "capture", "schedule", "pre", "nn", "post", "draw", "encode",
+    "socket_write", "publish",
+]
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each connection in its own thread.
+
+    Streaming clients are capped at `max_clients`, and every client socket
+    gets `client_timeout` seconds for each write so a stuck peer only ties
+    up its own thread.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class,
+                 max_clients=4, client_timeout=10.0):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.client_timeout = client_timeout
+        self.stream_slots = threading.BoundedSemaphore(max_clients)
 
 
 class MotionJpegHandler(BaseHTTPRequestHandler):
+    def setup(self):
+        # StreamRequestHandler applies `timeout` to the client socket.
+        self.timeout = self.server.client_timeout
+        BaseHTTPRequestHandler.setup(self)
+
+    def handle(self):
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except socket.error as e:
+            # Disconnected or timed out (socket.timeout) client.
+            logging.info("Client disconnected: " + repr(e))
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
     def do_GET(self):
-        global config, pool, gg_pool
-        result = None
-        fps_only_network = 0.0
+        if self.path == "/favicon.ico":
+            self.send_error(404)
+            return
+        if self.path == "/health":
+            self._send_text(200, "OK")
+            return
+        if self.path == "/metrics":
+            self._send_metrics()
+            return
+        if self.path == "/stats":
+            self._send_stats()
+            return
+
+        stream = _find_stream(self.path)
+        if stream is None:
+            self.send_error(404)
+            return
+        if not self.server.stream_slots.acquire(False):
+            self._send_text(503, "Too many stream clients")
+            return
+        try:
+            self._stream(stream)
+        finally:
+            self.server.stream_slots.release()
+
+    def _send_text(self, code, text, content_type="text/plain"):
+        body = text.encode("utf-8")
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_metrics(self):
+        global metrics, publisher, streams, inference_pipeline, clip_writer
+        gauges = {"bluegrass_inference_fps": inference_pipeline.fps}
+        for stream in streams:
+            label = '{{stream="{}"}}'.format(stream.index)
+            gauges["bluegrass_fps" + label] = stream.pipeline.fps
+            gauges["bluegrass_inference_interval" + label] = \
+                stream.scheduler.interval
+            gauges["bluegrass_stream_latency_seconds" + label] = \
+                stream.scheduler.latency
+            gauges["bluegrass_frame_bytes" + label] = \
+                stream.encoder.frame_bytes
+            for name, dropped in stream.dropped():
+                gauges['bluegrass_dropped_frames{{stream="{}",stage="{}"}}'
+                       .format(stream.index, name)] = dropped
+        for name, dropped in inference_pipeline.dropped():
+            gauges['bluegrass_dropped_batches{{stage="{}"}}'.format(name)] = \
+                dropped
+        for name, value in publisher.stats().items():
+            gauges["bluegrass_publisher_" + name] = value
+        if clip_writer is not None:
+            for name, value in clip_writer.stats().items():
+                gauges["bluegrass_clips_" + name] = value
+        self._send_text(
+            200, metrics.to_prometheus(gauges),
+            content_type="text/plain; version=0.0.4",
+        )
 
-        pool_result = pool.apply_async(_read_camera_image, ())
+    def _send_stats(self):
+        global metrics, publisher, streams, inference_pipeline, clip_writer
+        global current_model
+        model = current_model
+        stats = {
+            "streams": [
+                {
+                    "path": STREAM_PATH + str(stream.index),
+                    "source": stream.source,
+                    "fps": stream.pipeline.fps,
+                    "inference_interval": stream.scheduler.interval,
+                    "stream_latency": stream.scheduler.latency,
+                    "frame_bytes": stream.encoder.frame_bytes,
+                    "dropped_frames": dict(stream.dropped()),
+                }
+                for stream in streams
+            ],
+            "inference_fps": inference_pipeline.fps,
+            "model_loaded": model is not None,
+            "model_batch_size": model.batch_size if model else None,
+            "dropped_batches": dict(inference_pipeline.dropped()),
+            "stages": metrics.as_dict(),
+            "publisher": publisher.stats(),
+            "clips": clip_writer.stats() if clip_writer is not None else None,
+        }
+        self._send_text(
+            200, json.dumps(stats), content_type="application/json",
+        )
 
+    def _stream(self, stream):
+        global metrics
         self.send_response(200)
         self.send_header(
             'Content-type',
@@ -73,91 +239,332 @@ class MotionJpegHandler(BaseHTTPRequestHandler):
         )
         self.end_headers()
 
-        state = 0
-        displayed_waring = False
-        start_time = None
-
-        while True:
+        sequence = 0
+        jpeg = None
+        while not stream.broadcaster.closed:
+            latest, frame = stream.broadcaster.wait(
+                sequence, timeout=STREAM_KEEPALIVE,
+            )
+            if frame is not None:
+                sequence, jpeg = latest, frame
+            elif jpeg is None:
+                # Nothing streamed yet, nothing to send again.
+                continue
             try:
-                pool_result.wait()
-                window_img = pool_result.get()
-                result, _, fps_only_network = _run_inference(window_img)
-                pool_result = pool.apply_async(_read_camera_image, ())
-
-                result = result[0]
-                submit_flag = False
-                duration = 1.0
-                if config.TASK == "IMAGE.CLASSIFICATION":
-                    image = visualize_classification(
-                        window_img, result, config
-                    )
-                    now = time.time()
-                    start_time = start_time or now
-                    submit_flag = now - start_time > duration
-                    start_time = now if submit_flag else start_time
-
-                if config.TASK == "IMAGE.OBJECT_DETECTION":
-                    prev_displayed_waring = displayed_waring
-                    image, state, start_time, displayed_waring = visualize_od(
-                        window_img, result, config, state, start_time, duration
-                    )
-                    submit_flag = (
-                        displayed_waring and not prev_displayed_waring
-                    )
-
-                if config.TASK == "IMAGE.SEMANTIC_SEGMENTATION":
-                    image = visualize_semantic_segmentation(
-                        window_img, result, config
-                    )
-
-                draw_fps(image, fps_only_network)
-                tmp = BytesIO()
-                image.save(tmp, "JPEG", quality=100, subsampling=0)
-                if submit_flag:
-                    logging.info("Detect Warning!!!")
-                    json_output = JsonOutput(
-                        task=Tasks(config.TASK),
-                        classes=config.CLASSES,
-                        image_size=config.IMAGE_SIZE,
-                        data_format=config.DATA_FORMAT,
+                with metrics.time("socket_write"):
+                    self.send_header('Content-type', 'image/jpeg')
+                    self.end_headers()
+                    self.wfile.write(jpeg)
+                    self.wfile.write(b"\r\n--jpgboundary\r\n")
+            except (socket.error, IOError):
+                # The client went away.
+                return
+
+
+def _find_stream(path):
+    """Return the stream of a path, '/' being the first camera's."""
+    global streams
+    if not path.startswith(STREAM_PATH):
+        return streams[0]
+    index = path[len(STREAM_PATH):]
+    if not index.isdigit() or int(index) >= len(streams):
+        return None
+    return streams[int(index)]
+
+
+class _Stream(object):
+    """Camera, streaming pipeline and MJPEG endpoint of one video source.
+
+    Every captured frame is drawn and encoded by the stream's own pipeline,
+    while its scheduler hands some of them over to the inference pipeline
+    shared by all streams. Encoded frames also go to the recorder, if any,
+    for clips of warnings. Results are published as `JsonOutput` JSON, or
+    encoded by `result_encoder` if given.
+    """
+
+    def __init__(self, index, source, scheduler, encoder, recorder=None,
+                 result_encoder=None):
+        self.index = index
+        self.source = source
+        self.scheduler = scheduler
+        self.encoder = encoder
+        self.recorder = recorder
+        self.result_encoder = result_encoder
+        self.broadcaster = FrameBroadcaster()
+        self.camera = None
+        self.pool = None
+        self.pipeline = None
+        self.shape = None
+        self.sequence = 0
+
+    def open(self, camera_backend, camera_settings):
+        """Start capturing and build the streaming pipeline.
+
+        Args:
+            camera_backend (str): "shared_memory" or "pool".
+            camera_settings (dict): `camera.open_camera` keyword arguments
+                besides the source.
+
+        """
+        global metrics
+        self.shape = (
+            camera_settings["height"], camera_settings["width"], 3,
+        )
+        open_func = partial(open_camera, self.source, **camera_settings)
+        self.pipeline = Pipeline([
+            ("capture", self.capture),
+            ("draw", _Visualizer(self)),
+            ("encode", self.encode),
+        ], metrics=metrics)
+        if camera_backend == "shared_memory":
+            # Every frame in flight holds a buffer, plus one being captured
+            # and the ones chosen for inference until pre-processed.
+            self.camera = SharedMemoryCamera(
+                open_func, self.shape,
+                slots=self.pipeline.max_frames_in_flight + 2
+                + INFERENCE_FRAMES_HELD,
+            )
+            self.camera.start()
+        elif camera_backend == "pool":
+            self.pool = Pool(
+                processes=1, initializer=_init_camera,
+                initargs=(open_func, ),
+            )
+        else:
+            raise ValueError("Unknown camera backend: " + camera_backend)
+
+    def capture(self):
+        # The camera is read in a child process; this thread just waits.
+        self.sequence += 1
+        if self.camera is not None:
+            slot, image = self.camera.read()
+            frame = Frame(
+                self.sequence, image,
+                release=partial(self.camera.release, slot),
+            )
+        else:
+            image = self.pool.apply(_read_camera_image, (self.shape, ))
+            frame = Frame(self.sequence, image)
+        self.scheduler.offer(frame)
+        return frame
+
+    def encode(self, frame):
+        jpeg = self.encoder.encode(frame.drawn)
+        self.broadcaster.publish(jpeg)
+        if self.recorder is not None:
+            self.recorder.add(jpeg, frame.captured_at)
+        self.scheduler.displayed(frame, _inference_time())
+        return frame
+
+    def latencies(self):
+        global inference_pipeline
+        return self.pipeline.latencies() + inference_pipeline.latencies()[1:]
+
+    def dropped(self):
+        return self.pipeline.dropped() + [
+            ("schedule", self.scheduler.dropped),
+        ]
+
+    def close(self):
+        self.pipeline.stop()
+        self.scheduler.close()
+        self.broadcaster.close()
+        if self.recorder is not None:
+            self.recorder.flush()
+        if self.camera is not None:
+            self.camera.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
+
+
+class _Model(object):
+    """Runner, config and processors of a model, swapped in as a whole.
+
+    A batch takes the model current when it enters the inference pipeline
+    and keeps it until its frames are drawn, so a reload never mixes two
+    models on the same frame. A batch reaching the nn stage after a reload
+    is dropped, as the network of its model is released.
+    """
+
+    def __init__(self, nn, config, pre_process, post_process):
+        self.nn = nn
+        self.batch_size = None
+        self.config = config
+        self.pre_process = pre_process
+        self.post_process = post_process
+        self.renderer = FrameRenderer(config)
+
+    def init(self):
+        """Initialize the network, loaded by `_load_runner`."""
+        if self.nn.init() is False:
+            raise RuntimeError("Failed to initialize the network")
+        self.batch_size = model_batch_size(self.nn)
+
+    def release(self):
+        """Free the network, which must not run any more.
+
+        `NNLib.delete` frees its buffers on the FPGA and on the device, then
+        the library is unloaded: every reload loads a new copy of it.
+        """
+        delete = getattr(self.nn, "delete", None)
+        if not isinstance(self.nn, NNLib) or delete is None:
+            return
+        lib = self.nn.lib
+        delete()
+        if lib is not None:
+            _ctypes.dlclose(lib._handle)
+
+
+def _preprocess(batch):
+    global current_model
+    batch.model = current_model
+    if batch.model is None:
+        # Still loading, the streams show the camera images meanwhile.
+        return None
+    batch.data = pre_process_images(
+        batch.model.pre_process, [frame.image for frame in batch.frames],
+    )
+    # The camera buffers, shared with the streamed frames, aren't needed
+    # any more.
+    for frame in batch.frames:
+        frame.release()
+        frame.image = None
+    return batch
+
+
+def _infer(batch):
+    global current_model, runner_lock
+    model = batch.model
+    with runner_lock:
+        if model is not current_model:
+            # Pre-processed for the model before a reload, whose network
+            # is released.
+            return None
+        batch.outputs = run_batched(model.nn, batch.data, model.batch_size)
+    return batch
+
+
+def _postprocess(batch):
+    global streams
+    outputs = batch.model.post_process(outputs=batch.outputs)['outputs']
+    for i, (index, frame) in enumerate(zip(batch.streams, batch.frames)):
+        frame.result = outputs[i]
+        frame.model = batch.model
+        streams[index].scheduler.update_result(frame)
+    return batch
+
+
+def _inference_time():
+    global inference_pipeline
+    # Throughput is bound by the slowest stage, the first one just waits.
+    return max(
+        latency for _, latency in inference_pipeline.latencies()[1:]
+    )
+
+
+class _Visualizer(object):
+    """Draw results and decide on submission, keeping state across frames.
+
+    Every streamed frame is drawn with the latest inference result, which
+    may come from an earlier frame.
+    """
+
+    def __init__(self, stream, duration=1.0):
+        self.stream = stream
+        self.duration = duration
+        self.state = 0
+        self.displayed_waring = False
+        self.start_time = None
+
+    def __call__(self, frame):
+        global publisher, metrics, current_model
+        stream = self.stream
+        window_img = frame.image
+        inferred = stream.scheduler.latest()
+        if inferred is None:
+            # Nothing inferred yet, stream the camera image as it is.
+            frame.drawn = window_img.copy()
+            if current_model is None:
+                draw_message(frame.drawn, "Loading model...")
+            frame.release()
+            return frame
+        config = inferred.model.config
+        renderer = inferred.model.renderer
+        result = inferred.result
+        duration = self.duration
+        submit_flag = False
+        warning = False
+        if config.TASK == "IMAGE.CLASSIFICATION":
+            image = np.array(
+                visualize_classification(window_img, result, config)
+            )
+            now = time.time()
+            self.start_time = self.start_time or now
+            submit_flag = now - self.start_time > duration
+            self.start_time = now if submit_flag else self.start_time
+
+        if config.TASK == "IMAGE.OBJECT_DETECTION":
+            prev_displayed_waring = self.displayed_waring
+            image, self.state, self.start_time, self.displayed_waring = \
+                renderer.render_object_detection(
+                    window_img.copy(), result,
+                    self.state, self.start_time, duration,
+                )
+            submit_flag = self.displayed_waring and not prev_displayed_waring
+            warning = submit_flag
+
+        if config.TASK == "IMAGE.SEMANTIC_SEGMENTATION":
+            image = np.array(
+                visualize_semantic_segmentation(window_img, result, config)
+            )
+
+        renderer.draw_stats(
+            image, stream.pipeline.fps, stream.latencies(),
+            stream.encoder.frame_bytes,
+            inference_interval=stream.scheduler.interval,
+        )
+        if submit_flag:
+            logging.info("Detect Warning on camera {}!!!".format(
+                stream.source
+            ))
+            clip = None
+            if warning and stream.recorder is not None:
+                clip = stream.recorder.trigger(frame.captured_at)
+            with metrics.time("publish"):
+                # The image inferred is released once pre-processed, the
+                # one the warning is shown on goes with the result.
+                if stream.result_encoder is not None:
+                    message = stream.result_encoder.encode(
+                        config, result, window_img,
+                        frame.captured_at, clip=clip,
                     )
-                    json_obj = json_output(
-                        np.expand_dims(result, 0), [window_img], [None]
+                else:
+                    message = _json_result(
+                        config, result, window_img, clip,
                     )
-                    gg_pool.apply_async(_submit, (json_obj, ))
-
-                self.send_header('Content-type', 'image/jpeg')
-                self.end_headers()
-                self.wfile.write(tmp.getvalue())
-
-            finally:
-                self.wfile.write(b"\r\n--jpgboundary\r\n")
-
-
-def _run_inference(inputs):
-    global nn, pre_process, post_process
-    start = time.time()
-
-    data = pre_process(image=inputs)["image"]
-    data = np.expand_dims(data, axis=0)
-
-    network_only_start = time.time()
-    result = nn.run(data)
-    fps_only_network = 1.0 / (time.time() - network_only_start)
-
-    output = post_process(outputs=result)['outputs']
-
-    fps = 1.0 / (time.time() - start)
-    return output, fps, fps_only_network
-
-
-def _init_worker():
-    global nn
-    # ignore SIGINT in pooled process.
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-    # init
-    nn.init()
+                publisher.submit(message)
+
+        frame.drawn = image
+        # The camera buffer isn't needed any more once drawn.
+        frame.release()
+        return frame
+
+
+def _json_result(config, result, image, clip=None):
+    """Serialize a result by `JsonOutput`, with the path of its clip."""
+    json_output = JsonOutput(
+        task=Tasks(config.TASK),
+        classes=config.CLASSES,
+        image_size=config.IMAGE_SIZE,
+        data_format=config.DATA_FORMAT,
+    )
+    json_obj = json_output(np.expand_dims(result, 0), [image], [None])
+    if clip is None:
+        return json_obj
+    json_result = json.loads(json_obj)
+    json_result["clip"] = clip
+    return json.dumps(json_result)
 
 
 def _update_exclude_score_box_threshold(config, threshold):
@@ -171,63 +578,119 @@ def _update_exclude_score_box_threshold(config, threshold):
     return config
 
 
-def _init_camera():
-    global vc
-    # camera settings.
-    camera_width = 320
-    camera_height = 240
-    camera_fps = 60
-    camera_source = 0
+def _init_camera(open_func):
+    global vc, converter
+    vc = open_func()
+    converter = FrameConverter(frame_size(vc))
 
-    if hasattr(cv2, 'cv'):
-        vc = cv2.VideoCapture(camera_source)
-        vc.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, camera_width)
-        vc.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, camera_height)
-        vc.set(cv2.cv.CV_CAP_PROP_FPS, camera_fps)
-    else:
-        vc = cv2.VideoCapture(camera_source)
-        vc.set(cv2.CAP_PROP_FRAME_WIDTH, camera_width)
-        vc.set(cv2.CAP_PROP_FRAME_HEIGHT, camera_height)
-        vc.set(cv2.CAP_PROP_FPS, camera_fps)
 
+def _read_camera_image(shape):
+    global vc, converter
+    return read_rgb(vc, converter, shape)
 
-def _read_camera_image():
-    global vc
-    _, frame = vc.read()
-    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
 
+def _load_runner(model, copy=False):
+    """Load the network of a model file, initialized by `_install_model`.
 
-def _init_gg_client():
-    global gg_client
-    # Creating a greengrass core sdk client
-    gg_client = greengrasssdk.client('iot-data')
-
-
-def _submit(json_obj):
-    global gg_client
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    logging.info("Publish JSON")
-    kinesis_message = {
-        "request": {
-            "data": json_obj,
-        },
-        "id": timestamp,
-    }
-    try:
-        gg_client.publish(
-            topic='kinesisfirehose/message',
-            payload=json.dumps(kinesis_message),
-        )
-        gg_client.publish(
-            topic='inference/result',
-            payload=json_obj,
-        )
-    except Exception as e:
-        logging.error("Failed to publish message: " + repr(e))
+    Args:
+        model (str): Path of a .so or .pb file.
+        copy (bool): Load a shared library from a copy. dlopen() returns
+            the library already loaded from a path, so a new model at the
+            same path would not be loaded otherwise.
 
+    """
+    _, file_extension = os.path.splitext(model)
+    if file_extension == '.so':  # Shared library
+        nn = NNLib()
+        if copy:
+            fd, path = tempfile.mkstemp(
+                prefix="bluegrass_model_", suffix=file_extension,
+            )
+            os.close(fd)
+            shutil.copyfile(model, path)
+            try:
+                nn.load(path)
+            finally:
+                # The library stays mapped once loaded.
+                os.remove(path)
+        else:
+            nn.load(model)
+
+    elif file_extension == '.pb':  # Protocol Buffer file
+        # only load tensorflow if user wants to use GPU
+        from lmnet.tensorflow_graph_runner import TensorflowGraphRunner
+        nn = TensorflowGraphRunner(model)
+
+    return nn
+
+
+def _load_model(model, config_file, threshold, camera_size,
+                fused_pre_process=True, fused_post_process=True,
+                reload=False):
+    """Load a model and build the processors of its meta.yaml.
 
-def run(model, config_file, port=80, threshold=0.5):
-    global nn, pre_process, post_process, config, vc, pool, gg_client, gg_pool
+    Args:
+        camera_size (list): [height, width] of the camera frames.
+        reload (bool): Whether a model was loaded before.
+
+    Returns:
+        _Model: The loaded model, not initialized yet.
+
+    """
+    nn = _load_runner(model, copy=reload)
+
+    config = load_yaml(config_file)
+    config = _update_exclude_score_box_threshold(config, threshold)
+    pre_process, post_process = build_processors(
+        config, camera_size, fused_pre_process=fused_pre_process,
+        fused_post_process=fused_post_process,
+    )
+    return _Model(nn, config, pre_process, post_process)
+
+
+def _install_model(load_func):
+    """Load a model and make it current, keeping the previous one on error.
+
+    The nn stage is paused while the new network initializes. Batches
+    pre-processed for the previous model are dropped from then on, so its
+    network is released right after the swap.
+    """
+    global current_model, model_lock, runner_lock
+    with model_lock:
+        start = time.time()
+        try:
+            model = load_func()
+        except Exception as e:
+            logging.error("Failed to load the model: {!r}".format(e))
+            return
+        with runner_lock:
+            try:
+                model.init()
+            except Exception as e:
+                logging.error("Failed to load the model: {!r}".format(e))
+                model.release()
+                return
+            previous, current_model = current_model, model
+            if previous is not None:
+                previous.release()
+        logging.info("Model loaded in {:.1f}s".format(time.time() - start))
+
+
+def run(model, config_file, port=80, threshold=0.5,
+        max_clients=4, client_timeout=10.0, camera_backend="shared_memory",
+        jpeg_quality=85, jpeg_subsampling=2, jpeg_backend="pillow",
+        publish_queue_size=100, publish_batch_size=10,
+        inference_interval=1, target_fps=None, latency_budget=None,
+        max_inference_interval=30, camera_sources=(CAMERA_SOURCE, ),
+        camera_resolution=(CAMERA_WIDTH, CAMERA_HEIGHT),
+        camera_fps=CAMERA_FPS, camera_format=FORMAT_DEFAULT,
+        fused_pre_process=True, fused_post_process=True, clip_dir=None,
+        clip_pre_seconds=5.0, clip_post_seconds=5.0,
+        clip_disk_limit=100 * 1024 * 1024,
+        clip_buffer_size=8 * 1024 * 1024, model_watch_interval=10.0,
+        result_store_path=None, result_store_size=50 * 1024 * 1024,
+        publish_rate=None, result_encoding="json", thumbnail_width=None):
+    global publisher, streams, metrics, inference_pipeline, clip_writer
 
     filename, file_extension = os.path.splitext(model)
     supported_files = ['.so', '.pb']
@@ -239,38 +702,134 @@ def run(model, config_file, port=80, threshold=0.5):
             Only .pb(protocol buffer) or .so(shared object) file is supported.
             """ % (filename, file_extension))
 
-    if file_extension == '.so':  # Shared library
-        nn = NNLib()
-        nn.load(model)
+    def result_encoder():
+        if result_encoding == "json":
+            return None
+        thumbnail = Thumbnailer(thumbnail_width) if thumbnail_width else None
+        return CompactResultEncoder(result_encoding, thumbnail=thumbnail)
 
-    elif file_extension == '.pb':  # Protocol Buffer file
-        # only load tensorflow if user wants to use GPU
-        from lmnet.tensorflow_graph_runner import TensorflowGraphRunner
-        nn = TensorflowGraphRunner(model)
+    # Fail before starting anything if the encoding isn't available.
+    result_encoder()
 
-    nn = NNLib()
-    nn.load(model)
-    nn.init()
+    if camera_resolution == "model":
+        # Only meta.yaml is read up front, the network loads meanwhile.
+        camera_height, camera_width = load_yaml(config_file).IMAGE_SIZE
+    else:
+        camera_width, camera_height = camera_resolution
+    camera_settings = {
+        "width": camera_width,
+        "height": camera_height,
+        "fps": camera_fps,
+        "pixel_format": camera_format,
+    }
 
-    config = load_yaml(config_file)
-    config = _update_exclude_score_box_threshold(config, threshold)
+    # The streams start right away with the camera images, and get
+    # inference results once the model is loaded in the background. A model
+    # pushed to the device later is loaded the same way, then swapped in.
+    load_model = partial(
+        _load_model, model, config_file, threshold,
+        [camera_height, camera_width],
+        fused_pre_process=fused_pre_process,
+        fused_post_process=fused_post_process,
+    )
+    loader = threading.Thread(
+        target=_install_model, args=(load_model, ), name="model_loader",
+    )
+    loader.daemon = True
+    loader.start()
+    watcher = None
+    if model_watch_interval:
+        watcher = ModelWatcher(
+            [model, config_file],
+            partial(_install_model, partial(load_model, reload=True)),
+            interval=model_watch_interval,
+        )
+        watcher.start()
 
-    pre_process = build_pre_process(config.PRE_PROCESSOR)
-    post_process = build_post_process(config.POST_PROCESSOR)
+    # Results wait on disk rather than in memory if a store is given, so
+    # those not delivered yet survive an outage of the broker or a restart.
+    store = None
+    if result_store_path:
+        store = ResultStore(result_store_path, max_bytes=result_store_size)
 
-    pool = Pool(processes=1, initializer=_init_camera)
-    gg_pool = Pool(processes=1, initializer=_init_gg_client)
+    # Creating a greengrass core sdk client
+    publisher = ResultPublisher(
+        greengrasssdk.client('iot-data'),
+        max_queue=publish_queue_size, max_batch=publish_batch_size,
+        store=store, max_rate=publish_rate,
+    )
+    publisher.start()
+
+    # Clips of warnings are cut from a ring buffer of each stream's encoded
+    # frames and written by one background thread.
+    if clip_dir:
+        clip_writer = ClipWriter(clip_dir, max_bytes=clip_disk_limit)
+        clip_writer.start()
+
+    # A single pipeline per camera serves all of its clients, so the number
+    # of open streams doesn't multiply camera reads, inference or encoding.
+    # Each stage runs in its own thread and keeps only the newest frame
+    # waiting. Every captured frame is streamed, while the schedulers hand
+    # some of them over to one inference pipeline, which runs the frames of
+    # all cameras as one batch if the model takes it.
+    metrics = StageMetrics(METRIC_STAGES)
+    ready = threading.Event()
+    streams = [
+        _Stream(
+            index, source,
+            InferenceScheduler(
+                interval=inference_interval, target_fps=target_fps,
+                latency_budget=latency_budget,
+                max_interval=max_inference_interval, ready=ready,
+            ),
+            JpegEncoder(
+                quality=jpeg_quality, subsampling=jpeg_subsampling,
+                backend=jpeg_backend,
+            ),
+            recorder=ClipRecorder(
+                clip_writer, "camera{}".format(index),
+                pre_seconds=clip_pre_seconds,
+                post_seconds=clip_post_seconds, max_bytes=clip_buffer_size,
+            ) if clip_writer is not None else None,
+            # Its thumbnail encoder is used by the stream's thread only.
+            result_encoder=result_encoder(),
+        )
+        for index, source in enumerate(camera_sources)
+    ]
+    collector = BatchCollector(
+        [stream.scheduler for stream in streams], ready,
+    )
+    inference_pipeline = Pipeline([
+        ("schedule", collector.next_batch),
+        ("pre", _preprocess),
+        ("nn", _infer),
+        ("post", _postprocess),
+    ], metrics=metrics)
+    for stream in streams:
+        stream.open(camera_backend, camera_settings)
+
+    inference_pipeline.start()
+    for stream in streams:
+        stream.pipeline.start()
 
     try:
-        server = HTTPServer(('', port), MotionJpegHandler)
+        server = ThreadedHTTPServer(
+            ('', port), MotionJpegHandler,
+            max_clients=max_clients, client_timeout=client_timeout,
+        )
         print("server starting")
         server.serve_forever()
     except KeyboardInterrupt:
         print("KeyboardInterrpt in server - ending server")
-        vc.release()
-        pool.terminate()
-        pool.join()
-        gg_pool.terminate()
-        gg_pool.join()
+        if watcher is not None:
+            watcher.stop()
+        for stream in streams:
+            stream.close()
+        inference_pipeline.stop()
+        publisher.stop()
+        if store is not None:
+            store.close()
+        if clip_writer is not None:
+            clip_writer.stop()
         server.socket.close()
         server.shutdown()
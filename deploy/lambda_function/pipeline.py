@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Threaded frame processing pipeline with bounded drop-oldest queues."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+from collections import deque
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Frame(object):
+    """A camera frame and everything computed from it along the pipeline.
+
+    Stages add their results as attributes (e.g. `data`, `result`, `image`,
+    `jpeg`), so each stage only needs to know what its predecessors produce.
+
+    Args:
+        sequence (int): Frame number.
+        image (np.ndarray): Captured RGB image.
+        release (callable): Called once when `image` is no longer used,
+            e.g. to hand a shared buffer back to the camera.
+
+    """
+
+    def __init__(self, sequence, image, release=None):
+        self.sequence = sequence
+        self.image = image
+        self.captured_at = time.time()
+        self._release = release
+
+    def release(self):
+        """Give the image buffer back. Calling it again does nothing."""
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def share(self):
+        """Return a new frame of the same image, e.g. for inference.
+
+        The image isn't copied: its buffer is given back once this frame
+        and every frame sharing it are released.
+        """
+        if self._release is not None and \
+                not isinstance(self._release, _SharedRelease):
+            self._release = _SharedRelease(self._release)
+        if self._release is not None:
+            self._release.retain()
+        frame = Frame(self.sequence, self.image, release=self._release)
+        frame.captured_at = self.captured_at
+        return frame
+
+
+class _SharedRelease(object):
+    """Call `release` once all of the frames sharing a buffer are released."""
+
+    def __init__(self, release):
+        self._release = release
+        self._count = 1
+        self._lock = threading.Lock()
+
+    def retain(self):
+        with self._lock:
+            self._count += 1
+
+    def __call__(self):
+        with self._lock:
+            self._count -= 1
+            released = self._count == 0
+        if released:
+            self._release()
+
+
+class DropOldestQueue(object):
+    """Bounded FIFO queue whose `put` never blocks.
+
+    When the queue is full the oldest item is discarded, so a slow consumer
+    always works on the most recent data and never stalls its producer.
+
+    Args:
+        maxsize (int): Capacity of the queue.
+        on_drop (callable): Called with each discarded item.
+
+    """
+
+    def __init__(self, maxsize=1, on_drop=None):
+        self._items = deque()
+        self.maxsize = maxsize
+        self._on_drop = on_drop
+        self._condition = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """Append an item, discarding the oldest one if the queue is full."""
+        dropped = None
+        with self._condition:
+            if len(self._items) >= self.maxsize:
+                dropped = self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+        if dropped is not None and self._on_drop is not None:
+            self._on_drop(dropped)
+
+    def get(self, timeout=None):
+        """Pop the oldest item.
+
+        Args:
+            timeout (float): Seconds to wait at most, None to wait forever.
+
+        Returns:
+            The item, or None on timeout or after close.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while not self._items and not self._closed:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def close(self):
+        """Wake up all consumers; `get` returns None once drained."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class RateMeter(object):
+    """Exponentially weighted moving average of an event rate."""
+
+    def __init__(self, alpha=0.1):
+        self._alpha = alpha
+        self._last = None
+        self._interval = None
+
+    def tick(self):
+        now = time.time()
+        if self._last is not None:
+            interval = now - self._last
+            if self._interval is None:
+                self._interval = interval
+            else:
+                self._interval += self._alpha * (interval - self._interval)
+        self._last = now
+
+    @property
+    def rate(self):
+        if not self._interval:
+            return 0.0
+        return 1.0 / self._interval
+
+
+class Stage(object):
+    """Run `func` on every item of an input queue in a dedicated thread.
+
+    `func` takes a frame and returns the frame to be passed to the output
+    queue, or None to drop it. A stage without an input queue is a source:
+    `func` is called with no argument and returns new frames. Frames that
+    are dropped, fail, or leave the last stage are released.
+
+    Args:
+        name (str): Stage name used for statistics and logging.
+        func (callable): Work done for each frame.
+        input_queue (DropOldestQueue): Queue to read frames from.
+        output_queue (DropOldestQueue): Queue to write frames to.
+        alpha (float): Smoothing factor of the latency moving average.
+        metrics (metrics.StageMetrics): Records the latency of every frame
+            under the stage name.
+
+    """
+
+    def __init__(self, name, func, input_queue=None, output_queue=None,
+                 alpha=0.1, metrics=None):
+        self.name = name
+        self.latency = 0.0
+        self._metrics = metrics
+        self._func = func
+        self._input_queue = input_queue
+        self._output_queue = output_queue
+        self._alpha = alpha
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            args = ()
+            frame = None
+            if self._input_queue is not None:
+                frame = self._input_queue.get(timeout=0.5)
+                if frame is None:
+                    continue
+                args = (frame, )
+
+            start = time.time()
+            try:
+                output = self._func(*args)
+            except Exception as e:
+                logger.error(
+                    "Failed in stage {}: {!r}".format(self.name, e)
+                )
+                output = None
+            elapsed = time.time() - start
+            self.latency += self._alpha * (elapsed - self.latency)
+            if self._metrics is not None:
+                self._metrics.observe(self.name, elapsed)
+
+            if output is None:
+                if frame is not None:
+                    frame.release()
+            elif self._output_queue is not None:
+                self._output_queue.put(output)
+            else:
+                output.release()
+
+
+def _release_frame(frame):
+    frame.release()
+
+
+class Pipeline(object):
+    """Chain of stages connected by bounded drop-oldest queues.
+
+    Each stage works in its own thread, so e.g. the accelerator can run
+    inference on frame N while the CPU draws frame N-1 and encodes N-2.
+    The first stage is a source; the output of the last stage is dropped.
+
+    Args:
+        stages (list): (name, func) tuples in processing order.
+        queue_size (int): Capacity of each queue between two stages.
+        metrics (metrics.StageMetrics): Records the latency of every stage.
+
+    """
+
+    def __init__(self, stages, queue_size=1, metrics=None):
+        self.queues = []
+        self.stages = []
+        self._meter = RateMeter()
+        input_queue = None
+        for i, (name, func) in enumerate(stages):
+            output_queue = None
+            if i < len(stages) - 1:
+                output_queue = DropOldestQueue(
+                    queue_size, on_drop=_release_frame,
+                )
+                self.queues.append(output_queue)
+            else:
+                func = self._metered(func)
+            self.stages.append(Stage(
+                name, func, input_queue, output_queue, metrics=metrics,
+            ))
+            input_queue = output_queue
+
+    def _metered(self, func):
+        def wrapper(frame):
+            frame = func(frame)
+            self._meter.tick()
+            return frame
+        return wrapper
+
+    @property
+    def fps(self):
+        """Frames per second leaving the last stage."""
+        return self._meter.rate
+
+    def latencies(self):
+        """Return a list of (stage name, moving average seconds) tuples."""
+        return [(stage.name, stage.latency) for stage in self.stages]
+
+    def dropped(self):
+        """Return a list of (stage name, frames dropped before it) tuples."""
+        return [
+            (stage.name, queue.dropped)
+            for stage, queue in zip(self.stages[1:], self.queues)
+        ]
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+        for queue in self.queues:
+            queue.close()
+        for stage in self.stages:
+            stage.join()
+        for queue in self.queues:
+            while True:
+                frame = queue.get(timeout=0)
+                if frame is None:
+                    break
+                frame.release()
+
+    @property
+    def max_frames_in_flight(self):
+        """Upper bound of frames held by the stages and queues at once."""
+        return len(self.stages) + sum(q.maxsize for q in self.queues)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Pre- and post-processors of a model, as the inference server runs them.
+
+Shared by the server and `benchmark_server.py`, so the benchmark measures
+the same processors. `config` is the module of the Blueoil output's python
+directory, which must be on the path.
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import numpy as np
+
+from fused_post_process import compile_post_process
+from fused_pre_process import (
+    compile_pre_process,
+    FusedPreProcess,
+    RESIZE_PRE_PROCESSORS,
+)
+
+
+def without_resize(pre_processors):
+    return [
+        processor for processor in pre_processors or []
+        if not any(name in processor for name in RESIZE_PRE_PROCESSORS)
+    ]
+
+
+def build_processors(config, camera_size, fused_pre_process=True,
+                     fused_post_process=True):
+    """Build the processors of a model's meta.yaml.
+
+    Args:
+        config: Loaded meta.yaml.
+        camera_size (list): [height, width] of the camera frames.
+        fused_pre_process (bool): Run common pre-processor chains as one
+            fused routine, others through Blueoil.
+        fused_post_process (bool): Same for post-processor chains.
+
+    Returns:
+        tuple: The pre-process and post-process callables.
+
+    """
+    from config import build_post_process, build_pre_process
+
+    pre_processors = config.PRE_PROCESSOR
+    if list(camera_size) == list(config.IMAGE_SIZE):
+        # Frames are captured, resized and converted to RGB at the model's
+        # size in one go, so resizing them again would just copy them.
+        pre_processors = without_resize(pre_processors)
+    pre_process = None
+    if fused_pre_process:
+        pre_process = compile_pre_process(pre_processors)
+    if pre_process is None:
+        pre_process = build_pre_process(pre_processors)
+    post_process = None
+    if fused_post_process:
+        post_process = compile_post_process(config.POST_PROCESSOR)
+    if post_process is None:
+        post_process = build_post_process(config.POST_PROCESSOR)
+    return pre_process, post_process
+
+
+def pre_process_images(pre_process, images):
+    """Pre-process images into one input array of the model.
+
+    Returns:
+        np.ndarray: Inputs of shape [num_images, ...].
+
+    """
+    if not isinstance(pre_process, FusedPreProcess):
+        return np.stack([
+            pre_process(image=image)["image"] for image in images
+        ])
+    # Write each image straight into its slot of the model's input.
+    shape = pre_process.output_shape(images[0].shape)
+    data = np.empty((len(images), ) + shape, pre_process.dtype)
+    for image, out in zip(images, data):
+        pre_process(image=image, out=out)
+    return data
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Bounded, batched publishing of inference results to AWS IoT Greengrass."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+from collections import deque
+from datetime import datetime
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+KINESIS_TOPIC = "kinesisfirehose/message"
+# Batch request topic of the Kinesis Firehose connector, up to 500 records.
+KINESIS_BATCH_TOPIC = "kinesisfirehose/message/batch"
+RESULT_TOPIC = "inference/result"
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class ResultPublisher(object):
+    """Publish inference results from a background thread.
+
+    Results wait in a bounded in-memory queue. When it is full, either the
+    oldest queued result or the new one is dropped, so a burst of warnings
+    or a broker outage can't grow memory without limit. The worker sends
+    the queued results in micro-batches: one Kinesis Firehose batch request
+    per batch, followed by one 'inference/result' message per result. Each
+    publish is retried with exponential backoff. `sent` and `failed` count
+    results by the outcome of their Kinesis Firehose request.
+
+    With a `store`, results are queued on disk instead (store and forward):
+    its limits apply rather than `max_queue` and `policy`, and a result is
+    only deleted from it once its Kinesis Firehose request is delivered.
+    A failed batch stays first in line and is tried again after
+    `max_backoff`, so `failed` counts attempts. Results left on stop are
+    sent once a publisher is started again on the same store.
+
+    Args:
+        client: Greengrass 'iot-data' client, or any object having the same
+            `publish(topic=..., payload=...)` method.
+        max_queue (int): Maximum number of results waiting to be sent.
+        max_batch (int): Maximum number of results sent in one batch.
+        linger (float): Seconds to wait for more results before sending a
+            batch that isn't full.
+        policy (str): "drop_oldest" or "drop_newest" when the queue is full.
+        retries (int): Retries of a failed publish call.
+        backoff (float): Seconds to wait before the first retry, doubled
+            for every further retry up to `max_backoff`.
+        max_backoff (float): Upper bound of the wait between retries.
+        store (result_store.ResultStore): Persistent queue, None to queue
+            results in memory.
+        max_rate (float): Maximum number of results sent per second, None
+            for no limit.
+
+    """
+
+    def __init__(self, client, max_queue=100, max_batch=10, linger=0.5,
+                 policy=DROP_OLDEST, retries=3, backoff=0.5, max_backoff=8.0,
+                 store=None, max_rate=None):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown drop policy: " + policy)
+        self.client = client
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.linger = linger
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_rate = max_rate
+
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._queue = deque()
+        self._store = store
+        self._next_send = 0.0
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="publisher")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the worker after it has sent what is already queued."""
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def submit(self, json_obj):
+        """Queue a result without waiting for the broker.
+
+        Args:
+            json_obj (str): Inference result serialized by `JsonOutput`, or
+                encoded by `result_format.CompactResultEncoder`.
+
+        Returns:
+            bool: False if the result was dropped instead.
+
+        """
+        if self._store is not None:
+            evicted = self._store.put(json_obj)
+            with self._condition:
+                self.dropped += evicted
+                self.queued += 1
+                self._condition.notify()
+            return True
+        with self._condition:
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                self._queue.popleft()
+            self._queue.append(json_obj)
+            self.queued += 1
+            self._condition.notify()
+        return True
+
+    def stats(self):
+        """Return the counters as a dict."""
+        with self._condition:
+            pending = self._pending()
+        return {
+            "queued": self.queued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "pending": pending,
+        }
+
+    def _pending(self):
+        if self._store is not None:
+            return len(self._store)
+        return len(self._queue)
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending() and not self._stop_event.is_set():
+                self._condition.wait(1.0)
+            if not self._pending():
+                return []
+            # Give a burst the chance to fill up the batch.
+            deadline = time.time() + self.linger
+            while self._pending() < self.max_batch \
+                    and not self._stop_event.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            if self._store is not None:
+                return self._store.peek(self.max_batch)
+            count = min(self.max_batch, len(self._queue))
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _loop(self):
+        while True:
+            if self._store is not None and self._stop_event.is_set():
+                # What's left is kept on disk for the next start.
+                return
+            batch = self._next_batch()
+            if not batch:
+                if self._stop_event.is_set():
+                    return
+                continue
+            self._throttle(len(batch))
+            logger.info("Publish {} result(s)".format(len(batch)))
+            if self._store is None:
+                self._send(batch)
+                continue
+            if self._send([payload for _, payload in batch]):
+                self._store.delete([row_id for row_id, _ in batch])
+            else:
+                # Kept first in line until the broker is reachable again.
+                self._stop_event.wait(self.max_backoff)
+
+    def _throttle(self, count):
+        """Wait so that no more than `max_rate` results are sent a second."""
+        if not self.max_rate:
+            return
+        now = time.time()
+        if self._next_send > now:
+            self._stop_event.wait(self._next_send - now)
+        self._next_send = max(now, self._next_send) + count / self.max_rate
+
+    def _send(self, batch):
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        if len(batch) == 1:
+            kinesis_topic = KINESIS_TOPIC
+            request = {"data": batch[0]}
+        else:
+            kinesis_topic = KINESIS_BATCH_TOPIC
+            request = {"data_list": batch}
+        kinesis_message = {
+            "request": request,
+            "id": timestamp,
+        }
+        delivered = self._publish(kinesis_topic, json.dumps(kinesis_message))
+        # Stored results are sent again with their next attempt.
+        if delivered or self._store is None:
+            for json_obj in batch:
+                self._publish(RESULT_TOPIC, json_obj)
+        if delivered:
+            self.sent += len(batch)
+        else:
+            self.failed += len(batch)
+        return delivered
+
+    def _publish(self, topic, payload):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self.client.publish(topic=topic, payload=payload)
+                return True
+            except Exception as e:
+                logger.error(
+                    "Failed to publish message to {}: {!r}".format(topic, e)
+                )
+            if attempt == self.retries or self._stop_event.is_set():
+                return False
+            self._stop_event.wait(delay)
+            delay = min(delay * 2, self.max_backoff)
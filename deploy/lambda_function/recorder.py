@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Recording of video clips around warnings to local disk."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+from collections import deque
+from datetime import datetime
+import logging
+import os
+from Queue import Full, Queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+CLIP_EXTENSION = ".mjpg"
+PARTIAL_EXTENSION = ".part"
+
+
+class ClipWriter(object):
+    """Write clips to local disk from a background thread.
+
+    A clip is a raw Motion JPEG file, the JPEG frames of the video stream
+    one after another, which VLC or `ffmpeg -f mjpeg` can play. Once the
+    clips in `directory` take more than `max_bytes`, the oldest ones are
+    deleted, including those of earlier runs. At most `max_pending` clips
+    wait to be written; further ones are dropped rather than holding
+    frames in memory while the disk is slow.
+
+    Args:
+        directory (str): Directory of the clips, created if missing.
+        max_bytes (int): Disk space all clips may take.
+        max_pending (int): Maximum number of clips waiting to be written.
+
+    """
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024, max_pending=4):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.dropped = 0
+        self.evicted = 0
+        self._clips = deque()
+        self._total_bytes = 0
+        self._queue = Queue(max_pending)
+        self._thread = threading.Thread(target=self._loop, name="clip_writer")
+        self._thread.daemon = True
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        clips = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(PARTIAL_EXTENSION):
+                # Left over by a run stopped in the middle of a write.
+                os.remove(path)
+            elif name.endswith(CLIP_EXTENSION):
+                clips.append((os.path.getmtime(path), path))
+        for _, path in sorted(clips):
+            self._add(path)
+        self._evict()
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the worker after it has written the clips already queued."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def submit(self, path, frames):
+        """Queue a clip without blocking.
+
+        Args:
+            path (str): File to write the clip to.
+            frames (list): JPEG data of each frame.
+
+        Returns:
+            bool: False if the clip was dropped instead.
+
+        """
+        try:
+            self._queue.put_nowait((path, frames))
+        except Full:
+            self.dropped += 1
+            logger.warning("Clip writer is busy, dropped " + path)
+            return False
+        return True
+
+    def stats(self):
+        """Return the counters as a dict."""
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "evicted": self.evicted,
+            "bytes": self._total_bytes,
+        }
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, frames = item
+            try:
+                self._write(path, frames)
+            except (IOError, OSError) as e:
+                self.dropped += 1
+                logger.error("Failed to write {}: {!r}".format(path, e))
+                continue
+            self.written += 1
+            logger.info("Wrote {} frames to {}".format(len(frames), path))
+            self._evict()
+
+    def _write(self, path, frames):
+        # Written aside first, so a clip on disk is always complete.
+        partial_path = path + PARTIAL_EXTENSION
+        with open(partial_path, "wb") as f:
+            for jpeg in frames:
+                f.write(jpeg)
+        os.rename(partial_path, path)
+        self._add(path)
+
+    def _add(self, path):
+        size = os.path.getsize(path)
+        self._clips.append((path, size))
+        self._total_bytes += size
+
+    def _evict(self):
+        while self._clips and self._total_bytes > self.max_bytes:
+            path, size = self._clips.popleft()
+            self._total_bytes -= size
+            self.evicted += 1
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Failed to remove {}: {!r}".format(path, e))
+
+
+class ClipRecorder(object):
+    """Keep the recent frames of a stream and cut clips around warnings.
+
+    Encoded frames wait in a ring buffer, which drops those older than
+    `pre_seconds` and never holds more than `max_bytes`, so its memory is
+    fixed whatever the frame rate and quality. A trigger turns the buffered
+    frames into the start of a clip, the frames of the next `post_seconds`
+    are appended to it, and the clip is then handed over to the writer.
+    Both calls only move references to the frames around, so the stream
+    doesn't wait for the disk.
+
+    Args:
+        writer (ClipWriter): Writes finished clips.
+        name (str): Prefix of the clip file names.
+        pre_seconds (float): Seconds recorded before the trigger.
+        post_seconds (float): Seconds recorded after the trigger.
+        max_bytes (int): Maximum size of the ring buffer and of a clip.
+
+    """
+
+    def __init__(self, writer, name, pre_seconds=5.0, post_seconds=5.0,
+                 max_bytes=8 * 1024 * 1024):
+        self.writer = writer
+        self.name = name
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_bytes = max_bytes
+        self._buffer = deque()
+        self._buffer_bytes = 0
+        self._clip = None
+        self._clip_path = None
+        self._clip_bytes = 0
+        self._clip_end = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, jpeg, timestamp):
+        """Buffer an encoded frame of the stream.
+
+        Args:
+            jpeg (bytes): JPEG data of the frame.
+            timestamp (float): UNIX time the frame was captured.
+
+        """
+        with self._lock:
+            self._buffer.append((timestamp, jpeg))
+            self._buffer_bytes += len(jpeg)
+            oldest = timestamp - self.pre_seconds
+            while self._buffer and (self._buffer_bytes > self.max_bytes
+                                    or self._buffer[0][0] < oldest):
+                _, dropped = self._buffer.popleft()
+                self._buffer_bytes -= len(dropped)
+
+            if self._clip is None:
+                return
+            self._clip.append(jpeg)
+            self._clip_bytes += len(jpeg)
+            if timestamp < self._clip_end and \
+                    self._clip_bytes < self.max_bytes:
+                return
+            path, clip = self._clip_path, self._clip
+            self._clip = None
+        self.writer.submit(path, clip)
+
+    def trigger(self, timestamp):
+        """Start a clip, unless one is being recorded already.
+
+        Args:
+            timestamp (float): UNIX time of the event.
+
+        Returns:
+            str: Path the clip is going to be written to.
+
+        """
+        with self._lock:
+            if self._clip is None:
+                name = "{}_{}{}".format(
+                    self.name,
+                    datetime.fromtimestamp(timestamp).strftime(
+                        "%Y%m%d_%H%M%S_%f"
+                    ),
+                    CLIP_EXTENSION,
+                )
+                self._clip_path = os.path.join(self.writer.directory, name)
+                self._clip = [jpeg for _, jpeg in self._buffer]
+                self._clip_bytes = self._buffer_bytes
+                self._clip_end = timestamp + self.post_seconds
+            return self._clip_path
+
+    def flush(self):
+        """Hand the clip being recorded over to the writer as it is."""
+        with self._lock:
+            path, clip = self._clip_path, self._clip
+            self._clip = None
+        if clip:
+            self.writer.submit(path, clip)
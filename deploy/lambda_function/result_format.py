@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Compact binary encoding of published inference results, and its decoder.
+
+A result is a document of a few fields, whose arrays are packed as
+little-endian float16 (boxes, scores) and uint8 (class ids, masks) bytes:
+
+    v          format version
+    task       index of the task in `TASKS`
+    time       UNIX time the image was captured
+    size       [height, width] of the image, boxes are in its pixels
+    classes    class names of the model
+    class_ids  class of each box (object detection)
+    boxes      [x, y, w, h] of each box (object detection)
+    scores     score of each box, or of each class (classification)
+    mask       zlib compressed class of each pixel (semantic segmentation)
+    clip       path of the clip recorded on the device, if any
+    thumbnail  JPEG thumbnail of the image, if any
+
+It is framed with a fixed binary layout needing nothing beyond the
+standard library, or with msgpack or CBOR if those libraries are
+installed, and published as one line of base64 text, so the records
+Kinesis Firehose concatenates into one S3 object can be split again.
+
+Decode S3 objects or `inference/result` messages on the cloud side with:
+
+    python result_format.py [file ...] > results.jsonl
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import argparse
+import base64
+from datetime import datetime
+import io
+import json
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+VERSION = 1
+
+TASKS = (
+    "IMAGE.CLASSIFICATION",
+    "IMAGE.OBJECT_DETECTION",
+    "IMAGE.SEMANTIC_SEGMENTATION",
+)
+CLASSIFICATION, OBJECT_DETECTION, SEMANTIC_SEGMENTATION = range(len(TASKS))
+
+FRAMING_BINARY = "binary"
+FRAMING_MSGPACK = "msgpack"
+FRAMING_CBOR = "cbor"
+
+FLOAT_DTYPE = np.dtype("<f2")
+
+# Binary framing: a fixed header, then each field of `_FIELDS` prefixed
+# with its length, 0 for a missing one.
+_MAGIC = b"BG"
+_HEADER = struct.Struct("<2sBBdHH")
+_LENGTH = struct.Struct("<I")
+_FIELDS = (
+    "classes", "clip", "class_ids", "boxes", "scores", "mask", "thumbnail",
+)
+_TEXT_FIELDS = ("classes", "clip")
+
+
+def _class_dtype(num_classes):
+    return np.dtype("u1" if num_classes <= 256 else "<u2")
+
+
+def _resize_nearest(array, height, width):
+    rows = np.arange(height) * array.shape[0] // height
+    columns = np.arange(width) * array.shape[1] // width
+    return array[rows[:, np.newaxis], columns]
+
+
+class CompactResultEncoder(object):
+    """Encode inference results into compact base64 records.
+
+    Args:
+        framing (str): "binary", "msgpack" or "cbor".
+        thumbnail (callable): Returns JPEG data of an RGB image, e.g.
+            `encoder.Thumbnailer`, None to leave the image out.
+
+    """
+
+    def __init__(self, framing=FRAMING_BINARY, thumbnail=None):
+        if framing not in (FRAMING_BINARY, FRAMING_MSGPACK, FRAMING_CBOR):
+            raise ValueError("Unknown result framing: " + framing)
+        if framing == FRAMING_MSGPACK and msgpack is None:
+            raise ValueError("msgpack framing needs the msgpack package")
+        if framing == FRAMING_CBOR and cbor2 is None:
+            raise ValueError("cbor framing needs the cbor2 package")
+        self.framing = framing
+        self.thumbnail = thumbnail
+
+    def encode(self, config, result, image, timestamp, clip=None):
+        """Encode the result of one image.
+
+        Args:
+            config: Model configuration read from meta.yaml.
+            result (np.ndarray): Post-processed output of the image.
+            image (np.ndarray): RGB image the result was inferred from.
+            timestamp (float): UNIX time the image was captured.
+            clip (str): Path of the clip recorded for the result.
+
+        Returns:
+            str: One line of base64 text.
+
+        """
+        document = self.document(config, result, image, timestamp)
+        if clip:
+            document["clip"] = clip
+        if self.thumbnail is not None:
+            document["thumbnail"] = self.thumbnail(image)
+        return base64.b64encode(
+            pack(document, self.framing)
+        ).decode("ascii") + "\n"
+
+    def document(self, config, result, image, timestamp):
+        """Return the fields of a result, before framing."""
+        if config.TASK not in TASKS:
+            raise ValueError("Unsupported task: " + config.TASK)
+        task = TASKS.index(config.TASK)
+        height, width = image.shape[:2]
+        class_dtype = _class_dtype(len(config.CLASSES))
+        document = {
+            "v": VERSION,
+            "task": task,
+            "time": timestamp,
+            "size": [height, width],
+            # Text even if YAML gave byte strings, for msgpack and CBOR.
+            "classes": ["{}".format(name) for name in config.CLASSES],
+        }
+        result = np.asarray(result)
+        if task == OBJECT_DETECTION:
+            boxes = result.reshape(-1, 6)
+            # Boxes are in pixels of the model input, like `JsonOutput`
+            # scale them to the pixels of the image.
+            model_height, model_width = config.IMAGE_SIZE
+            scale = np.array([
+                width / model_width, height / model_height,
+            ] * 2, dtype=np.float32)
+            document["boxes"] = (boxes[:, :4] * scale).astype(
+                FLOAT_DTYPE
+            ).tobytes()
+            document["class_ids"] = boxes[:, 4].astype(class_dtype).tobytes()
+            document["scores"] = boxes[:, 5].astype(FLOAT_DTYPE).tobytes()
+        elif task == CLASSIFICATION:
+            document["scores"] = result.reshape(-1).astype(
+                FLOAT_DTYPE
+            ).tobytes()
+        else:
+            mask = _resize_nearest(
+                np.argmax(result, axis=-1).astype(class_dtype),
+                height, width,
+            )
+            document["mask"] = zlib.compress(mask.tobytes(), 1)
+        return document
+
+
+def pack(document, framing=FRAMING_BINARY):
+    """Frame a result document into bytes."""
+    if framing == FRAMING_MSGPACK:
+        return msgpack.packb(document, use_bin_type=True)
+    if framing == FRAMING_CBOR:
+        return cbor2.dumps(document)
+    height, width = document["size"]
+    parts = [_HEADER.pack(
+        _MAGIC, document["v"], document["task"], document["time"],
+        height, width,
+    )]
+    for name in _FIELDS:
+        if name == "classes":
+            value = "\n".join(document[name]).encode("utf-8")
+        elif name in _TEXT_FIELDS:
+            value = document.get(name, "").encode("utf-8")
+        else:
+            value = document.get(name, b"")
+        parts.append(_LENGTH.pack(len(value)))
+        parts.append(value)
+    return b"".join(parts)
+
+
+def unpack(data):
+    """Parse the framing of a result, whichever it is, into its document."""
+    first = bytearray(data[:1])[0]
+    if data[:2] == _MAGIC:
+        return _unpack_binary(data)
+    # Documents are maps of fewer than 16 entries, whose first byte is
+    # 0x80 to 0x8f in msgpack and 0xa0 to 0xbf in CBOR.
+    if 0x80 <= first <= 0x8f:
+        if msgpack is None:
+            raise ValueError("Decoding msgpack needs the msgpack package")
+        return msgpack.unpackb(data, raw=False)
+    if 0xa0 <= first <= 0xbf:
+        if cbor2 is None:
+            raise ValueError("Decoding CBOR needs the cbor2 package")
+        return cbor2.loads(data)
+    raise ValueError("Unknown result framing")
+
+
+def _unpack_binary(data):
+    _, version, task, timestamp, height, width = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("Unsupported result version: {}".format(version))
+    document = {
+        "v": version,
+        "task": task,
+        "time": timestamp,
+        "size": [height, width],
+    }
+    offset = _HEADER.size
+    for name in _FIELDS:
+        length, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        value = data[offset:offset + length]
+        offset += length
+        if name in _TEXT_FIELDS:
+            value = value.decode("utf-8")
+        if name == "classes":
+            value = value.split("\n") if value else []
+        if value or name == "classes":
+            document[name] = value
+    return document
+
+
+def decode_result(record):
+    """Decode a record into the structure of `JsonOutput`'s results.
+
+    Args:
+        record (str): Base64 text published by `CompactResultEncoder`.
+
+    Returns:
+        dict: "task", "date", "classes", "image_size" and "results",
+            the prediction of the image, plus "clip" and "thumbnail"
+            (JPEG data) if present. Predictions of object detection are
+            lists of {"class": {"id", "name"}, "box", "score"}, those of
+            classification lists of {"class", "probability"}, and those of
+            semantic segmentation a [height, width] array of class ids.
+
+    """
+    if not isinstance(record, bytes):
+        record = record.encode("ascii")
+    document = unpack(base64.b64decode(record.strip()))
+    if document["v"] != VERSION:
+        raise ValueError(
+            "Unsupported result version: {}".format(document["v"])
+        )
+    task = document["task"]
+    classes = document["classes"]
+    height, width = document["size"]
+    class_dtype = _class_dtype(len(classes))
+
+    def class_of(class_id):
+        return {"id": int(class_id), "name": classes[class_id]}
+
+    if task == OBJECT_DETECTION:
+        boxes = np.frombuffer(
+            document.get("boxes", b""), dtype=FLOAT_DTYPE
+        ).reshape(-1, 4)
+        class_ids = np.frombuffer(
+            document.get("class_ids", b""), dtype=class_dtype
+        )
+        scores = np.frombuffer(document.get("scores", b""), dtype=FLOAT_DTYPE)
+        prediction = [
+            {
+                "class": class_of(class_id),
+                "box": [float(value) for value in box],
+                "score": float(score),
+            }
+            for box, class_id, score in zip(boxes, class_ids, scores)
+        ]
+    elif task == CLASSIFICATION:
+        scores = np.frombuffer(document["scores"], dtype=FLOAT_DTYPE)
+        prediction = [
+            {"class": class_of(class_id), "probability": float(score)}
+            for class_id, score in enumerate(scores)
+        ]
+    elif task == SEMANTIC_SEGMENTATION:
+        prediction = np.frombuffer(
+            zlib.decompress(document["mask"]), dtype=class_dtype
+        ).reshape(height, width)
+    else:
+        raise ValueError("Unknown task: {}".format(task))
+
+    decoded = {
+        "task": TASKS[task],
+        "date": datetime.fromtimestamp(document["time"]).isoformat(),
+        "classes": classes,
+        "image_size": [height, width],
+        "results": [{"prediction": prediction}],
+    }
+    for name in ("clip", "thumbnail"):
+        if name in document:
+            decoded[name] = document[name]
+    return decoded
+
+
+def decode_records(text):
+    """Decode the records of an S3 object or message, one per line."""
+    for line in text.splitlines():
+        if line.strip():
+            yield decode_result(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Decode compact inference results to JSON lines."
+    )
+    parser.add_argument(
+        "files", nargs="*",
+        help="S3 objects or messages of base64 records, stdin if none",
+    )
+    parser.add_argument(
+        "--thumbnail-dir",
+        help="write thumbnails there rather than as base64 in the JSON",
+    )
+    args = parser.parse_args()
+
+    texts = []
+    if not args.files:
+        texts.append(sys.stdin.read())
+    for path in args.files:
+        with io.open(path, encoding="ascii") as f:
+            texts.append(f.read())
+
+    count = 0
+    for text in texts:
+        for decoded in decode_records(text):
+            prediction = decoded["results"][0]["prediction"]
+            if isinstance(prediction, np.ndarray):
+                decoded["results"][0]["prediction"] = prediction.tolist()
+            thumbnail = decoded.get("thumbnail")
+            if thumbnail is not None and args.thumbnail_dir:
+                path = os.path.join(
+                    args.thumbnail_dir, "{:06d}.jpg".format(count)
+                )
+                with open(path, "wb") as f:
+                    f.write(thumbnail)
+                decoded["thumbnail"] = path
+            elif thumbnail is not None:
+                decoded["thumbnail"] = base64.b64encode(
+                    thumbnail
+                ).decode("ascii")
+            print(json.dumps(decoded))
+            count += 1
+
+
+if __name__ == "__main__":
+    main()
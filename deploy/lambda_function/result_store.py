@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Persistent on-device queue of inference results."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStore(object):
+    """FIFO queue of results kept in an SQLite database.
+
+    Results are written to disk as soon as they are put, and deleted only
+    once they have been delivered, so they survive a broker outage as well
+    as a restart of the Lambda function. Beyond `max_results` or
+    `max_bytes`, the oldest results are deleted. Pages freed by deleted
+    results are given back to the file system every `compact_every`
+    deletions, and whenever the queue gets empty.
+
+    Args:
+        path (str): Database file, created with its directory if missing.
+        max_results (int): Maximum number of results kept.
+        max_bytes (int): Maximum total size of the results kept.
+        compact_every (int): Deleted results between two compactions.
+
+    """
+
+    def __init__(self, path, max_results=100000, max_bytes=50 * 1024 * 1024,
+                 compact_every=1000):
+        self.path = path
+        self.max_results = max_results
+        self.max_bytes = max_bytes
+        self.compact_every = compact_every
+        self._deleted = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Transactions are explicit, the connection is shared by threads.
+        self._connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False,
+        )
+        self._execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._execute("PRAGMA journal_mode = WAL")
+        self._execute("PRAGMA synchronous = NORMAL")
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "payload TEXT NOT NULL, "
+            "size INTEGER NOT NULL)"
+        )
+        self._reload_counters()
+        if self._count:
+            logger.info("{} result(s) left to forward in {}".format(
+                self._count, path
+            ))
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        """Total size of the results kept."""
+        return self._bytes
+
+    def _execute(self, sql, parameters=()):
+        return self._connection.execute(sql, parameters)
+
+    def put(self, payload):
+        """Append a result, deleting the oldest ones beyond the limits.
+
+        Args:
+            payload (str): Serialized result.
+
+        Returns:
+            int: Number of results deleted to make room.
+
+        """
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+        size = len(payload)
+        with self._lock:
+            self._execute("BEGIN")
+            try:
+                self._execute(
+                    "INSERT INTO results (payload, size) VALUES (?, ?)",
+                    (payload, size),
+                )
+                self._count += 1
+                self._bytes += size
+                evicted = 0
+                while self._count > 1 and (
+                        self._count > self.max_results
+                        or self._bytes > self.max_bytes):
+                    row_id, row_size = self._execute(
+                        "SELECT id, size FROM results ORDER BY id LIMIT 1"
+                    ).fetchone()
+                    self._execute(
+                        "DELETE FROM results WHERE id = ?", (row_id, )
+                    )
+                    self._count -= 1
+                    self._bytes -= row_size
+                    evicted += 1
+                self._execute("COMMIT")
+            except Exception:
+                self._execute("ROLLBACK")
+                self._reload_counters()
+                raise
+        return evicted
+
+    def peek(self, count):
+        """Return up to `count` oldest results as (id, payload) tuples."""
+        with self._lock:
+            return self._execute(
+                "SELECT id, payload FROM results ORDER BY id LIMIT ?",
+                (count, ),
+            ).fetchall()
+
+    def delete(self, ids):
+        """Delete delivered results; those already evicted are skipped."""
+        with self._lock:
+            self._execute("BEGIN")
+            try:
+                for row_id in ids:
+                    row = self._execute(
+                        "SELECT size FROM results WHERE id = ?", (row_id, )
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    self._execute(
+                        "DELETE FROM results WHERE id = ?", (row_id, )
+                    )
+                    self._count -= 1
+                    self._bytes -= row[0]
+                    self._deleted += 1
+                self._execute("COMMIT")
+            except Exception:
+                self._execute("ROLLBACK")
+                self._reload_counters()
+                raise
+            if self._deleted >= self.compact_every or not self._count:
+                self._compact()
+
+    def _compact(self):
+        self._execute("PRAGMA incremental_vacuum").fetchall()
+        self._execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._deleted = 0
+
+    def _reload_counters(self):
+        self._count, self._bytes = self._execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -23,10 +23,10 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def _run(model, config_file, port, threshold, output_dir):
+def _run(model, config_file, port, threshold, output_dir, **kwargs):
     sys.path.append(os.path.join(output_dir, "python"))
     from motion_jpeg_server_custom import run
-    run(model, config_file, port=port, threshold=threshold)
+    run(model, config_file, port=port, threshold=threshold, **kwargs)
 
 
 def run_server():
@@ -37,8 +37,88 @@ def run_server():
     model = os.path.join(model_dir, "lib/libdlk_fpga.so")
     port = 8080
     threshold = float(os.getenv("BOX_SCORE_THRESHOLD", default=0.5))
+    max_clients = int(os.getenv("MAX_STREAM_CLIENTS", default=4))
+    client_timeout = float(os.getenv("CLIENT_WRITE_TIMEOUT", default=10.0))
+    camera_backend = os.getenv("CAMERA_BACKEND", default="shared_memory")
+    jpeg_quality = int(os.getenv("JPEG_QUALITY", default=85))
+    # 0: 4:4:4, 1: 4:2:2, 2: 4:2:0
+    jpeg_subsampling = int(os.getenv("JPEG_SUBSAMPLING", default=2))
+    jpeg_backend = os.getenv("JPEG_BACKEND", default="pillow")
+    publish_queue_size = int(os.getenv("PUBLISH_QUEUE_SIZE", default=100))
+    publish_batch_size = int(os.getenv("PUBLISH_BATCH_SIZE", default=10))
+    inference_interval = int(os.getenv("INFERENCE_INTERVAL", default=1))
+    # 0 disables the adaptive inference interval.
+    target_fps = float(os.getenv("TARGET_FPS", default=0))
+    latency_budget = float(os.getenv("LATENCY_BUDGET", default=0))
+    max_inference_interval = int(
+        os.getenv("MAX_INFERENCE_INTERVAL", default=30)
+    )
+    # Comma separated device numbers or paths, e.g. "0,1" or "/dev/video2".
+    camera_sources = [
+        int(source) if source.isdigit() else source
+        for source in os.getenv("CAMERA_SOURCES", default="0").split(",")
+    ]
+    # "[width]x[height]", or "model" for the image size of the model.
+    camera_resolution = os.getenv("CAMERA_RESOLUTION", default="320x240")
+    if camera_resolution != "model":
+        camera_resolution = tuple(
+            int(v) for v in camera_resolution.lower().split("x")
+        )
+    camera_fps = int(os.getenv("CAMERA_FPS", default=60))
+    # default, MJPG or YUYV
+    camera_format = os.getenv("CAMERA_FORMAT", default="default")
+    # 0 runs every pre- and post-processor through Blueoil.
+    fused_pre_process = bool(int(os.getenv("FUSED_PRE_PROCESS", default=1)))
+    fused_post_process = bool(
+        int(os.getenv("FUSED_POST_PROCESS", default=1))
+    )
+    # Unset or empty not to record clips of warnings.
+    clip_dir = os.getenv("CLIP_DIR")
+    clip_pre_seconds = float(os.getenv("CLIP_PRE_SECONDS", default=5.0))
+    clip_post_seconds = float(os.getenv("CLIP_POST_SECONDS", default=5.0))
+    clip_disk_limit = int(os.getenv("CLIP_DISK_LIMIT_MB", default=100))
+    clip_buffer_size = int(os.getenv("CLIP_BUFFER_MB", default=8))
+    # 0 disables reloading a model updated on the device.
+    model_watch_interval = float(
+        os.getenv("MODEL_WATCH_INTERVAL", default=10.0)
+    )
+    # Unset or empty to keep results waiting to be published in memory only.
+    result_store_path = os.getenv("RESULT_STORE_PATH")
+    result_store_size = int(os.getenv("RESULT_STORE_MB", default=50))
+    # 0 publishes results as fast as the broker takes them.
+    publish_rate = float(os.getenv("PUBLISH_RATE", default=0))
+    # "json" publishes the `JsonOutput` document of Blueoil, "binary",
+    # "msgpack" or "cbor" the compact encoding of `result_format`.
+    result_encoding = os.getenv("RESULT_ENCODING", default="json")
+    # 0 leaves the thumbnail out of compact results.
+    thumbnail_width = int(os.getenv("RESULT_THUMBNAIL_WIDTH", default=0))
     logger.info("Motion JPEG Server Start!")
-    _run(model, config_file, port, threshold, output_dir)
+    _run(
+        model, config_file, port, threshold, output_dir,
+        max_clients=max_clients, client_timeout=client_timeout,
+        camera_backend=camera_backend, jpeg_quality=jpeg_quality,
+        jpeg_subsampling=jpeg_subsampling, jpeg_backend=jpeg_backend,
+        publish_queue_size=publish_queue_size,
+        publish_batch_size=publish_batch_size,
+        inference_interval=inference_interval,
+        target_fps=target_fps or None,
+        latency_budget=latency_budget or None,
+        max_inference_interval=max_inference_interval,
+        camera_sources=camera_sources,
+        camera_resolution=camera_resolution, camera_fps=camera_fps,
+        camera_format=camera_format, fused_pre_process=fused_pre_process,
+        fused_post_process=fused_post_process, clip_dir=clip_dir,
+        clip_pre_seconds=clip_pre_seconds,
+        clip_post_seconds=clip_post_seconds,
+        clip_disk_limit=clip_disk_limit * 1024 * 1024,
+        clip_buffer_size=clip_buffer_size * 1024 * 1024,
+        model_watch_interval=model_watch_interval,
+        result_store_path=result_store_path,
+        result_store_size=result_store_size * 1024 * 1024,
+        publish_rate=publish_rate or None,
+        result_encoding=result_encoding,
+        thumbnail_width=thumbnail_width or None,
+    )
 
 
 run_server()
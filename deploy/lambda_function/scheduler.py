@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Adaptive scheduling of inference between streamed frames."""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import logging
+import math
+import threading
+import time
+
+from pipeline import DropOldestQueue, RateMeter, _release_frame
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceScheduler(object):
+    """Decide which streamed frames are sent to inference.
+
+    Every captured frame is streamed, but only every `interval`-th one is
+    handed to the inference pipeline, through a queue holding just the
+    newest frame, so inference never works on a stale one. Streamed frames
+    are overlaid with the latest result.
+
+    With `target_fps` or `latency_budget`, `interval` is adjusted once per
+    `update_period` from the measured stage times: it never asks for
+    inference more often than inference completes, and it grows while the
+    stream is slower than `target_fps` or later than `latency_budget`, to
+    free the CPU for drawing and encoding, and shrinks again otherwise.
+    Without either, `interval` stays fixed.
+
+    Args:
+        interval (int): Initial (or fixed) inference interval in frames.
+        target_fps (float): Display frame rate to keep, None to ignore.
+        latency_budget (float): Seconds from capture to stream to keep,
+            None to ignore.
+        max_interval (int): Upper bound of the interval.
+        update_period (float): Seconds between two interval adjustments.
+        ready (threading.Event): Set whenever a frame is chosen, so one
+            consumer can wait for the schedulers of several cameras.
+
+    """
+
+    def __init__(self, interval=1, target_fps=None, latency_budget=None,
+                 max_interval=30, update_period=1.0, ready=None):
+        self.interval = max(1, int(interval))
+        self.target_fps = target_fps
+        self.latency_budget = latency_budget
+        self.max_interval = max_interval
+        self.update_period = update_period
+        self.offered = 0
+        self.latency = 0.0
+        self._queue = DropOldestQueue(1, on_drop=_release_frame)
+        self._display_meter = RateMeter()
+        self._latest = None
+        self._lock = threading.Lock()
+        self._updated_at = time.time()
+        self._ready = ready
+
+    @property
+    def adaptive(self):
+        return bool(self.target_fps or self.latency_budget)
+
+    @property
+    def display_fps(self):
+        return self._display_meter.rate
+
+    @property
+    def dropped(self):
+        """Frames chosen for inference but replaced by a newer one."""
+        return self._queue.dropped
+
+    def offer(self, frame):
+        """Hand every `interval`-th frame over to inference.
+
+        The frame handed over shares the camera buffer of the streamed one,
+        without a copy, and gives it back once pre-processed.
+        """
+        self.offered += 1
+        if self.offered % self.interval:
+            return
+        self._queue.put(frame.share())
+        if self._ready is not None:
+            self._ready.set()
+
+    def next_frame(self, timeout=0.5):
+        """Source of the inference pipeline: the newest frame chosen."""
+        return self._queue.get(timeout=timeout)
+
+    def update_result(self, frame):
+        """Last stage of the inference pipeline: keep its result."""
+        with self._lock:
+            self._latest = frame
+        return frame
+
+    def latest(self):
+        """Return the most recently inferred frame, or None."""
+        with self._lock:
+            return self._latest
+
+    def displayed(self, frame, inference_time):
+        """Account a streamed frame and adjust the interval if it's time.
+
+        Args:
+            frame (pipeline.Frame): Frame just sent to the stream.
+            inference_time (float): Seconds per frame of the slowest
+                inference stage, the inverse of the inference throughput.
+
+        """
+        self._display_meter.tick()
+        now = time.time()
+        self.latency += 0.1 * (now - frame.captured_at - self.latency)
+        if not self.adaptive or now - self._updated_at < self.update_period:
+            return
+        self._updated_at = now
+        interval = self._next_interval(inference_time)
+        if interval != self.interval:
+            logger.info("Inference interval: {} -> {} frames".format(
+                self.interval, interval
+            ))
+            self.interval = interval
+
+    def _next_interval(self, inference_time):
+        fps = self.display_fps
+        interval = self.interval
+        slow = self.target_fps and fps < 0.95 * self.target_fps
+        late = self.latency_budget and self.latency > self.latency_budget
+        if slow or late:
+            interval += 1
+        elif not self.latency_budget or \
+                self.latency < 0.8 * self.latency_budget:
+            interval -= 1
+
+        # Frames offered faster than inference completes would be dropped.
+        rate = max(fps, self.target_fps or 0.0)
+        lowest = int(math.ceil(rate * inference_time))
+        return min(max(interval, lowest, 1), self.max_interval)
+
+    def close(self):
+        self._queue.close()
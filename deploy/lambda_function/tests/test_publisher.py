@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Tests of `ResultPublisher` queueing results in memory.
+
+Usage:
+    python -m unittest discover -s tests
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from publisher import DROP_NEWEST, DROP_OLDEST  # noqa: E402
+from publisher import KINESIS_BATCH_TOPIC, KINESIS_TOPIC  # noqa: E402
+from publisher import RESULT_TOPIC, ResultPublisher  # noqa: E402
+
+
+class StubClient(object):
+    """Greengrass client recording what it publishes.
+
+    Args:
+        failures (int): Number of publish calls failing first.
+
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.messages = []
+        self.call_times = []
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload):
+        with self._lock:
+            self.call_times.append(time.time())
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("broker unreachable")
+            self.messages.append((topic, payload))
+
+    def requests(self):
+        """Kinesis Firehose requests, as lists of results."""
+        requests = []
+        for topic, payload in self.messages:
+            if topic == KINESIS_TOPIC:
+                requests.append([json.loads(payload)["request"]["data"]])
+            elif topic == KINESIS_BATCH_TOPIC:
+                requests.append(json.loads(payload)["request"]["data_list"])
+        return requests
+
+    def results(self):
+        """Payloads of the 'inference/result' messages."""
+        return [
+            payload for topic, payload in self.messages
+            if topic == RESULT_TOPIC
+        ]
+
+
+def _results(count):
+    return ["result {}".format(i) for i in range(count)]
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class ResultPublisherTest(unittest.TestCase):
+
+    def _publish(self, client, results, calls=0, **kwargs):
+        """Submit results before starting, then stop once all are sent.
+
+        Stopping cuts retries short, so the publisher is stopped only once
+        the client got `calls` publish calls.
+        """
+        kwargs.setdefault("linger", 0.0)
+        publisher = ResultPublisher(client, **kwargs)
+        accepted = [publisher.submit(result) for result in results]
+        publisher.start()
+        _wait_for(lambda: len(client.call_times) >= calls)
+        publisher.stop(timeout=10)
+        self.assertFalse(publisher._thread.is_alive())
+        return publisher, accepted
+
+    def test_drop_oldest_when_full(self):
+        client = StubClient()
+        publisher, accepted = self._publish(
+            client, _results(5), max_queue=3, policy=DROP_OLDEST,
+        )
+        self.assertEqual(accepted, [True] * 5)
+        self.assertEqual(client.results(), _results(5)[2:])
+        self.assertEqual(publisher.stats(), {
+            "queued": 5, "sent": 3, "dropped": 2, "failed": 0, "pending": 0,
+        })
+
+    def test_drop_newest_when_full(self):
+        client = StubClient()
+        publisher, accepted = self._publish(
+            client, _results(5), max_queue=3, policy=DROP_NEWEST,
+        )
+        self.assertEqual(accepted, [True, True, True, False, False])
+        self.assertEqual(client.results(), _results(3))
+        self.assertEqual(publisher.dropped, 2)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            ResultPublisher(StubClient(), policy="drop_all")
+
+    def test_batch_request(self):
+        client = StubClient()
+        self._publish(client, _results(3), max_batch=10)
+        topics = [topic for topic, _ in client.messages]
+        self.assertEqual(topics, [KINESIS_BATCH_TOPIC] + [RESULT_TOPIC] * 3)
+        self.assertEqual(client.requests(), [_results(3)])
+
+    def test_single_result_request(self):
+        client = StubClient()
+        self._publish(client, _results(1))
+        topics = [topic for topic, _ in client.messages]
+        self.assertEqual(topics, [KINESIS_TOPIC, RESULT_TOPIC])
+        self.assertEqual(client.requests(), [_results(1)])
+
+    def test_batches_split_at_max_batch(self):
+        client = StubClient()
+        self._publish(client, _results(5), max_batch=2)
+        results = _results(5)
+        self.assertEqual(
+            client.requests(), [results[0:2], results[2:4], results[4:]]
+        )
+        self.assertEqual(client.results(), results)
+
+    def test_linger_fills_batch(self):
+        client = StubClient()
+        publisher = ResultPublisher(client, max_batch=3, linger=5.0)
+        publisher.start()
+        for result in _results(3):
+            publisher.submit(result)
+        _wait_for(lambda: len(client.messages) >= 4, timeout=4.0)
+        publisher.stop(timeout=10)
+        # Sent as one batch once full, before the linger expired.
+        self.assertEqual(client.requests(), [_results(3)])
+
+    def test_retry_with_backoff(self):
+        client = StubClient(failures=3)
+        publisher, _ = self._publish(
+            client, _results(2), calls=6, retries=3, backoff=0.05,
+            max_backoff=0.1,
+        )
+        self.assertEqual(client.requests(), [_results(2)])
+        self.assertEqual((publisher.sent, publisher.failed), (2, 0))
+        # Three failed attempts, then the delivered one: waits are doubled
+        # up to max_backoff.
+        waits = [
+            later - earlier for earlier, later
+            in zip(client.call_times[:3], client.call_times[1:4])
+        ]
+        for wait, expected in zip(waits, [0.05, 0.1, 0.1]):
+            self.assertGreaterEqual(wait, expected * 0.9)
+
+    def test_failed_after_retries(self):
+        client = StubClient(failures=2)
+        publisher, _ = self._publish(
+            client, _results(2), calls=4, retries=1, backoff=0.01,
+        )
+        # The Kinesis Firehose request failed twice; the results are
+        # counted as failed and still sent on 'inference/result'.
+        self.assertEqual(len(client.call_times), 4)
+        self.assertEqual(client.requests(), [])
+        self.assertEqual(client.results(), _results(2))
+        self.assertEqual((publisher.sent, publisher.failed), (0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
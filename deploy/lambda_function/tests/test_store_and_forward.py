@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 LeapMind Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================
+"""Tests of `ResultPublisher` forwarding results kept in a `ResultStore`.
+
+Usage:
+    python -m unittest discover -s tests
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals
+)
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from publisher import KINESIS_BATCH_TOPIC, KINESIS_TOPIC  # noqa: E402
+from publisher import RESULT_TOPIC, ResultPublisher  # noqa: E402
+from result_store import ResultStore  # noqa: E402
+
+
+class FailingClient(object):
+    """Greengrass client failing every publish call while `down` is set.
+
+    Args:
+        store (ResultStore): Store whose results are counted when a Kinesis
+            Firehose request is delivered.
+
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self.down = threading.Event()
+        self.calls = 0
+        self.delivered = []
+        self.results = []
+        # Results kept in the store when each request was delivered.
+        self.stored_on_delivery = []
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload):
+        with self._lock:
+            self.calls += 1
+            if self.down.is_set():
+                raise RuntimeError("broker unreachable")
+            if topic == KINESIS_TOPIC:
+                data_list = [json.loads(payload)["request"]["data"]]
+            elif topic == KINESIS_BATCH_TOPIC:
+                data_list = json.loads(payload)["request"]["data_list"]
+            else:
+                self.results.append(payload)
+                return
+            self.delivered.extend(data_list)
+            if self.store is not None:
+                self.stored_on_delivery.append(
+                    [payload for _, payload in self.store.peek(len(data_list))]
+                )
+
+
+def _results(count):
+    return ["result {}".format(i) for i in range(count)]
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class StoreAndForwardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "results.db")
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.directory)
+
+    def _store(self, **kwargs):
+        store = ResultStore(self.path, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def _publisher(self, client, store):
+        return ResultPublisher(
+            client, max_batch=10, linger=0.0, retries=1, backoff=0.01,
+            max_backoff=0.05, store=store,
+        )
+
+    def test_kept_while_publishing_fails(self):
+        store = self._store()
+        client = FailingClient(store)
+        client.down.set()
+        publisher = self._publisher(client, store)
+        publisher.start()
+        for result in _results(3):
+            publisher.submit(result)
+        # Several failed attempts, each one of two publish calls.
+        self.assertTrue(_wait_for(lambda: client.calls >= 6))
+        publisher.stop(timeout=10)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(
+            [payload for _, payload in store.peek(10)], _results(3)
+        )
+        self.assertEqual(client.delivered, [])
+        # Sent on 'inference/result' only with a delivered request.
+        self.assertEqual(client.results, [])
+        self.assertEqual(publisher.sent, 0)
+        self.assertGreater(publisher.failed, 0)
+
+    def test_resent_after_recovery(self):
+        store = self._store()
+        client = FailingClient(store)
+        client.down.set()
+        publisher = self._publisher(client, store)
+        publisher.start()
+        for result in _results(3):
+            publisher.submit(result)
+        self.assertTrue(_wait_for(lambda: client.calls >= 4))
+        client.down.clear()
+        self.assertTrue(_wait_for(lambda: len(store) == 0))
+        publisher.stop(timeout=10)
+        self.assertEqual(client.delivered, _results(3))
+        self.assertEqual(client.results, _results(3))
+        self.assertEqual(publisher.sent, 3)
+
+    def test_deleted_only_after_delivery(self):
+        store = self._store()
+        client = FailingClient(store)
+        publisher = self._publisher(client, store)
+        for result in _results(3):
+            publisher.submit(result)
+        publisher.start()
+        self.assertTrue(_wait_for(lambda: len(store) == 0))
+        publisher.stop(timeout=10)
+        # Still stored while their request was being delivered.
+        self.assertEqual(client.stored_on_delivery, [_results(3)])
+        self.assertEqual(client.delivered, _results(3))
+
+    def test_resent_after_restart(self):
+        store = self._store()
+        client = FailingClient(store)
+        client.down.set()
+        publisher = self._publisher(client, store)
+        publisher.start()
+        for result in _results(3):
+            publisher.submit(result)
+        self.assertTrue(_wait_for(lambda: client.calls >= 2))
+        publisher.stop(timeout=10)
+        store.close()
+        self.stores.remove(store)
+
+        # Like a restart of the Lambda function with the broker back.
+        store = self._store()
+        self.assertEqual(len(store), 3)
+        client = FailingClient(store)
+        publisher = self._publisher(client, store)
+        publisher.start()
+        self.assertTrue(_wait_for(lambda: len(store) == 0))
+        publisher.stop(timeout=10)
+        self.assertEqual(client.delivered, _results(3))
+
+    def test_oldest_evicted_beyond_limit(self):
+        store = self._store(max_results=2)
+        client = FailingClient(store)
+        client.down.set()
+        publisher = self._publisher(client, store)
+        for result in _results(3):
+            publisher.submit(result)
+        self.assertEqual(publisher.dropped, 1)
+        client.down.clear()
+        publisher.start()
+        self.assertTrue(_wait_for(lambda: len(store) == 0))
+        publisher.stop(timeout=10)
+        self.assertEqual(client.delivered, _results(3)[1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -31,6 +31,9 @@ STATE_NORMAL = "NORMAL"
 STATE_WARNING = "WARNING"
 STATE_CLEAR = "CLEAR"
 
+_FONTS = {}
+_TEXT_FONTS = {}
+
 
 def _mask_image(image):
     # Mask right-half image with Red color
@@ -57,60 +60,139 @@ def _scale_boxes(post_processed, input_image_shape, predict_image_shape):
     return predict_boxes
 
 
-def _decide_class(preds, tuning_threshold=0.0):
-    class_id = 0
-    score = 0.0
-    for pred in preds:
-        current_score = pred[1]
-        if current_score - tuning_threshold >= score:
-            class_id = int(pred[0])
-            score = current_score
-    return class_id, score
+def _group_boxes(predict_boxes):
+    """Group prediction rows having identical box coordinates.
+
+    Args:
+        predict_boxes (np.ndarray): [N, 6] rows of (x, y, w, h, class, score).
+
+    Returns:
+        np.ndarray: [G] index of the first row of each group, in order of
+            first appearance.
+        np.ndarray: [G] index of the row deciding the class of each group,
+            the last one having the highest score.
+
+    """
+    num_rows = len(predict_boxes)
+    boxes = np.ascontiguousarray(predict_boxes[:, :4])
+    # Rows with the same coordinates have the same bytes, so a void view
+    # lets np.unique group them in one sort.
+    keys = boxes.view(np.dtype((np.void, boxes.dtype.itemsize * 4))).ravel()
+    _, first, group = np.unique(keys, return_index=True, return_inverse=True)
+    group = group.ravel()
+
+    # Sort rows by group, then score, then position: the last row of each
+    # group is its best one, ties going to the later row.
+    scores = predict_boxes[:, 5]
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    order = np.lexsort((np.arange(num_rows), scores, group))
+    last = np.append(np.flatnonzero(np.diff(group[order])), num_rows - 1)
+    best = order[last]
+
+    # Report groups in order of their first row.
+    appearance = np.argsort(first, kind="mergesort")
+    return first[appearance], best[appearance]
+
+
+def _gather_prediction_arrays(predict_boxes):
+    """Remove duplicate boxes of different classes, keeping the best class.
+
+    Args:
+        predict_boxes (np.ndarray): [N, 6] rows of (x, y, w, h, class, score).
+
+    Returns:
+        np.ndarray: [G, 4] unique boxes in order of first appearance.
+        np.ndarray: [G] class id of each box.
+        np.ndarray: [G] score of each box.
+
+    """
+    if len(predict_boxes) == 0:
+        return (
+            np.zeros((0, 4), dtype=predict_boxes.dtype),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=predict_boxes.dtype),
+        )
+    first, best = _group_boxes(predict_boxes)
+    boxes = predict_boxes[first, :4]
+    class_ids = predict_boxes[best, 4].astype(np.int64)
+    scores = predict_boxes[best, 5]
+    # A group whose best score is negative keeps the default class 0.
+    invalid = ~(scores >= 0.0)
+    class_ids[invalid] = 0
+    scores[invalid] = 0.0
+    return boxes, class_ids, scores
+
+
+def _to_uniq_boxes(boxes, class_ids, scores):
+    return [
+        {"box": box, "class_id": class_id, "score": score}
+        for box, class_id, score in zip(
+            boxes.tolist(), class_ids.tolist(), scores
+        )
+    ]
 
 
 def _gather_prediction(predict_boxes):
-    box_preds_list = []
-    indices = {}
-    for predict_box in predict_boxes:
-        box = predict_box[:4].tolist()
-        pred = predict_box[4:]
-        key = "{}-{}-{}-{}".format(*box)
-        if key in indices:
-            box_preds_list[indices[key]]["preds"].append(pred)
-        else:
-            indices[key] = len(box_preds_list)
-            box_preds_list.append({
-                "box": box,
-                "preds": [pred],
-            })
-
-    uniq_boxes = []
-    for box_preds in box_preds_list:
-        class_id, score = _decide_class(box_preds["preds"])
-        box = box_preds["box"]
-        uniq_boxes.append({
-            "box": box,
-            "class_id": class_id,
-            "score": score,
-        })
-
-    return uniq_boxes
-
-
-def _get_state(box, center_width):
+    return _to_uniq_boxes(*_gather_prediction_arrays(predict_boxes))
+
+
+def _get_states(boxes, center_width):
     # Check if the center of box is not in restricted area
-    mid = box["box"][0] + (box["box"][2] / 2)
-    return (mid < center_width), box["class_id"]
+    boxes = boxes.astype(np.float64)
+    return (boxes[:, 0] + boxes[:, 2] / 2) < center_width
+
+
+def _get_total_state(states, class_ids, ng_class_id):
+    restricted = ~states
+    if np.any(restricted & (class_ids == ng_class_id)):
+        return STATE_WARNING
+    return STATE_CLEAR if np.any(restricted) else STATE_NORMAL
+
+
+def _evaluate(image_shape, post_processed, config):
+    ng_class_id = _ng_class_id(config.CLASSES)
+    center_width = image_shape[1] // 2
+    predict_boxes = _scale_boxes(
+        post_processed, image_shape, config.IMAGE_SIZE
+    )
+
+    # Gather and remove duplicate box in different classes
+    boxes, class_ids, scores = _gather_prediction_arrays(predict_boxes)
+    states = _get_states(boxes, center_width)
+    total_state = _get_total_state(states, class_ids, ng_class_id)
+
+    uniq_boxes = _to_uniq_boxes(boxes, class_ids, scores)
+    states = list(zip(states.tolist(), class_ids.tolist()))
+    return uniq_boxes, states, total_state
+
+
+def _ng_class_id(classes):
+    return classes.index("face") if "face" in classes else 0
+
+
+def _box_label(uniq_box, state, classes, ng_class_id):
+    prefix = "[OK]" if state[0] or (state[1] != ng_class_id) else "[NG]"
+    return "{:s} {:s}: {:.3f}".format(
+        prefix, classes[uniq_box["class_id"]], float(uniq_box["score"])
+    )
+
+
+def _update_state(prev_state, total_state, start_time, duration):
+    if prev_state != total_state:
+        start_time = time.time()
+    elapsed_time = float(time.time() - start_time)
+    displayed = elapsed_time >= duration
+    displayed_waring = total_state == STATE_WARNING and displayed
+    displayed_clear = total_state == STATE_CLEAR and displayed
+    return start_time, displayed_waring, displayed_clear
 
 
-def _get_total_state(states, ng_class_id):
-    box_in_restricted_area = False
-    for state, class_id in states:
-        if not state:
-            if class_id == ng_class_id:
-                return STATE_WARNING
-            box_in_restricted_area = True
-    return STATE_CLEAR if box_in_restricted_area else STATE_NORMAL
+def _load_font(size):
+    # Loading a TrueType font is costly, keep one instance per size.
+    font = _FONTS.get(size)
+    if font is None:
+        font = _FONTS[size] = PIL.ImageFont.truetype(FONT, size)
+    return font
 
 
 def visualize_object_detection_custom(
@@ -137,23 +219,18 @@ def visualize_object_detection_custom(
 
     colorWarning = (255, 0, 0)
     colorClear = (0, 255, 0)
-    box_font = PIL.ImageFont.truetype(FONT, 10)
-    state_font = PIL.ImageFont.truetype(FONT, 20)
+    box_font = _load_font(10)
+    state_font = _load_font(20)
 
     classes = config.CLASSES
-    ng_class_id = classes.index("face") if "face" in classes else 0
+    ng_class_id = _ng_class_id(classes)
     start_time = start_time or time.time()
 
     center_width = image.shape[1] // 2
-    predict_boxes = _scale_boxes(
-        post_processed, image.shape, config.IMAGE_SIZE
+    uniq_boxes, states, total_state = _evaluate(
+        image.shape, post_processed, config
     )
 
-    # Gather and remove duplicate box in different classes
-    uniq_boxes = _gather_prediction(predict_boxes)
-    states = [_get_state(box, center_width) for box in uniq_boxes]
-    total_state = _get_total_state(states, ng_class_id)
-
     image = PIL.Image.fromarray(_mask_image(image))
     draw = PIL.ImageDraw.Draw(image)
     for uniq_box, state in zip(uniq_boxes, states):
@@ -161,24 +238,18 @@ def visualize_object_detection_custom(
         class_id = uniq_box["class_id"]
         xy = [box[0], box[1], box[0] + box[2], box[1] + box[3]]
         color = colorWarning if class_id == ng_class_id else colorClear
-        prefix = "[OK]" if state[0] or (state[1] != ng_class_id) else "[NG]"
-        txt = "{:s} {:s}: {:.3f}".format(
-            prefix, classes[class_id], float(uniq_box["score"])
-        )
+        txt = _box_label(uniq_box, state, classes, ng_class_id)
         draw.rectangle(xy, outline=color)
         draw.text([box[0], box[1]], txt, fill=color, font=box_font)
 
-    if prev_state != total_state:
-        start_time = time.time()
-
-    elapsed_time = float(time.time() - start_time)
+    start_time, displayed_waring, displayed_clear = _update_state(
+        prev_state, total_state, start_time, duration
+    )
     right_corner = [center_width + 60, 0]
 
-    displayed_waring = False
-    if total_state == STATE_WARNING and elapsed_time >= duration:
+    if displayed_waring:
         draw.text(right_corner, "WARNING", fill=colorWarning, font=state_font)
-        displayed_waring = True
-    elif total_state == STATE_CLEAR and elapsed_time >= duration:
+    elif displayed_clear:
         draw.text(right_corner, "  CLEAR", fill=colorClear, font=state_font)
 
     return image, total_state, start_time, displayed_waring
@@ -199,5 +270,210 @@ def draw_fps(pil_image, fps_only_network):
         (10, pil_image.height - font_size - 5),
         "FPS: {:.1f}".format(fps_only_network),
         fill=(0, 0, 255),
-        font=PIL.ImageFont.truetype(FONT, font_size),
+        font=_load_font(font_size),
     )
+
+
+class _TextMasks(object):
+    """The TrueType font of the PIL drawings, blended into numpy images.
+
+    PIL renders only the text, into a coverage mask kept for the next
+    frames, so labels look the same as with `PIL.ImageDraw` without
+    converting the frame.
+    """
+
+    max_texts = 256
+
+    def __init__(self, size):
+        self.font = _load_font(size)
+        ascent, descent = self.font.getmetrics()
+        self.height = ascent + descent
+        self._masks = {}
+
+    def mask(self, text):
+        """Coverage of the pixels of text, from 0 to 1.
+
+        Returns:
+            np.ndarray: [height, width, 1] coverage.
+            int: Offset of its first column from where the text is drawn.
+
+        """
+        cached = self._masks.get(text)
+        if cached is not None:
+            return cached
+        # Wide enough for any text, with room for glyphs overhanging their
+        # position; cropped to the drawn columns below.
+        pad = self.height
+        canvas = PIL.Image.new(
+            "L", (len(text) * self.height + 2 * pad, self.height)
+        )
+        PIL.ImageDraw.Draw(canvas).text(
+            (pad, 0), text, fill=255, font=self.font
+        )
+        mask = np.asarray(canvas, dtype=np.float32) / 255
+        columns = np.flatnonzero(mask.any(axis=0))
+        if len(columns):
+            mask = mask[:, columns[0]:columns[-1] + 1]
+            offset = columns[0] - pad
+        else:
+            mask, offset = mask[:, :0], 0
+        # Texts are mostly the same labels and statistics from frame to
+        # frame; beyond the limit, start over.
+        if len(self._masks) >= self.max_texts:
+            self._masks.clear()
+        cached = self._masks[text] = (mask[:, :, np.newaxis], offset)
+        return cached
+
+    def draw(self, image, xy, text, color):
+        mask, offset = self.mask(text)
+        x, y = int(xy[0]) + offset, int(xy[1])
+        height, width = image.shape[:2]
+        top, left = max(y, 0), max(x, 0)
+        bottom = min(y + mask.shape[0], height)
+        right = min(x + mask.shape[1], width)
+        if top >= bottom or left >= right:
+            return
+        alpha = mask[top - y:bottom - y, left - x:right - x]
+        region = image[top:bottom, left:right]
+        blended = region + alpha * (
+            np.array(color, dtype=np.float32) - region
+        )
+        region[...] = (blended + 0.5).astype(np.uint8)
+
+
+class FrameRenderer(object):
+    """Draw inference results and statistics straight onto numpy RGB frames.
+
+    It produces the same decorations as `visualize_object_detection_custom`
+    without per-frame costs: texts of the same TrueType font are rendered
+    once, the red mask of the restricted area is a precomputed lookup
+    table, and boxes and text are drawn in place with OpenCV and numpy
+    instead of converting the frame to a PIL image and back.
+
+    Args:
+        config (EasyDict): Inference config.
+
+    """
+
+    color_warning = (255, 0, 0)
+    color_clear = (0, 255, 0)
+    color_stats = (0, 0, 255)
+
+    def __init__(self, config):
+        self.config = config
+        self.ng_class_id = _ng_class_id(config.CLASSES)
+        self.box_font = _TextMasks(10)
+        self.state_font = _TextMasks(20)
+        self.fps_font = _TextMasks(14)
+        self.stage_font = _TextMasks(10)
+
+        # _mask_image blends every pixel with a constant color, so the
+        # blended value only depends on the input value and the channel.
+        ramp = np.tile(
+            np.arange(256, dtype=np.uint8).reshape(1, 256, 1), (1, 1, 3)
+        )
+        mask = np.ones(ramp.shape, dtype=np.uint8)
+        mask[:, :, 0] = 255
+        self.mask_lut = cv2.addWeighted(ramp, 0.5, mask, 0.5, 1.0)
+
+    def mask_image(self, image):
+        """Same as `_mask_image`, using the precomputed lookup table."""
+        height, width = image.shape[:2]
+        image[:, width // 2:] = cv2.LUT(image[:, width // 2:], self.mask_lut)
+        return image
+
+    def render_object_detection(
+            self, image, post_processed, prev_state, start_time, duration):
+        """Draw object detection result boxes onto image in place.
+
+        Args and returns are the same as `visualize_object_detection_custom`
+        except that the drawn image is the given np.ndarray.
+
+        """
+        classes = self.config.CLASSES
+        ng_class_id = self.ng_class_id
+        start_time = start_time or time.time()
+
+        center_width = image.shape[1] // 2
+        uniq_boxes, states, total_state = _evaluate(
+            image.shape, post_processed, self.config
+        )
+
+        image = self.mask_image(image)
+        for uniq_box, state in zip(uniq_boxes, states):
+            box = uniq_box["box"]
+            class_id = uniq_box["class_id"]
+            color = (
+                self.color_warning if class_id == ng_class_id
+                else self.color_clear
+            )
+            txt = _box_label(uniq_box, state, classes, ng_class_id)
+            cv2.rectangle(
+                image,
+                (int(box[0]), int(box[1])),
+                (int(box[0] + box[2]), int(box[1] + box[3])),
+                color,
+            )
+            self.box_font.draw(image, box[:2], txt, color)
+
+        start_time, displayed_waring, displayed_clear = _update_state(
+            prev_state, total_state, start_time, duration
+        )
+        right_corner = [center_width + 60, 0]
+
+        if displayed_waring:
+            self.state_font.draw(
+                image, right_corner, "WARNING", self.color_warning
+            )
+        elif displayed_clear:
+            self.state_font.draw(
+                image, right_corner, "  CLEAR", self.color_clear
+            )
+
+        return image, total_state, start_time, displayed_waring
+
+    def draw_stats(self, image, fps, latencies, frame_bytes=None,
+                   inference_interval=None):
+        """Draw pipeline throughput and per-stage latency onto image.
+
+        Args:
+            image (np.ndarray): RGB image to be drawn in place.
+            fps (float): End-to-end throughput of the pipeline.
+            latencies (list): (stage name, latency in seconds) tuples.
+            frame_bytes (float): Size of an encoded frame, if known.
+            inference_interval (int): Frames per inference, if known.
+
+        Returns:
+
+        """
+        fps_font_size = 14
+        stage_font_size = 10
+        y = image.shape[0] - fps_font_size - 5
+        text = "FPS: {:.1f}".format(fps)
+        if frame_bytes is not None:
+            text += " ({:.1f}KB)".format(frame_bytes / 1024)
+        if inference_interval is not None:
+            text += " infer 1/{:d}".format(inference_interval)
+        self.fps_font.draw(image, (10, y), text, self.color_stats)
+        for name, latency in reversed(latencies):
+            y -= stage_font_size + 2
+            self.stage_font.draw(
+                image, (10, y),
+                "{:s}: {:.1f}ms".format(name, latency * 1000),
+                self.color_stats,
+            )
+
+
+def draw_message(image, text, color=(255, 255, 0)):
+    """Draw a status message, e.g. while the model loads, onto image.
+
+    Args:
+        image (np.ndarray): RGB image to be drawn in place.
+        text (str): Message drawn at the top left corner.
+        color (tuple): RGB color of the text.
+
+    """
+    font = _TEXT_FONTS.get("message")
+    if font is None:
+        font = _TEXT_FONTS["message"] = _TextMasks(20)
+    font.draw(image, (10, 10), text, color)